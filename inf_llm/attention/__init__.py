@@ -4,6 +4,8 @@ from .inf_llm import inf_llm_forward
 from .infinite_lm import infinite_lm_forward
 from .stream_llm import stream_llm_forward
 from .origin import origin_forward
+from .cache_stats import model_stats, to_prometheus, write_prometheus, model_memory_report, check_memory_budget, session_memory
+from .profiler import StageProfiler, enable_stage_profiler, disable_stage_profiler
 
 ATTN_FORWRAD = {
     "inf-llm": inf_llm_forward,
@@ -12,4 +14,6 @@ ATTN_FORWRAD = {
     "origin": origin_forward
 }
 
-__all__ = ["RotaryEmbeddingESM", "ATTN_FORWARD"]
\ No newline at end of file
+__all__ = ["RotaryEmbeddingESM", "ATTN_FORWARD", "model_stats", "to_prometheus", "write_prometheus",
+           "model_memory_report", "check_memory_budget", "session_memory",
+           "StageProfiler", "enable_stage_profiler", "disable_stage_profiler"]
\ No newline at end of file
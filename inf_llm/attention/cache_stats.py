@@ -0,0 +1,311 @@
+import os
+import weakref
+import torch
+from typing import Optional
+
+# retrievals are bucketed by the number of blocks they load: 0, 1, 2-3, 4-7, ...
+_NUM_LOAD_BUCKETS = 24
+
+
+class CacheStats:
+    """
+    Counters of one ContextManager's memory unit cache, kept per unit.
+
+    Everything is counted from what the host already knows when blocks are
+    retrieved, loaded, evicted or added. The only exception is the retrieval set
+    churn, the number of selected blocks that the previous selection did not have.
+    It costs a comparison on device per retrieval, so it is only accumulated with
+    track_churn, and only read back when the stats are read. Otherwise it is None.
+    """
+    def __init__(self, num_units: int, block_bytes: int, track_churn: bool = False):
+        self.num_units = num_units
+        self.block_bytes = block_bytes
+        self.track_churn = track_churn
+        self.retrievals = 0
+        self.selected = [0] * num_units
+        self.loaded = [0] * num_units
+        self.evicted = [0] * num_units
+        self.added = 0
+        # load_histogram[i] retrievals loaded n blocks with n.bit_length() == i
+        self.load_histogram = [0] * _NUM_LOAD_BUCKETS
+        self._churn = None
+        self._prev_topk = None
+
+    def record_retrieval(self, block_topk: torch.Tensor, loaded: Optional[list] = None):
+        """
+        block_topk - (num_units, k) selected blocks, on device
+        loaded     - blocks loaded from CPU per unit, None if all were cached
+        """
+        self.retrievals += 1
+        for u in range(self.num_units):
+            self.selected[u] += block_topk.size(1)
+
+        num_loaded = 0
+        if loaded is not None:
+            for u, n in enumerate(loaded):
+                self.loaded[u] += n
+            num_loaded = sum(loaded)
+        self.load_histogram[min(num_loaded.bit_length(), _NUM_LOAD_BUCKETS - 1)] += 1
+
+        if not self.track_churn:
+            return
+
+        if self._churn is None:
+            self._churn = torch.zeros((self.num_units,), dtype=torch.int64, device=block_topk.device)
+        if self._prev_topk is None:
+            self._churn.add_(block_topk.size(1))
+        else:
+            kept = (block_topk[:, :, None] == self._prev_topk[:, None, :]).any(dim=-1)
+            self._churn.add_((~kept).sum(dim=-1))
+        self._prev_topk = block_topk
+
+    def record_loads(self, loaded: list):
+        """
+        Blocks loaded per unit outside of a retrieval, i.e. deferred loads.
+        """
+        for u, n in enumerate(loaded):
+            self.loaded[u] += n
+
+    def record_eviction(self, u: int):
+        self.evicted[u] += 1
+
+    def record_add(self):
+        self.added += 1
+
+    def as_dict(self, num_blocks: int = 0, num_cached_blocks: int = 0) -> dict:
+        if not self.track_churn:
+            churn = [None] * self.num_units
+        elif self._churn is None:
+            churn = [0] * self.num_units
+        else:
+            churn = self._churn.tolist()
+        total_churn = None if not self.track_churn else sum(churn)
+        selected = sum(self.selected)
+        loaded = sum(self.loaded)
+        return {
+            "retrievals": self.retrievals,
+            "selected_blocks": selected,
+            "hit_blocks": selected - loaded,
+            "hit_rate": (selected - loaded) / selected if selected > 0 else None,
+            "loaded_blocks": loaded,
+            "loaded_bytes": loaded * self.block_bytes,
+            "loaded_blocks_per_retrieval": loaded / self.retrievals if self.retrievals > 0 else None,
+            "evicted_blocks": sum(self.evicted),
+            "added_blocks": self.added,
+            "blocks": num_blocks,
+            "cached_blocks": num_cached_blocks,
+            "churn_blocks": total_churn,
+            "churn_rate": total_churn / selected if total_churn is not None and selected > 0 else None,
+            "load_histogram": list(self.load_histogram),
+            "units": [
+                {
+                    "selected_blocks": self.selected[u],
+                    "loaded_blocks": self.loaded[u],
+                    "evicted_blocks": self.evicted[u],
+                    "churn_blocks": churn[u],
+                }
+                for u in range(self.num_units)
+            ],
+        }
+
+
+_SUMMED_STATS = [
+    "retrievals", "selected_blocks", "hit_blocks", "loaded_blocks", "loaded_bytes",
+    "evicted_blocks", "added_blocks", "blocks", "cached_blocks"
+]
+
+
+def register_context_manager(model, layer_idx: int, manager) -> None:
+    """
+    Makes `manager` the ContextManager of layer `layer_idx` in `model.stats()`.
+    Only a weak reference is kept, so finished sessions are not held on to.
+    """
+    if not hasattr(model, "_context_managers"):
+        model._context_managers = {}
+    model._context_managers[layer_idx] = weakref.ref(manager)
+
+
+def model_stats(model) -> dict:
+    """
+    Cache stats of the live ContextManagers of `model`, per layer and summed over layers.
+    """
+    layers = {}
+    for layer_idx, ref in sorted(getattr(model, "_context_managers", {}).items()):
+        manager = ref()
+        if manager is not None and manager.initialized:
+            layers[layer_idx] = manager.stats()
+
+    total = {key: sum(s[key] for s in layers.values()) for key in _SUMMED_STATS}
+    total["hit_rate"] = total["hit_blocks"] / total["selected_blocks"] if total["selected_blocks"] > 0 else None
+    # churn is only summed when every layer tracked it
+    churn = [s["churn_blocks"] for s in layers.values()]
+    total["churn_blocks"] = sum(churn) if None not in churn else None
+    total["churn_rate"] = (
+        total["churn_blocks"] / total["selected_blocks"]
+        if total["churn_blocks"] is not None and total["selected_blocks"] > 0 else None
+    )
+    total["load_histogram"] = [sum(h) for h in zip(*(s["load_histogram"] for s in layers.values()))]
+    return {"layers": layers, "total": total}
+
+
+_PROMETHEUS_COUNTERS = [
+    ("retrievals", "Top-k retrievals of memory units."),
+    ("selected_blocks", "Memory units selected by top-k retrieval."),
+    ("hit_blocks", "Selected memory units that were already in the GPU cache."),
+    ("loaded_blocks", "Memory units loaded from CPU to the GPU cache."),
+    ("loaded_bytes", "Bytes loaded from CPU to the GPU cache."),
+    ("evicted_blocks", "Memory units evicted from the GPU cache."),
+    ("added_blocks", "Memory units created."),
+    ("churn_blocks", "Selected memory units that were not in the previous selection."),
+]
+
+_PROMETHEUS_GAUGES = [
+    ("blocks", "Memory units stored."),
+    ("cached_blocks", "Memory units resident in the GPU cache."),
+]
+
+
+def to_prometheus(stats: dict, prefix: str = "infllm_cache") -> str:
+    """
+    Prometheus text exposition of `model_stats` output, one series per layer.
+    Layers without a value, i.e. churn when it is not tracked, have no series.
+    """
+    layers = stats["layers"]
+    lines = []
+    for name, help, kind in (
+        [(name, help, "counter") for name, help in _PROMETHEUS_COUNTERS] +
+        [(name, help, "gauge") for name, help in _PROMETHEUS_GAUGES]
+    ):
+        metric = f"{prefix}_{name}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# HELP {metric} {help}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for layer_idx, s in layers.items():
+            if s[name] is not None:
+                lines.append(f'{metric}{{layer="{layer_idx}"}} {s[name]}')
+
+    metric = f"{prefix}_loaded_blocks_per_retrieval"
+    lines.append(f"# HELP {metric} Memory units loaded from CPU by one retrieval.")
+    lines.append(f"# TYPE {metric} histogram")
+    for layer_idx, s in layers.items():
+        count = 0
+        for i, n in enumerate(s["load_histogram"]):
+            count += n
+            le = "+Inf" if i == len(s["load_histogram"]) - 1 else str((1 << i) - 1)
+            lines.append(f'{metric}_bucket{{layer="{layer_idx}",le="{le}"}} {count}')
+        lines.append(f'{metric}_sum{{layer="{layer_idx}"}} {s["loaded_blocks"]}')
+        lines.append(f'{metric}_count{{layer="{layer_idx}"}} {count}')
+
+    return "\n".join(lines) + "\n"
+
+
+_MEMORY_TIERS = [
+    "gpu_cache", "gpu_cache_used", "local", "init", "remainder",
+    "block_repr", "block_table", "host", "gpu_total", "host_total"
+]
+
+
+def model_memory_report(model) -> dict:
+    """
+    Bytes held by the live ContextManagers of `model` per tier, per layer and summed over
+    layers. The total also has the shared attention workspace under "workspace", which is
+    included in its "gpu_total". The total "peak" sums the peaks of the layers, so it bounds
+    the peak of the model from above. Peaks are tracked, at a small cost per step, from the
+    first report on, including in later sessions.
+    """
+    from .dot_production_attention import get_workspace_pool
+    model.track_memory_peak = True
+    layers = {}
+    for layer_idx, ref in sorted(getattr(model, "_context_managers", {}).items()):
+        manager = ref()
+        if manager is not None and manager.initialized:
+            layers[layer_idx] = manager.memory_report()
+
+    total = {key: sum(r[key] for r in layers.values()) for key in _MEMORY_TIERS}
+    total["peak"] = {key: sum(r["peak"].get(key, 0) for r in layers.values()) for key in _MEMORY_TIERS}
+    total["workspace"] = get_workspace_pool().nbytes()
+    total["gpu_total"] += total["workspace"]
+    return {"layers": layers, "total": total}
+
+
+def session_memory(model, num_tokens: int = 0, batch_size: int = 1) -> dict:
+    """
+    Bytes a new session of `model` takes after `num_tokens` tokens, computed from the
+    inf-llm settings in `model.inf_llm_config` and the model config, before any
+    ContextManager exists. Returns {"layer": {"gpu", "host"}, "workspace"}: the bytes of
+    one layer, and of the workspace shared by all layers (global buffer and attention
+    accumulators). Empty if the model was not patched with inf-llm.
+    """
+    config = getattr(model, "inf_llm_config", None)
+    if config is None:
+        return {}
+
+    num_heads = model.config.num_attention_heads
+    num_heads_kv = getattr(model.config, "num_key_value_heads", None) or num_heads
+    dim_head = model.config.hidden_size // num_heads
+    element_size = torch.empty((), dtype=model.dtype).element_size()
+    block_size = config["block_size"]
+    # bytes of one token's keys and values in every unit
+    kv_bytes = batch_size * num_heads_kv * dim_head * 2 * element_size
+
+    # cuda cache slots, local window (and its rotated keys) and initial tokens
+    gpu = config["max_cached_block"] * block_size * kv_bytes
+    gpu += config["n_local"] * kv_bytes * (3 if config["absolute_local_rope"] else 2) // 2
+    gpu += config["n_init"] * kv_bytes
+
+    # memory units: host copies, and on the device one representative and block table entry each
+    num_blocks = max(num_tokens - config["n_init"] - config["n_local"], 0) // block_size
+    expected_blocks = (config["expected_length"] or 0) // block_size
+    host = num_blocks * block_size * kv_bytes
+    capacity = max(expected_blocks, 16)
+    while num_blocks > capacity:
+        capacity *= 2
+    gpu += capacity * batch_size * (8 + 4)
+    if not config["faiss"]:
+        gpu += max(num_blocks, expected_blocks) * batch_size * num_heads * dim_head * element_size
+
+    buffer_len = config["exc_block_size"] + block_size + config["n_init"]
+    workspace = buffer_len * kv_bytes
+    # float32 output accumulators with their running max / sum of a query block
+    workspace += batch_size * num_heads * config["exc_block_size"] * (dim_head + 2) * 4
+    return {"layer": {"gpu": gpu, "host": host}, "workspace": workspace}
+
+
+def check_memory_budget(
+    model, num_new_tokens: int = 0,
+    gpu_budget: Optional[int] = None, host_budget: Optional[int] = None
+) -> dict:
+    """
+    Whether the current session of `model` stays within gpu_budget / host_budget bytes
+    (None for no limit) after num_new_tokens more tokens. Returns {"fits", "gpu", "host"}
+    with the projected totals, for the caller to refuse the request or degrade it, e.g.
+    by truncating the input. Layers without a live ContextManager, e.g. before the first
+    request, are charged the cost of a new session (see session_memory).
+    """
+    report = model_memory_report(model)
+    gpu = report["total"]["gpu_total"]
+    host = report["total"]["host_total"]
+    for layer_idx in report["layers"]:
+        growth = model._context_managers[layer_idx]().memory_growth(num_new_tokens)
+        gpu += growth["gpu"]
+        host += growth["host"]
+
+    session = session_memory(model, num_new_tokens)
+    if len(session) > 0:
+        num_new_layers = model.config.num_hidden_layers - len(report["layers"])
+        gpu += num_new_layers * session["layer"]["gpu"]
+        host += num_new_layers * session["layer"]["host"]
+        gpu += max(session["workspace"] - report["total"]["workspace"], 0)
+
+    fits = (gpu_budget is None or gpu <= gpu_budget) and (host_budget is None or host <= host_budget)
+    return {"fits": fits, "gpu": gpu, "host": host}
+
+
+def write_prometheus(model, filename: str, prefix: str = "infllm_cache") -> None:
+    """
+    Writes the cache stats of `model` to `filename` in Prometheus text format,
+    e.g. for the node exporter's textfile collector. The file is replaced atomically.
+    """
+    tmp = f"{filename}.tmp"
+    with open(tmp, "w") as f:
+        f.write(to_prometheus(model_stats(model), prefix))
+    os.replace(tmp, filename)
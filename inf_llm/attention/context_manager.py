@@ -1,8 +1,10 @@
 import torch
 from typing import Optional, Tuple
-from copy import deepcopy
-from .dot_production_attention import get_multi_stage_dot_production_attention
+from contextlib import nullcontext
+from .dot_production_attention import get_multi_stage_dot_production_attention, get_workspace_pool
 from .context_manager_listener import GlobalCacheListener
+from .cache_stats import CacheStats
+from .static_decode import get_static_decode_attention
 
 class CudaCache:
     def __init__(self, num_units, unit_size, dtype):
@@ -110,59 +112,113 @@ class MemoryUnit:
         self.gpu_data_id = None
 
 
+# rows of the first segment of a VectorTensor, later ones double up to its page_size
+_MIN_PAGE_SIZE = 16
+
+
 class VectorTensor:
+    """
+    Block representatives of all units in a single (num_units, unit_size, length, dim_head)
+    store, updated in place and shared by the retrieval of every unit.
+
+    The length dimension is stored in fixed-size pages, so that growing it never
+    reallocates or copies the elements already stored. An optional `expected_length`
+    preallocates that capacity up front as one contiguous segment.
+    """
     def __init__(
         self, 
-        hidden_size,
-        element_dtype
+        num_units,
+        unit_size,
+        dim_head,
+        element_dtype,
+        expected_length: Optional[int] = None,
+        page_size: int = 1024,
     ):
-        init_cached_size = 16
-        self.data = torch.empty(
-            (init_cached_size, hidden_size),
-            dtype=element_dtype,
-            device='cuda'
-        )
+        self.num_units = num_units
+        self.unit_size = unit_size
+        self.dim_head = dim_head
+        self.dtype = element_dtype
+        self.page_size = page_size
         self.length = 0
-        self.cache_size = init_cached_size
-        self.hidden_size = hidden_size
+        self.cache_size = 0
+        # list of (start, segment); segments double in size up to page_size
+        self.segments = []
+
+        init_cached_size = _MIN_PAGE_SIZE
+        if expected_length is not None:
+            init_cached_size = max(
+                (expected_length + _MIN_PAGE_SIZE - 1) // _MIN_PAGE_SIZE * _MIN_PAGE_SIZE, _MIN_PAGE_SIZE
+            )
+        self.append_cache(init_cached_size)
+
+    def next_cache_size(self, cache_size: Optional[int] = None) -> int:
+        """
+        Size of the segment appended to a cache of `cache_size` rows, the current one by default.
+        """
+        cache_size = self.cache_size if cache_size is None else cache_size
+        return min(max(cache_size, _MIN_PAGE_SIZE), self.page_size)
+
+    def append_cache(self, size: Optional[int] = None):
+        size = self.next_cache_size() if size is None else size
+        self.segments.append((
+            self.cache_size,
+            torch.empty(
+                (self.num_units, self.unit_size, size, self.dim_head),
+                device='cuda',
+                dtype=self.dtype
+            )
+        ))
+        self.cache_size += size
 
-    def append_cache(self):
-        new_cache_size = self.cache_size * 2
-        data_shape = self.data.shape
-        new_data = torch.empty(
-            (new_cache_size,) + data_shape[1:],
-            device='cuda',
-            dtype=self.data.dtype
-        )
-        new_data[:self.cache_size,...].copy_(self.data)
-        self.data = new_data
-        self.cache_size = new_cache_size
+    def _used_segments(self):
+        for st, seg in self.segments:
+            if st >= self.length:
+                break
+            yield seg[:, :, :min(seg.size(2), self.length - st), :]
 
     def append(self, tensor: torch.Tensor):
-        assert tensor.dtype == self.data.dtype
-        assert tensor.size(1) == self.hidden_size
-        assert tensor.is_contiguous()
+        assert tensor.dtype == self.dtype
+        assert tensor.shape[:2] == (self.num_units, self.unit_size)
+        assert tensor.size(3) == self.dim_head
 
-        append_l = tensor.size(0)
+        append_l = tensor.size(2)
 
         while self.length + append_l > self.cache_size:
             self.append_cache()
 
-        self.data[self.length: self.length+append_l, ...].copy_(tensor)
-
-        self.length += append_l
+        ed = self.length + append_l
+        for st, seg in self.segments:
+            seg_ed = st + seg.size(2)
+            if seg_ed <= self.length:
+                continue
+            if st >= ed:
+                break
+            copy_st = max(st, self.length)
+            copy_ed = min(seg_ed, ed)
+            seg[:, :, copy_st - st: copy_ed - st, :].copy_(
+                tensor[:, :, copy_st - self.length: copy_ed - self.length, :]
+            )
 
+        self.length = ed
 
-    def get_data(self):
-        return self.data[:self.length, ...]
 
+    def get_logits(self, tensor: torch.Tensor):
+        """
+        tensor - (num_units, unit_size, len_q, dim_head)
 
-    def get_topk(self, tensor: torch.Tensor, topk): # inner product
-        assert tensor.dim() == 1 and tensor.size(0) == self.hidden_size
-        tensor = tensor.to(self.data.device)
-        logits = torch.matmul(self.data[:self.length], tensor[:, None]).squeeze(dim=-1)
-        assert logits.dim() == 1 and logits.size(0) == self.length
-        return logits.topk(topk, dim=0).indices.cpu().tolist()
+        Returns the (num_units, len_q, length) inner products with every block
+        representative, averaged over the unit's heads.
+        """
+        assert tensor.dim() == 4
+        assert tensor.shape[:2] == (self.num_units, self.unit_size)
+        assert tensor.size(3) == self.dim_head
+        tensor = tensor.to(self.dtype)
+        logits = torch.cat([
+            torch.matmul(tensor, seg.transpose(-1, -2)).mean(dim=1)
+            for seg in self._used_segments()
+        ], dim=-1)
+        assert logits.shape == (self.num_units, tensor.size(2), self.length)
+        return logits
 
     def __len__(self):
         return self.length
@@ -182,11 +238,18 @@ class Faiss:
     def get_data(self):
         raise ValueError
 
-    def get_topk(self, tensor: torch.Tensor, topk):
+    def get_topk(self, tensor: torch.Tensor, topk, score_scale: Optional[float] = None):
         assert tensor.dim() == 1 and tensor.size(0) == self.hidden_size
         xq = tensor[None, :].cpu().float().numpy().astype("float32")
-        topk_index = self.index.search(xq, topk)[1][0].tolist()
-        return topk_index
+        if score_scale is None:
+            topk_score, topk_index = self.index.search(xq, topk)
+            return topk_index[0].tolist()
+
+        # the mass is taken over all blocks, as without faiss; a flat index scores
+        # every block anyway, so searching them all only adds the sort
+        topk_score, topk_index = self.index.search(xq, self.index.ntotal)
+        values = torch.from_numpy(topk_score[0]).float() * score_scale
+        return topk_index[0][:topk].tolist(), values[:topk], values.logsumexp(dim=0)
 
     def __len__(self):
         return self.index.ntotal
@@ -195,6 +258,24 @@ class Faiss:
 GLOBAL_STREAM = None
 
 
+def _storage_bytes(tensors, seen):
+    """
+    Bytes of the storages behind `tensors`, each storage counted once across calls sharing `seen`.
+    Views are charged their whole storage, which is what they keep alive.
+    """
+    ret = 0
+    for t in tensors:
+        storage = t.untyped_storage() if hasattr(t, "untyped_storage") else t.storage()
+        if storage.data_ptr() in seen:
+            continue
+        seen.add(storage.data_ptr())
+        ret += storage.nbytes()
+    return ret
+
+
+_GPU_TIERS = ["gpu_cache", "local", "init", "remainder", "block_repr", "block_table"]
+
+
 class ContextManager:
     def __init__(self, 
                  position_embedding,
@@ -209,6 +290,15 @@ class ContextManager:
                  faiss: bool = False,
                  perhead: bool = False,
                  listeners: Optional[list[GlobalCacheListener]] = None,
+                 topk_min: Optional[int] = None,
+                 topk_mass: Optional[float] = None,
+                 expected_length: Optional[int] = None,
+                 static_decode: bool = False,
+                 local_score_horizon: Optional[int] = None,
+                 absolute_local_rope: bool = False,
+                 layer_idx: Optional[int] = None,
+                 deferred_block_load: bool = True,
+                 track_churn: bool = False,
     ):
 
         self.length = 0
@@ -221,7 +311,15 @@ class ContextManager:
         self.score_decay = score_decay
         assert exc_block_size <= n_local # no global token in input
         self.topk = topk
+        # adaptive top-k: `topk` is the maximum, `topk_min` the minimum number of
+        # retrieved blocks, and `topk_mass` the softmax mass the blocks must cover.
+        self.topk_mass = topk_mass
+        self.topk_min = topk_min if topk_min is not None else 1
+        if topk_mass is not None:
+            assert 0 < topk_mass <= 1
+            assert 1 <= self.topk_min <= topk
         self.Attn, _ = get_multi_stage_dot_production_attention(fattn)
+        self.workspace = get_workspace_pool()
         self.fattn = fattn
         self.initialized = False
         self.repr_topk = repr_topk
@@ -232,7 +330,35 @@ class ContextManager:
         self.pin_memory = pin_memory
         self.faiss = faiss
         self.perhead = perhead
+        self.expected_length = expected_length
+        self.static_decode = static_decode
+        # only local keys within `local_score_horizon` tokens of leaving the window get scores
+        self.local_score_horizon = local_score_horizon
+        # keep local keys rotated at their positions relative to a base that is
+        # moved forward every n_local tokens, instead of rotating the window per step
+        self.absolute_local_rope = absolute_local_rope
+        # decode steps select among resident blocks and load the missing ones of the
+        # full selection at the next step, so that they never wait for the device
+        self.deferred_block_load = deferred_block_load
+        # count the retrieval set churn in the cache stats, see CacheStats
+        self.track_churn = track_churn
+        # (event, k, num_blocks) of the selection copied to the host for the next step
+        self._deferred = None
+        # pinned (selection and slots, block scores) the deferred selection is copied into
+        self._deferred_host = None
+        # whether the last calc_block_topk only selected resident blocks
+        self._topk_resident = False
+        # position of the first token of memory unit 0 in the whole sequence
+        self._block_pos_base = 0
+        if local_score_horizon is not None:
+            assert local_score_horizon >= 0
         self._listeners: list[GlobalCacheListener] = listeners or []
+        # label of this layer in the stats, and the StageProfiler that times its stages, if any
+        self.layer_idx = layer_idx
+        self.profiler = None
+        # largest memory_usage values seen at the end of a step, tracked once a report asked for them
+        self.track_memory_peak = False
+        self._memory_peak = {}
 
         global GLOBAL_STREAM
         if self.async_global_stream and GLOBAL_STREAM is None:
@@ -252,23 +378,31 @@ class ContextManager:
         for cb in self._listeners:
             cb(event, **kw)
 
-    def remove_lru_blocks(self, u, num_remove: Optional[int] = None, ignore_blocks = None):
-        if num_remove is None:
-            num_remove = len(self.cached_blocks[u]) - self.max_cached_block
+    def _stage(self, name: str):
+        if self.profiler is None:
+            return nullcontext()
+
+        return self.profiler.stage(self.layer_idx, name, self.local_k.device)
 
+    def remove_lru_blocks(self, u, num_remove, ignore_blocks, block_score, slot_updates):
+        """
+        Offload the `num_remove` cached blocks of unit `u` with the lowest score,
+        skipping `ignore_blocks`. `block_score` is the host copy of the unit's
+        block scores; the (unit, block, -1) slot updates are appended to `slot_updates`.
+        """
         if num_remove <= 0:
             return
 
-        lst = list(self.cached_blocks[u].items())
-        lst.sort(key=lambda x: x[1])
+        lst = sorted(self.cached_blocks[u], key=lambda idx: block_score[idx])
 
         removed = 0
-        for i in range(len(lst)):
-            idx = lst[i][0]
-            if ignore_blocks is None or (idx not in ignore_blocks):
+        for idx in lst:
+            if idx not in ignore_blocks:
                 self.global_blocks[u][idx].offload()
-                self.cached_blocks[u].pop(idx)
+                self.cached_blocks[u].discard(idx)
+                slot_updates.append((u, idx, -1))
                 removed += 1
+                self.cache_stats.record_eviction(u)
                 self._emit(
                     'evict',
                     unit_id=u,
@@ -279,6 +413,158 @@ class ContextManager:
                 return
 
 
+    def load_blocks(self, block_topk):
+        """
+        Make the selected blocks resident in the cuda cache.
+
+        Hits are resolved on device through `block_slot`. Deferred decode selections
+        only hold resident blocks, and while every block is resident nothing is read
+        back either. Otherwise the selection and its slots are transferred once, and
+        the host loads the misses from CPU.
+        """
+        if block_topk.size(1) == 0:
+            return
+
+        if self._topk_resident or all(len(cached) == self.num_global_block for cached in self.cached_blocks):
+            self.cache_stats.record_retrieval(block_topk)
+            return
+
+        slots = self.block_slot.gather(1, block_topk)
+        host_topk, host_slots = torch.stack((block_topk, slots), dim=0).cpu()
+        loaded = self._load_missing(host_topk, host_slots)
+        self.cache_stats.record_retrieval(block_topk, loaded)
+
+
+    def _load_missing(self, host_topk, host_slots, block_score=None):
+        """
+        host_topk, host_slots - (num_units, k) host copies of a selection and its slots
+        block_score           - host copy of the block scores, read from device if None
+
+        Loads the selected blocks that are not resident, evicting the lowest scored
+        others. Returns the number of blocks loaded per unit.
+        """
+        slot_updates = []
+        loaded = [0] * self.num_units
+        for u in range(self.num_units):
+            topk_u = host_topk[u].tolist()
+            miss = [
+                b for b, slot in zip(topk_u, host_slots[u].tolist())
+                if slot < 0 and b not in self.cached_blocks[u]
+            ]
+            loaded[u] = len(miss)
+            if len(miss) == 0:
+                continue
+
+            num_remove = len(self.cached_blocks[u]) + len(miss) - self.max_cached_block
+            if num_remove > 0:
+                if block_score is None:
+                    block_score = self.block_score[:, :self.num_global_block].cpu()
+                self.remove_lru_blocks(u, num_remove, set(topk_u), block_score[u].tolist(), slot_updates)
+
+            for b_idx in miss:
+                self.global_blocks[u][b_idx].load()
+                self.cached_blocks[u].add(b_idx)
+                slot_updates.append((u, b_idx, self.global_blocks[u][b_idx].gpu_data_id))
+                block_start = self._block_pos_base + b_idx * self.block_size
+                self._emit(
+                    'load',
+                    unit_id=u,
+                    block_id=b_idx,
+                    block_start=block_start,
+                    block_end=block_start + self.block_size
+                )
+
+        self.update_block_slot(slot_updates)
+        return loaded
+
+
+    def _defer_block_load(self, len_q):
+        """
+        Whether this step selects among resident blocks only, deferring the loads of
+        its full selection to the next step. Only for decode steps with a fixed topk,
+        once every unit has at least topk resident blocks to select from.
+        """
+        return (
+            self.deferred_block_load and len_q == 1
+            and not self.faiss and self.topk_mass is None
+            and all(len(cached) >= self.topk for cached in self.cached_blocks)
+        )
+
+
+    def _deferred_block_topk(self, block_score):
+        """
+        block_score - (num_units, num_global_block) head-averaged block logits
+
+        Top-k among the resident blocks. The full top-k, its slots and the block scores
+        are copied to pinned host memory on the side, for load_deferred_blocks.
+        """
+        topk = min(self.topk, self.num_global_block)
+        num_blocks = self.num_global_block
+        block_topk = block_score.topk(topk, dim=-1).indices
+        slots = self.block_slot.gather(1, block_topk)
+
+        if self._deferred_host is None or self._deferred_host[1].size(1) < num_blocks:
+            self._deferred_host = (
+                torch.empty((2, self.num_units, self.topk), dtype=torch.int64, pin_memory=True),
+                torch.empty((self.num_units, max(2 * num_blocks, 64)), dtype=torch.float32, pin_memory=True),
+            )
+        host_selection, host_score = self._deferred_host
+        host_selection[:, :, :topk].copy_(torch.stack((block_topk, slots), dim=0), non_blocking=True)
+        host_score[:, :num_blocks].copy_(self.block_score[:, :num_blocks], non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self._deferred = (event, topk, num_blocks)
+
+        resident = self.block_slot[:, :num_blocks] >= 0
+        return block_score.masked_fill(~resident, float("-inf")).topk(topk, dim=-1).indices
+
+
+    def load_deferred_blocks(self):
+        """
+        Loads the missing blocks of the last deferred selection. Its copy was queued a
+        step earlier, so waiting for it does not stall on the current work.
+        """
+        if self._deferred is None:
+            return
+
+        event, topk, num_blocks = self._deferred
+        self._deferred = None
+        event.synchronize()
+        host_selection, host_score = self._deferred_host
+        host_topk, host_slots = host_selection[:, :, :topk]
+        if not bool((host_slots < 0).any()):
+            return
+
+        loaded = self._load_missing(host_topk, host_slots, host_score[:, :num_blocks])
+        self.cache_stats.record_loads(loaded)
+
+
+    def update_block_slot(self, slot_updates):
+        if len(slot_updates) == 0:
+            return
+
+        slot_updates = torch.tensor(slot_updates, dtype=torch.int64).to(self.block_slot.device, non_blocking=True)
+        self.block_slot[slot_updates[:, 0], slot_updates[:, 1]] = slot_updates[:, 2]
+
+
+    def append_block_table(self, slots, score):
+        """
+        Register a new global block with the given per-unit cuda cache slots (-1 if not resident).
+        """
+        idx = self.num_global_block
+        if idx >= self.block_slot.size(1):
+            new_capacity = self.block_slot.size(1) * 2
+            block_slot = torch.full((self.num_units, new_capacity), -1, dtype=torch.int64, device=self.block_slot.device)
+            block_slot[:, :idx].copy_(self.block_slot)
+            block_score = torch.zeros((self.num_units, new_capacity), dtype=torch.float32, device=self.block_score.device)
+            block_score[:, :idx].copy_(self.block_score)
+            self.block_slot = block_slot
+            self.block_score = block_score
+
+        self.block_slot[:, idx].copy_(torch.tensor(slots, dtype=torch.int64), non_blocking=True)
+        self.block_score[:, idx] = score
+
+
     def get_block_k(self, k, score):
         assert isinstance(score, torch.Tensor)
         assert k.dim() >= 2
@@ -329,20 +615,36 @@ class ContextManager:
         self.unit_size_kv = num_heads_kv
 
         self.global_blocks = [[] for _ in range(self.num_units)] # [[memory_unit]]
-        self.cached_blocks = [{} for _ in range(self.num_units)] # [[block_id: block_score]
+        self.cached_blocks = [set() for _ in range(self.num_units)] # [{block_id}] resident in cuda cache
         self.num_global_block = 0
 
+        # device-side block table
+        #   block_slot  - cuda cache slot of each block, -1 if not resident
+        #   block_score - lru / lru-s score of each resident block
+        block_capacity = 16
+        if self.expected_length is not None:
+            block_capacity = max(self.expected_length // self.block_size, block_capacity)
+        self.block_slot = torch.full((self.num_units, block_capacity), -1, dtype=torch.int64, device=global_k.device)
+        self.block_score = torch.zeros((self.num_units, block_capacity), dtype=torch.float32, device=global_k.device)
+
         if self.faiss:
             self.block_k = [Faiss(
                 dim_head * self.unit_size, global_k.dtype
             ) for _ in range(self.num_units)]
         else:
-            self.block_k = [VectorTensor(
-                dim_head * self.unit_size, global_k.dtype
-            ) for _ in range(self.num_units)]
+            expected_block_num = None
+            if self.expected_length is not None:
+                expected_block_num = self.expected_length // self.block_size
+
+            self.block_k = VectorTensor(
+                self.num_units, self.unit_size, dim_head, global_k.dtype, expected_block_num
+            )
 
         self.local_k = torch.empty((self.num_units, self.unit_size_kv, 0, dim_head), dtype=local_k.dtype, device=local_k.device)
         self.local_v = torch.empty((self.num_units, self.unit_size_kv, 0, dim_head), dtype=local_v.dtype, device=local_v.device)
+        if self.absolute_local_rope:
+            self.local_h_k = self.local_k
+            self.local_rope_base = 0
 
         self.global_remainder = (
             torch.empty((self.num_units, self.unit_size_kv, 0, dim_head), dtype=global_k.dtype, device=global_k.device),
@@ -356,45 +658,75 @@ class ContextManager:
         self.init_v = torch.empty((self.num_units, self.unit_size_kv, 0, dim_head), dtype=global_k.dtype, device=global_k.device)
         self.init_exc = False
         self.dtype = local_q.dtype
-        self.position_embedding._update_cos_sin_tables_len(
-            self.n_local + self.exc_block_size + 1, local_k.device, local_k.dim()
-        )
 
-        buffer_len = self.topk * self.block_size + self.exc_block_size + self.block_size + self.n_init
-        self.global_buffer = torch.zeros(
-                (2, self.num_units, self.unit_size_kv, buffer_len , dim_head),
-                dtype = global_k.dtype, device=global_k.device
-            )
-        self.global_buffer_block_id_list = [[-1] * self.topk for _ in range(self.num_units)]
-        self.global_buffer_init_st = 0
-        self.global_buffer_init_ed = 0
+        # selected blocks are read straight from the cuda cache, the global buffer only
+        # stages init tokens and the remainder; layers run one after another, so they
+        # all share one buffer
+        buffer_len = self.exc_block_size + self.block_size + self.n_init
+        self.global_buffer_shape = (2, self.num_units, self.unit_size_kv, buffer_len , dim_head)
+        if self.static_decode:
+            self._global_buffer_arange = torch.arange(buffer_len, device=global_k.device)
+            self._block_arange = torch.arange(self.topk * self.block_size, device=global_k.device)
+            # the tables of `rotate`, so that both decode paths rotate alike
+            cos, sin = self.position_embedding._get_rotary_tables(self.n_local, local_k.device)
+            self._static_cos = torch.cat((cos, cos), dim=-1)[:self.n_local]
+            self._static_sin = torch.cat((sin, sin), dim=-1)[:self.n_local]
         self.cuda_cache = CudaCache(
             self.max_cached_block * self.num_units,
             self.unit_size_kv * self.block_size * dim_head * 2,
             local_k.dtype
         )
+        self.cache_stats = CacheStats(
+            self.num_units,
+            self.unit_size_kv * self.block_size * dim_head * 2 * local_k.element_size(),
+            self.track_churn
+        )
 
         self.initialized = True
     
 
+    def _min_block_topk(self):
+        return self.topk if self.topk_mass is None else self.topk_min
+
+
+    def adaptive_block_num(self, topk_logits, logits_lse):
+        """
+        topk_logits - (..., k) scaled block logits in descending order
+        logits_lse  - (...) log-sum-exp of the scaled logits over all blocks
+
+        Returns the number of blocks needed to cover `topk_mass` of the softmax
+        mass, clamped to [topk_min, k].
+        """
+        mass = torch.exp(topk_logits.float() - logits_lse.float()[..., None]).cumsum(dim=-1)
+        num = (mass < self.topk_mass).sum(dim=-1) + 1
+        return num.clamp(min=self.topk_min, max=topk_logits.size(-1))
+
+
     def calc_block_topk(
         self, global_h_q
     ):
+        self._topk_resident = False
         if not self._use_chunk_topk:
-            if self.num_global_block <= self.topk:
-                return [list(range(len(self.global_blocks[0]))) for _ in range(self.num_units)]
+            if self.num_global_block <= self._min_block_topk():
+                return self._all_blocks()
 
-            global_h_q = global_h_q.mean(dim=2, keepdim=False)
-            assert global_h_q.shape == (self.num_units, self.unit_size, self.dim_head)
-            global_h_q = global_h_q.reshape(self.num_units, self.dim_head * self.unit_size)
-            ret = []
-            for u in range(self.num_units):
-                ret.append(self.block_k[u].get_topk(global_h_q[u], self.topk))
-                self._emit(
-                    'topk',
-                    unit_id=u,
-                    ret=ret[-1]
-                )
+            len_q = global_h_q.size(2)
+
+            if self.faiss:
+                ret = self._calc_block_topk_faiss(global_h_q)
+                ret = torch.tensor(ret, dtype=torch.int64).to(self.block_slot.device, non_blocking=True)
+            else:
+                global_h_q = global_h_q.mean(dim=2, keepdim=True)
+                assert global_h_q.shape == (self.num_units, self.unit_size, 1, self.dim_head)
+                block_score = self.block_k.get_logits(global_h_q).squeeze(dim=1)
+                assert block_score.shape == (self.num_units, self.num_global_block)
+                if self._defer_block_load(len_q):
+                    ret = self._deferred_block_topk(block_score)
+                    self._topk_resident = True
+                else:
+                    ret = self._block_score_topk(block_score, None)[0]
+
+            self._emit_topk(ret)
 
         else:
             return self._cached_topk[self._topk_cur]
@@ -402,190 +734,367 @@ class ContextManager:
         return ret
 
 
+    def _emit_topk(self, block_topk):
+        """
+        One 'topk' event per unit with the flat list of its selected blocks.
+        Only reads the (num_units, k) selection back when someone listens.
+        """
+        if len(self._listeners) == 0:
+            return
+
+        for u, topk_u in enumerate(block_topk.tolist()):
+            self._emit(
+                'topk',
+                unit_id=u,
+                ret=topk_u
+            )
+
+
+    def _all_blocks(self):
+        return torch.arange(
+            self.num_global_block, dtype=torch.int64, device=self.block_slot.device
+        )[None, :].repeat(self.num_units, 1)
+
+
+    def _calc_block_topk_faiss(self, global_h_q):
+        global_h_q = global_h_q.mean(dim=2, keepdim=False)
+        assert global_h_q.shape == (self.num_units, self.unit_size, self.dim_head)
+        global_h_q = global_h_q.reshape(self.num_units, self.dim_head * self.unit_size)
+        ret = []
+        if self.topk_mass is None:
+            for u in range(self.num_units):
+                ret.append(self.block_k[u].get_topk(global_h_q[u], self.topk))
+        else:
+            # mean over heads of the scaled dot product, as in attention
+            score_scale = 1 / (self.unit_size * self.dim_head ** 0.5)
+            topk = min(self.topk, self.num_global_block)
+            topk_logits, logits_lse = [], []
+            for u in range(self.num_units):
+                indices, values, lse = self.block_k[u].get_topk(global_h_q[u], topk, score_scale)
+                ret.append(indices)
+                topk_logits.append(values.cpu())
+                logits_lse.append(lse.cpu())
+
+            # all units load the same number of blocks
+            block_num = int(self.adaptive_block_num(
+                torch.stack(topk_logits), torch.stack(logits_lse)
+            ).max())
+            ret = [indices[:block_num] for indices in ret]
+
+        return ret
+
+
+    def _block_score_topk(self, block_score, exc_block_num):
+        """
+        block_score   - (num_units, [exc_block_num,] num_global_block) head-averaged block logits
+        exc_block_num - None if block_score has no execution block dimension
+
+        Returns a list over execution blocks of (num_units, block_num) device tensors
+        of the selected block ids. Only adaptive top-k reads anything back to the host.
+        """
+        topk = min(self.topk, self.num_global_block)
+        score_scale = 1 / (self.dim_head ** 0.5)
+        if exc_block_num is None:
+            block_score = block_score[:, None, :]
+
+        block_topk = block_score.topk(topk, dim=-1)
+        block_num = self._batched_block_num(block_topk.values, block_score, score_scale)
+        ret = []
+        for b in range(block_score.size(1)):
+            ret.append(block_topk.indices[:, b, :block_num[b]])
+
+        return ret
+
+
     def get_global_hidden_and_mask(
         self, len_q, block_topk
     ):
-        assert len(block_topk) == self.num_units
-        global_block_map = [[] for _ in range(self.num_units)]
+        """
+        Returns the cuda cache slots of the selected blocks with their sliding window,
+        and the init tokens and remainder staged in the global buffer with theirs.
+        Blocks come first in key order, then init tokens, then the remainder.
+        """
+        assert block_topk.dim() == 2 and block_topk.size(0) == self.num_units
         global_remainder_len = max(self._global_remainder_ed - self._global_remainder_st + len_q - self.n_local, 0)
         init_len = self.init_k.size(-2)
-        sliding_window = None
-
-        global_h_k = self.global_buffer[0]
-        global_h_v = self.global_buffer[1]
 
-        block_num = len(block_topk[0])
-        for u in range(self.num_units):
-            assert len(block_topk[u]) == block_num
-
-            block_topk[u].sort()
-            global_block_map[u] = deepcopy(self.global_buffer_block_id_list[u])
-            for b_idx in block_topk[u]:
-                if b_idx in global_block_map[u]:
-                    continue
-
-                st = -1
-                ed = -1
-                for j in range(self.topk):
-                    if global_block_map[u][j] == -1 or global_block_map[u][j] not in block_topk[u]:
-                        st = j * self.block_size
-                        ed = st + self.block_size
-                        global_block_map[u][j] = b_idx
-                        break
-
-                
-                assert b_idx in self.cached_blocks[u]
-                self.global_blocks[u][b_idx].load((global_h_k[u, :, st:ed, :], global_h_v[u, :, st:ed, :]))
-                self._emit(
-                    'load',
-                    unit_id=u,
-                    block_id=b_idx,
-                    block_start=st,
-                    block_end=ed
-                )
+        global_buffer = self.get_global_buffer()
+        global_h_k = global_buffer[0]
+        global_h_v = global_buffer[1]
 
-             
-        init_st = block_num * self.block_size
-        init_ed = init_st + init_len
-        if self.global_buffer_init_st != init_st or self.global_buffer_init_ed != init_ed:
-            global_h_k[:, :, init_st: init_ed, :].copy_(self.init_k, non_blocking=True)
-            global_h_v[:, :, init_st: init_ed, :].copy_(self.init_v, non_blocking=True)
+        block_num = block_topk.size(1)
+        block_slots = self.block_slot.gather(1, block_topk)
 
-        ed = init_ed
+        # every layer writes its own init tokens into the shared buffer
+        global_h_k[:, :, :init_len, :].copy_(self.init_k, non_blocking=True)
+        global_h_v[:, :, :init_len, :].copy_(self.init_v, non_blocking=True)
 
-        rmd_st = init_ed
+        rmd_st = init_len
         rmd_ed = rmd_st + global_remainder_len
-        ed = rmd_ed
         global_h_k[:, :, rmd_st: rmd_ed, :].copy_(self.global_remainder[0][:, :, self._global_remainder_st:self._global_remainder_st+global_remainder_len, :], non_blocking=True)
         global_h_v[:, :, rmd_st: rmd_ed, :].copy_(self.global_remainder[1][:, :, self._global_remainder_st:self._global_remainder_st+global_remainder_len, :], non_blocking=True)
 
-
         sliding_window = (self.global_remainder[0].size(-2) + rmd_st, self.n_local)
+        block_sliding_window = (sliding_window[0] + block_num * self.block_size, self.n_local)
 
-        self.global_buffer_block_id_list = deepcopy(global_block_map)
-        self.global_buffer_init_st = init_st
-        self.global_buffer_init_ed = init_ed
+        global_h_k = global_h_k[:, :, :rmd_ed, :]
+        global_h_v = global_h_v[:, :, :rmd_ed, :]
+        return block_slots, block_sliding_window, global_h_k, global_h_v, sliding_window, block_topk, block_num
 
-        for u in range(self.num_units):
-            assert max(global_block_map[u][block_num:] + [-1]) == -1
-            assert min(global_block_map[u][:block_num] + [0]) > -1
-            global_block_map[u] = list(global_block_map[u][:block_num])
 
+    def get_cache_kv(self):
+        """
+        (num_slots, num_heads_kv, block_size, dim_head) k and v views of the cuda cache.
+        """
+        cache_kv = self.cuda_cache.data.view(
+            self.cuda_cache.num_units, 2, self.unit_size_kv, self.block_size, self.dim_head
+        )
+        return cache_kv[:, 0], cache_kv[:, 1]
 
-        global_h_k = global_h_k[:, :, :ed, :]
-        global_h_v = global_h_v[:, :, :ed, :]
-        return global_h_k, global_h_v, sliding_window, global_block_map, block_num
+
+    def get_global_buffer(self):
+        return self.workspace.get(
+            "global_buffer", self.global_buffer_shape, self.init_k.dtype, self.init_k.device
+        )
 
 
     def update_block_score(
         self, global_score: torch.FloatTensor, global_block_map, global_block_num
     ):
-        if global_score is not None:
+        if global_score is not None and global_block_num > 0:
             global_score = global_score[:, :, :global_block_num * self.block_size]
             assert global_score.shape == (self.num_units, self.unit_size, global_block_num * self.block_size)
             global_score = global_score.view(self.num_units, self.unit_size, global_block_num, self.block_size)
             global_score = global_score.sum(dim=-1).sum(dim=1)
             assert global_score.shape == (self.num_units, global_block_num)
-            global_score = global_score.to(device='cpu', non_blocking=False) # (num_units, global_block_num)
-            for u in range(self.num_units):
-                for k, v in self.cached_blocks[u].items():
-                    self.cached_blocks[u][k] = v * self.score_decay
-                score = global_score[u].tolist()
-                assert len(score) >= len(global_block_map[u])
-                for s, i in zip(score, global_block_map[u]):
-                    self.cached_blocks[u][i] += s
+            self.block_score.mul_(self.score_decay)
+            self.block_score.scatter_add_(1, global_block_map, global_score.float())
 
 
-    
-    def _append(
-        self,
-        local_q, local_k, local_v, global_q
-    ):
-
-        # get local_h_q, local_h_k, local_h_v
-        local_h_q, local_h_k = self.position_embedding(local_q, local_k)
-        local_h_v = local_v
-
 
-        # calc local result first to overlap host-device communication
-        attn = self.Attn(local_h_q.shape, local_h_q.dtype, local_h_q.device)
-        attn.append(
-            local_h_q, local_h_k, local_h_v, 
-            get_score=True, sliding_window=self.n_local
-        )
-
-        # calc topk global repr k and load cache
+    def load_global(self, global_q, len_q):
         with torch.cuda.stream(GLOBAL_STREAM):
-            block_topk = self.calc_block_topk(global_q)
-            
-            for u in range(self.num_units):
-                num_remove = len(self.cached_blocks[u]) - self.max_cached_block
-                for bidx in block_topk[u]:
-                    if bidx not in self.cached_blocks[u]:
-                        num_remove += 1
+            with self._stage("load_blocks"):
+                self.load_deferred_blocks()
+
+            with self._stage("topk"):
+                block_topk = self.calc_block_topk(global_q)
 
-                # update cache
-                self.remove_lru_blocks(u, num_remove, block_topk[u])
+            # update cache
+            with self._stage("load_blocks"):
+                self.load_blocks(block_topk)
 
             if self.cache_strategy == "lru":
                 self.load_count += 1
-                for u in range(self.num_units):
-                    for bidx in block_topk[u]:
-                        self.cached_blocks[u][bidx] = self.load_count
+                self.block_score.scatter_(1, block_topk, float(self.load_count))
 
             elif self.cache_strategy == "lru-s":
-                for u in range(self.num_units):
-                    for bidx in block_topk[u]:
-                        self.cached_blocks[u][bidx] = 0
+                self.block_score.scatter_(1, block_topk, 0.)
             else:
                 raise ValueError
 
             # get global_h_k, global_h_v, global_mask
             #    Beacuse exc_block_size <= n_local, no global_k, global_v used in global part
-            global_h_q = global_q
-            global_h_k, global_h_v, global_sliding_window, global_block_map, global_block_num = self.get_global_hidden_and_mask(local_h_q.size(-2), block_topk)
+            return self.get_global_hidden_and_mask(len_q, block_topk)
+
+
+    def _static_decode_append(
+        self,
+        local_q, local_k, local_v, global_q
+    ):
+        """
+        Decode step with a full local window, computed on the whole global buffer
+        with a validity mask instead of variable slices, so that the attention
+        compiles into one static graph.
+
+        The oldest of the n_local + 1 local keys is outside the sliding window;
+        the remaining n_local keys are rotated with positions 0..n_local-1.
+        """
+        (
+            block_slots, block_sliding_window,
+            global_h_k, _, global_sliding_window,
+            global_block_map, global_block_num
+        ) = self.load_global(global_q, 1)
+
+        # the only keys that vary are how many blocks are selected and where
+        # the valid prefix of the buffer ends; blocks are padded to topk
+        static_slots = torch.zeros((self.num_units, self.topk), dtype=block_slots.dtype, device=block_slots.device)
+        static_slots[:, :global_block_num] = block_slots
+        block_valid_len = min(global_block_num * self.block_size, block_sliding_window[0] - block_sliding_window[1] + 1)
+        block_mask = self._block_arange < block_valid_len
+        valid_len = min(global_h_k.size(-2), global_sliding_window[0] - global_sliding_window[1] + 1)
+        global_mask = self._global_buffer_arange < valid_len
+        global_buffer = self.get_global_buffer()
+        cache_k, cache_v = self.get_cache_kv()
 
         if self.async_global_stream:
             torch.cuda.current_stream().wait_stream(GLOBAL_STREAM)
 
-        # calc global result
-        attn.append(
-            global_h_q, global_h_k, global_h_v, 
-            end=True, get_score=self.calc_block_score, 
-            sliding_window=global_sliding_window,
-            complement_sliding_window=True
-        )
+        with self._stage("static_decode"):
+            o, loc_score, glb_score = get_static_decode_attention()(
+                local_q, local_k[:, :, 1:, :], local_v[:, :, 1:, :],
+                self._static_cos, self._static_sin,
+                global_q, cache_k, cache_v, static_slots, block_mask,
+                global_buffer[0], global_buffer[1], global_mask
+            )
+
+        if self.async_global_stream:
+            GLOBAL_STREAM.wait_stream(torch.cuda.current_stream())
+
+        # update global score
+        with torch.cuda.stream(GLOBAL_STREAM):
+            if self.calc_block_score:
+                self.update_block_score(glb_score, global_block_map, global_block_num)
+
+        loc_score = torch.nn.functional.pad(loc_score, (1, 0))
+        return o.view((self.batch_size, self.num_heads, -1, self.dim_head)), loc_score
+
+
+    def _use_static_decode(self, len_q, len_k):
+        return self.static_decode and len_q == 1 and len_k == self.n_local + 1
+
+
+    def _append(
+        self,
+        local_q, local_k, local_v, global_q,
+        local_h_q=None, local_h_k=None
+    ):
+        if self._use_static_decode(local_q.size(-2), local_k.size(-2)):
+            return self._static_decode_append(local_q, local_k, local_v, global_q)
+
+        # get local_h_q, local_h_k, local_h_v
+        if local_h_q is None:
+            with self._stage("rope"):
+                local_h_q, local_h_k = self.position_embedding(local_q, local_k)
+        local_h_v = local_v
+
+
+        # calc local result first to overlap host-device communication
+        attn = self.Attn(local_h_q.shape, local_h_q.dtype, local_h_q.device, self.workspace)
+        len_q, len_k = local_h_q.size(-2), local_h_k.size(-2)
+        score_len = self.local_score_len(len_q, len_k)
+        with self._stage("local_attention"):
+            if score_len < len_k:
+                # the scores only matter for keys that are cut into blocks soon,
+                # so the local window is split into a scored and an unscored stage
+                attn.append(
+                    local_h_q, local_h_k[:, :, :score_len, :], local_h_v[:, :, :score_len, :],
+                    get_score=True, sliding_window=(len_k - len_q, self.n_local)
+                )
+                attn.append(
+                    local_h_q, local_h_k[:, :, score_len:, :], local_h_v[:, :, score_len:, :],
+                    get_score=False, sliding_window=(len_k - len_q - score_len, self.n_local)
+                )
+            else:
+                attn.append(
+                    local_h_q, local_h_k, local_h_v,
+                    get_score=True, sliding_window=self.n_local
+                )
+
+        # calc topk global repr k and load cache
+        global_h_q = global_q
+        (
+            block_slots, block_sliding_window,
+            global_h_k, global_h_v, global_sliding_window,
+            global_block_map, global_block_num
+        ) = self.load_global(global_q, local_h_q.size(-2))
+
+        if self.async_global_stream:
+            torch.cuda.current_stream().wait_stream(GLOBAL_STREAM)
+
+        # calc global result, the selected blocks straight from their cuda cache slots
+        num_local_stage = 2 if score_len < len_k else 1
+        with self._stage("global_attention"):
+            if global_block_num > 0:
+                cache_k, cache_v = self.get_cache_kv()
+                attn.append_paged(
+                    global_h_q, cache_k, cache_v, block_slots,
+                    get_score=self.calc_block_score,
+                    sliding_window=block_sliding_window,
+                    complement_sliding_window=True
+                )
+
+            attn.append(
+                global_h_q, global_h_k, global_h_v,
+                end=True, get_score=False,
+                sliding_window=global_sliding_window,
+                complement_sliding_window=True
+            )
 
         o, score_list = attn.get_result()
         loc_score = score_list[0]
-        glb_score = score_list[1]
+        glb_score = score_list[num_local_stage] if global_block_num > 0 else None
+        if score_len < len_k:
+            loc_score = torch.nn.functional.pad(loc_score, (0, len_k - score_len))
 
         if self.async_global_stream:
             GLOBAL_STREAM.wait_stream(torch.cuda.current_stream())
 
         # update global score
         with torch.cuda.stream(GLOBAL_STREAM):
-            self.update_block_score(glb_score, global_block_map, global_block_num)
+            with self._stage("score_update"):
+                self.update_block_score(glb_score, global_block_map, global_block_num)
 
 
         return o.view((self.batch_size, self.num_heads, -1, self.dim_head)), loc_score
 
 
+    def rotate_local(self, local_q, q_pos, kv_st, kv_ed):
+        """
+        Rotated queries (at absolute position q_pos onwards) and rotated local keys
+        kv_st..kv_ed, rotating only the keys that were not rotated yet.
+
+        Positions are relative to local_rope_base, which moves up to the first key
+        in use once they would exceed 2 * n_local + exc_block_size. Keys before it
+        keep their old rotation, they are never used again.
+        """
+        # the queries are the last keys of the slice, so local_k[:, :, 0] is at
+        first_pos = q_pos + local_q.size(-2) - kv_ed
+        if first_pos + kv_ed - self.local_rope_base > 2 * self.n_local + self.exc_block_size:
+            self.local_rope_base = first_pos + kv_st
+            h_len = self.local_h_k.size(-2)
+            self.local_h_k = torch.cat((
+                # keys before kv_st are never used again, static decode steps may have left them unrotated
+                self.local_h_k[:, :, :kv_st, :] if h_len >= kv_st else self.local_k[:, :, :kv_st, :],
+                self.position_embedding.apply_rotary_pos_emb_range(
+                    self.local_k[:, :, kv_st:max(h_len, kv_st), :], 0
+                )
+            ), dim=-2)
+
+        h_len = self.local_h_k.size(-2)
+        if h_len < kv_ed:
+            self.local_h_k = torch.cat((
+                self.local_h_k,
+                self.position_embedding.apply_rotary_pos_emb_range(
+                    self.local_k[:, :, h_len:kv_ed, :], first_pos + h_len - self.local_rope_base
+                )
+            ), dim=-2)
+
+        local_h_q = self.position_embedding.apply_rotary_pos_emb_range(local_q, q_pos - self.local_rope_base)
+        return local_h_q, self.local_h_k[:, :, kv_st:kv_ed, :]
+
+
+    def local_score_len(self, len_q, len_k):
+        """
+        Number of oldest local keys whose scores are computed. A key j is visible
+        to the last query while len_k - 1 - j < n_local, so the keys within the
+        horizon of leaving the window are those with len_k - 1 - j >= n_local - horizon.
+        """
+        if self.local_score_horizon is None:
+            return len_k
+
+        return min(max(len_k - self.n_local + self.local_score_horizon, 0), len_k)
+
+
     def get_batched_topk(self, global_q):
         length = global_q.shape[2]
         exc_num = (length + self.exc_block_size - 1) // self.exc_block_size
         exc_block_num = length // self.exc_block_size
         ret = []
-        if self.num_global_block <= self.topk:
+        if self.num_global_block <= self._min_block_topk():
             for _ in range(exc_num):
-                ret.append(
-                    [list(range(len(self.global_blocks[0]))) for _ in range(self.num_units)]
-                )
-                self._emit(
-                    'topk',
-                    unit_id=0,
-                    ret=ret[-1]
-                )
+                ret.append(self._all_blocks())
+                self._emit_topk(ret[-1])
             return ret
 
 
@@ -593,59 +1102,46 @@ class ContextManager:
         assert global_h_q.dim() == 4
         assert global_h_q.shape[:2] == (self.num_units, self.unit_size)
         assert global_h_q.shape[3] == self.dim_head
-
-
-
-        block_k = torch.cat([self.block_k[u].get_data()[None, :, :] for u in range(self.num_units)], dim=0)
-        assert block_k.shape == (self.num_units, self.num_global_block, self.dim_head * self.unit_size)
-        block_k = block_k.reshape(self.num_units, self.num_global_block, self.unit_size, self.dim_head).permute(0, 2, 1, 3).contiguous()
-
+        assert not self.faiss
 
         if exc_block_num > 0:
             tmp_global_h_q = global_h_q[:, :, :exc_block_num * self.exc_block_size, :].reshape(
                 self.num_units, self.unit_size, exc_block_num, self.exc_block_size, self.dim_head
             ).mean(dim=-2)
             assert tmp_global_h_q.shape == (self.num_units, self.unit_size, exc_block_num, self.dim_head)
-            block_score = torch.matmul(
-                tmp_global_h_q, block_k.transpose(-1, -2)
-            ).mean(dim=1) # (num_units, exc_block_num, num_global_block)
+            block_score = self.block_k.get_logits(tmp_global_h_q) # (num_units, exc_block_num, num_global_block)
             assert block_score.shape == (self.num_units, exc_block_num, self.num_global_block)
-
-            indices = block_score.topk(self.topk, dim=-1).indices.cpu()
-            for b in range(exc_block_num):
-                tmp = []
-                for u in range(self.num_units):
-                    tmp.append(indices[u, b].tolist())
-                    assert len(tmp[-1]) == self.topk
-                
-                ret.append(tmp)
+            ret.extend(self._block_score_topk(block_score, exc_block_num))
 
         if exc_block_num != exc_num: 
             tmp_global_h_q = global_h_q[:, :, exc_block_num * self.exc_block_size:, :].reshape(
                 self.num_units, self.unit_size, length - exc_block_num * self.exc_block_size, self.dim_head
             ).mean(dim=-2, keepdim=True)
             assert tmp_global_h_q.shape == (self.num_units, self.unit_size, 1, self.dim_head)
-            block_score = torch.matmul(
-                tmp_global_h_q, block_k.transpose(-1, -2)
-            )
-            assert block_score.shape == (self.num_units, self.unit_size, 1, self.num_global_block)
-            block_score = block_score.squeeze(dim=2).mean(dim=1)
+            block_score = self.block_k.get_logits(tmp_global_h_q).squeeze(dim=1)
             assert block_score.shape == (self.num_units, self.num_global_block)
-            indices = block_score.topk(self.topk, dim=-1).indices.cpu()
-            tmp = []
-            for u in range(self.num_units):
-                tmp.append(indices[u].tolist())
-                assert len(tmp[-1]) == self.topk
-
-            ret.append(tmp)
+            ret.extend(self._block_score_topk(block_score, None))
 
-        self._emit(
-            'topk',
-            unit_id=0,
-            ret=ret[-1]
-        )
+        self._emit_topk(ret[-1])
         return ret
 
+    def _batched_block_num(self, topk_values, block_score, score_scale):
+        """
+        topk_values - (num_units, exc_block_num, k) scaled top-k block logits
+
+        Number of blocks to load for each execution block, i.e. `topk` or, in
+        adaptive mode, the maximum over units of `adaptive_block_num`.
+        """
+        if self.topk_mass is None:
+            return [topk_values.size(-1)] * topk_values.size(1)
+
+        block_num = self.adaptive_block_num(
+            topk_values.float() * score_scale,
+            (block_score.float() * score_scale).logsumexp(dim=-1)
+        ).max(dim=0).values
+        return block_num.cpu().tolist()
+
+
     def append_global(
         self, exc_length, kv_length, local_score
     ):
@@ -683,6 +1179,8 @@ class ContextManager:
 
         while global_remainder_len - self.block_size >= self.n_local:
             global_remainder_len -= self.block_size
+            if self.num_global_block == 0:
+                self._block_pos_base = self._global_remainder_pos + global_remainder_st
             for u in range(self.num_units):
                 self.global_blocks[u].append((
                     MemoryUnit(
@@ -696,29 +1194,38 @@ class ContextManager:
                     )
                 ))
 
+            self.append_block_table(
+                [-1] * self.num_units, float(self.load_count) if self.cache_strategy == "lru" else 0.
+            )
+
             global_block_k = self.get_block_k(
                 self.global_remainder[0][:, :, global_remainder_st:global_remainder_st + self.block_size, :],
                 self.global_remainder_local_score[:, :, global_remainder_st:global_remainder_st + self.block_size]
             )
             assert global_block_k.shape == (self.num_units, self.unit_size, self.repr_topk, self.dim_head)
-            global_block_k = global_block_k.mean(dim=-2, keepdim=False)
-            global_block_k = global_block_k.reshape(self.num_units, self.unit_size * self.dim_head)
-            global_block_k = global_block_k[:, None, :]
+            global_block_k = global_block_k.mean(dim=-2, keepdim=True)
 
             self.num_global_block += 1
-            for u in range(self.num_units):
-                self.block_k[u].append(global_block_k[u])
-                # get the indexs in k/v that are used in the block
-                block_start = global_remainder_st
-                block_end = global_remainder_st + self.block_size
+            self.cache_stats.record_add()
+            if self.faiss:
+                global_block_k = global_block_k.reshape(self.num_units, 1, self.unit_size * self.dim_head)
+                for u in range(self.num_units):
+                    self.block_k[u].append(global_block_k[u])
+            else:
+                self.block_k.append(global_block_k)
 
-                self._emit(
-                    'add',
-                    unit_id=u,
-                    block_id=self.num_global_block,
-                    block_start=block_start,
-                    block_end=block_end
-                )
+            if len(self._listeners) > 0:
+                # token positions of the block in the whole sequence
+                block_start = self._global_remainder_pos + global_remainder_st
+                block_end = block_start + self.block_size
+                for u in range(self.num_units):
+                    self._emit(
+                        'add',
+                        unit_id=u,
+                        block_id=self.num_global_block - 1,
+                        block_start=block_start,
+                        block_end=block_end
+                    )
             global_remainder_st += self.block_size
 
         self._global_remainder_ed = global_remainder_ed
@@ -770,6 +1277,8 @@ class ContextManager:
         with torch.cuda.stream(GLOBAL_STREAM):
             self._global_remainder_st = 0
             self._global_remainder_ed = self.global_remainder[0].size(-2)
+            # position of global_remainder[..., 0, :] in the whole sequence
+            self._global_remainder_pos = self.length - self._global_remainder_ed
 
             self.global_remainder = (
                 torch.cat((self.global_remainder[0], global_k), dim=-2),
@@ -788,9 +1297,10 @@ class ContextManager:
 
 
         with torch.cuda.stream(GLOBAL_STREAM):
-            global_q = self.position_embedding.apply_rotary_pos_emb_one_angle(
-                global_q, self.n_local
-            )
+            with self._stage("rope"):
+                global_q = self.position_embedding.apply_rotary_pos_emb_one_angle(
+                    global_q, self.n_local
+                )
 
         use_chunk_topk = self.chunk_topk_calc is not None and input_length > 1
         self._use_chunk_topk = use_chunk_topk
@@ -803,7 +1313,11 @@ class ContextManager:
             self._topk_cur = 0
             self._topk_calc_cur = -1
 
-        o_list = []
+        # attention results live in the shared workspace, copy them out chunk by chunk
+        ret = torch.empty(
+            (self.batch_size, self.num_heads, input_length, self.dim_head),
+            dtype=local_q.dtype, device=local_q.device
+        )
 
         for st in range(0, input_length, self.exc_block_size): 
             ed = min(st + self.exc_block_size, input_length)
@@ -817,18 +1331,26 @@ class ContextManager:
 
             kv_st = max(kv_length + st - input_length - self.n_local, 0)
             kv_ed = kv_length + ed - input_length
+            # the static decode step rotates its own window, the skipped keys are rotated on the next use
+            if self.absolute_local_rope and not self._use_static_decode(ed - st, kv_ed - kv_st):
+                with self._stage("rope"):
+                    rotated = self.rotate_local(local_q[:, :, st:ed, :], self.length + st, kv_st, kv_ed)
+            else:
+                rotated = None, None
             chunk_o, local_score = self._append(
                 local_q[:, :, st:ed, :],
                 self.local_k[:, :, kv_st: kv_ed, :],
                 self.local_v[:, :, kv_st: kv_ed, :],
-                global_q[:, :, st:ed, :]
+                global_q[:, :, st:ed, :],
+                *rotated
             )
-            o_list.append(chunk_o)
+            ret[:, :, st:ed, :].copy_(chunk_o)
 
 
             # append global
             with torch.cuda.stream(GLOBAL_STREAM):
-                self.append_global(ed - st, kv_ed - kv_st, local_score)
+                with self._stage("append_global"):
+                    self.append_global(ed - st, kv_ed - kv_st, local_score)
 
             if self.async_global_stream:
                 torch.cuda.current_stream().wait_stream(GLOBAL_STREAM)
@@ -840,8 +1362,12 @@ class ContextManager:
 
         # update local and global tensor
         if self.local_k.size(-2) >= self.n_local:
-            self.local_k = self.local_k[:, :, -self.n_local:, :]
-            self.local_v = self.local_v[:, :, -self.n_local:, :]
+            num_drop = self.local_k.size(-2) - self.n_local
+            self.local_k = self.local_k[:, :, num_drop:, :]
+            self.local_v = self.local_v[:, :, num_drop:, :]
+            if self.absolute_local_rope:
+                # rotated keys are aligned with local_k, but may end before it
+                self.local_h_k = self.local_h_k[:, :, num_drop:, :]
 
         assert self._global_remainder_ed == self.global_remainder[0].size(-2)
         with torch.cuda.stream(GLOBAL_STREAM):
@@ -851,7 +1377,9 @@ class ContextManager:
             )
             self.global_remainder_local_score = self.global_remainder_local_score[:, :, self._global_remainder_st:]
 
-        ret = torch.cat(o_list, dim=-2)
+        if self.track_memory_peak:
+            for key, value in self.memory_usage().items():
+                self._memory_peak[key] = max(self._memory_peak.get(key, 0), value)
 
         if self.perhead:
             ret = ret.view(batch_size, num_heads, input_length, -1)
@@ -859,4 +1387,112 @@ class ContextManager:
         return ret
 
     def size(self, *args, **kwargs):
-        return self.length
\ No newline at end of file
+        return self.length
+
+    def memory_usage(self) -> dict:
+        """
+        Bytes held by this layer per tier, computed from the live structures.
+
+        gpu_cache      - the preallocated cuda cache of memory units, gpu_cache_used its occupied slots
+        local          - the local window (and its rotated keys with absolute_local_rope)
+        init           - the initial tokens
+        remainder      - tokens not yet cut into memory units, with their scores
+        block_repr     - memory unit representatives
+        block_table    - device-side slots and scores of the memory units
+        host           - MemoryUnit.cpu_data of all memory units (and the faiss index)
+        gpu_total, host_total - sums over the device and host tiers
+        """
+        if not self.initialized:
+            return {}
+
+        seen = set()
+        local = [self.local_k, self.local_v]
+        if self.absolute_local_rope:
+            local.append(self.local_h_k)
+
+        host = self.num_global_block * self.num_units * self.cache_stats.block_bytes
+        if self.faiss:
+            block_repr = 0
+            host += sum(index.index.ntotal * index.hidden_size * 4 for index in self.block_k)
+        else:
+            block_repr = _storage_bytes([seg for _, seg in self.block_k.segments], seen)
+
+        ret = {
+            "gpu_cache": _storage_bytes([self.cuda_cache.data], seen),
+            "gpu_cache_used": (
+                (self.cuda_cache.num_units - len(self.cuda_cache.idle_set))
+                * self.cuda_cache.unit_size * self.cuda_cache.data.element_size()
+            ),
+            "local": _storage_bytes(local, seen),
+            "init": _storage_bytes([self.init_k, self.init_v], seen),
+            "remainder": _storage_bytes(list(self.global_remainder) + [self.global_remainder_local_score], seen),
+            "block_repr": block_repr,
+            "block_table": _storage_bytes([self.block_slot, self.block_score], seen),
+            "host": host,
+        }
+        ret["gpu_total"] = sum(ret[key] for key in _GPU_TIERS)
+        ret["host_total"] = host
+        return ret
+
+
+    def memory_report(self) -> dict:
+        """
+        memory_usage, with the largest values seen at the end of a step under "peak".
+        Peaks are only tracked from the first report on, so steps before it are not in them.
+        """
+        self.track_memory_peak = True
+        ret = self.memory_usage()
+        if len(ret) > 0:
+            ret["peak"] = dict(self._memory_peak)
+        return ret
+
+
+    def memory_growth(self, num_new_tokens: int) -> dict:
+        """
+        Upper bound of the extra gpu / host bytes after `num_new_tokens` more tokens.
+        Only memory units grow with the context: their host copies, and on the device
+        their representatives and block table entries. Those grow in steps, by a
+        segment of the VectorTensor or by doubling the block table (whose old copy is
+        alive while it is copied), so the device bytes are those of the steps reached.
+        """
+        if not self.initialized:
+            return {"gpu": 0, "host": 0}
+
+        # at most all tokens not cut into blocks yet, n_local of them stay in the window
+        remainder_len = self._global_remainder_ed - self._global_remainder_st
+        new_blocks = (remainder_len + num_new_tokens) // self.block_size
+        num_blocks = self.num_global_block + new_blocks
+
+        host = new_blocks * self.num_units * self.cache_stats.block_bytes
+        gpu = 0
+        if self.faiss:
+            host += new_blocks * self.num_units * self.unit_size * self.dim_head * 4
+        else:
+            # one representative per block and unit
+            cache_size = self.block_k.cache_size
+            while num_blocks > cache_size:
+                cache_size += self.block_k.next_cache_size(cache_size)
+            gpu += (
+                (cache_size - self.block_k.cache_size)
+                * self.num_units * self.unit_size * self.dim_head * self.init_k.element_size()
+            )
+
+        capacity = self.block_slot.size(1)
+        table_bytes = self.num_units * (self.block_slot.element_size() + self.block_score.element_size())
+        if num_blocks > capacity:
+            new_capacity = capacity
+            while num_blocks > new_capacity:
+                new_capacity *= 2
+            gpu += new_capacity * table_bytes
+
+        return {"gpu": gpu, "host": host}
+
+
+    def stats(self) -> dict:
+        """
+        Cache telemetry of this layer, see CacheStats.as_dict.
+        """
+        return self.cache_stats.as_dict(
+            self.num_global_block * self.num_units,
+            sum(len(cached) for cached in self.cached_blocks)
+        )
\ No newline at end of file
@@ -1,12 +1,67 @@
-from typing import Protocol, Any
+import os
+import queue
+import struct
+import atexit
+import threading
+from typing import Protocol, Any, List
 from time import perf_counter
+from array import array
+
+
+class TokenLog:
+    """
+    Host-side log of the token ids of the session (batch row 0), for listeners that
+    decode block contents. Ids are kept in fixed-size chunks, so appending never copies
+    earlier tokens. The patched model only records into `model.token_log` when it is set.
+    """
+    def __init__(self, chunk_size: int = 65536):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.length = 0
+        # bumped on clear, so that readers can tell a new session from an old one
+        self.session = 0
+
+    def append(self, input_ids) -> None:
+        ids = input_ids[0].tolist()
+        pos = 0
+        while pos < len(ids):
+            if len(self.chunks) == 0 or len(self.chunks[-1]) == self.chunk_size:
+                self.chunks.append(array("l"))
+            chunk = self.chunks[-1]
+            n = min(self.chunk_size - len(chunk), len(ids) - pos)
+            chunk.extend(ids[pos:pos + n])
+            pos += n
+
+        self.length += len(ids)
+
+    def get(self, st: int, ed: int) -> List[int]:
+        """
+        Token ids at positions st .. ed - 1.
+        """
+        ed = min(ed, self.length)
+        ret = []
+        for c in range(st // self.chunk_size, (ed - 1) // self.chunk_size + 1):
+            base = c * self.chunk_size
+            ret.extend(self.chunks[c][max(st - base, 0):ed - base])
+
+        return ret
+
+    def clear(self) -> None:
+        self.chunks = []
+        self.length = 0
+        self.session += 1
+
+    def __len__(self):
+        return self.length
+
 
 class GlobalCacheListener(Protocol):
     """
-    event     - 'add' | 'load' | 'evict'
+    event     - 'add' | 'load' | 'evict' | 'topk'
     unit_id   - batch index  (0-based, size = num_units)
     block_id  - global block index  (0-based, monotonically increasing)
-    extra     - anything else you feel like emitting (length, timestamp …)
+    extra     - anything else you feel like emitting (length, timestamp …),
+                'add' carries the block's token positions [block_start, block_end)
     """
     def __call__(self,
                  event: str,
@@ -17,6 +72,7 @@ class GlobalCacheListener(Protocol):
 def file_listener(filename: str, model) -> GlobalCacheListener:
     """
     Returns a listener that writes to the given file as efficiently as possible.
+    Block contents are decoded from `model.token_log` when it is set.
     """
     try:
         with open(filename, 'w') as f:
@@ -44,8 +100,152 @@ def file_listener(filename: str, model) -> GlobalCacheListener:
             else:
                 raise ValueError(f"Unknown event: {event}")
         
-            if 'block_start' in kwargs and 'block_end' in kwargs:
-                f.write(f"  block_contents={_decode(model.input_ids.tolist()[0][kwargs['block_start']:kwargs['block_end']])}\n")
+            token_log = getattr(model, 'token_log', None)
+            if token_log is not None and 'block_start' in kwargs and 'block_end' in kwargs:
+                f.write(f"  block_contents={_decode(token_log.get(kwargs['block_start'], kwargs['block_end']))}\n")
 
     return _listener
-    
\ No newline at end of file
+    
+
+# trace file layout: TRACE_MAGIC, u32 version, u32 record size, then fixed-size records
+TRACE_MAGIC = b"INFLLMTR"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<8sII")
+# time, block_start, block_end, block_id, unit_id, layer, event
+TRACE_RECORD = struct.Struct("<dqqiHBB")
+# 'token' records carry a token id in block_id at position block_start,
+# 'reset' records start a new session (token positions start over)
+TRACE_EVENTS = ('add', 'load', 'evict', 'topk', 'token', 'reset')
+_TRACE_EVENT_CODE = {event: i for i, event in enumerate(TRACE_EVENTS)}
+
+
+class TraceWriter:
+    """
+    Writes cache events of all layers as fixed-size binary records (TRACE_RECORD).
+
+    Records are packed into a preallocated buffer. A full buffer is handed to a
+    background thread that writes it to the file, so emitting an event never touches
+    the file. Block contents are not decoded here: the tokens that 'add' records
+    cover are traced from `token_log` as 'token' records, and `inf_llm.decode_trace`
+    decodes them offline.
+    """
+    def __init__(self, filename: str, token_log: TokenLog = None, buffer_records: int = 1 << 16):
+        dirname = os.path.dirname(filename)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+
+        self.token_log = token_log
+        self._file = open(filename, 'wb')
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        self._buffer_size = buffer_records * TRACE_RECORD.size
+        self._buffer = bytearray(self._buffer_size)
+        self._offset = 0
+        self._free = queue.SimpleQueue()
+        self._pending = queue.SimpleQueue()
+        self._token_session = None
+        self._tokens_written = 0
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _flush_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+
+            buffer, size = item
+            self._file.write(memoryview(buffer)[:size])
+            self._free.put(buffer)
+
+    def _swap(self):
+        self._pending.put((self._buffer, self._offset))
+        try:
+            self._buffer = self._free.get_nowait()
+        except queue.Empty:
+            self._buffer = bytearray(self._buffer_size)
+        self._offset = 0
+
+    def _write(self, layer, event, unit_id=0, block_id=-1, block_start=-1, block_end=-1):
+        if self._offset == self._buffer_size:
+            self._swap()
+
+        TRACE_RECORD.pack_into(
+            self._buffer, self._offset,
+            perf_counter(), block_start, block_end, block_id, unit_id, layer, _TRACE_EVENT_CODE[event]
+        )
+        self._offset += TRACE_RECORD.size
+
+    def _write_tokens(self, layer, end):
+        """
+        Traces the session's tokens up to position `end`, each one once.
+        """
+        token_log = self.token_log
+        if token_log.session != self._token_session:
+            self._token_session = token_log.session
+            self._tokens_written = 0
+            self._write(layer, 'reset')
+
+        start = self._tokens_written
+        for i, token in enumerate(token_log.get(start, end)):
+            self._write(layer, 'token', block_id=token, block_start=start + i)
+            self._tokens_written = start + i + 1
+
+    def listener(self, layer: int) -> GlobalCacheListener:
+        """
+        Listener of one layer's ContextManager.
+        """
+        def _listener(event: str, **kwargs: Any) -> None:
+            if self._closed:
+                return
+
+            unit_id = kwargs['unit_id']
+            if event == 'topk':
+                # one record per selected block, block_start is its rank in the selection;
+                # a selection of all units comes as one list per unit
+                ret = kwargs['ret']
+                selections = enumerate(ret) if len(ret) > 0 and isinstance(ret[0], list) else [(unit_id, ret)]
+                for u, ret_u in selections:
+                    for rank, block_id in enumerate(ret_u):
+                        self._write(layer, event, u, block_id, rank, len(ret_u))
+                return
+
+            if event not in ('add', 'load', 'evict'):
+                raise ValueError(f"Unknown event: {event}")
+
+            block_start = kwargs.get('block_start', -1)
+            block_end = kwargs.get('block_end', -1)
+            if self.token_log is not None and block_end > 0:
+                self._write_tokens(layer, block_end)
+
+            self._write(layer, event, unit_id, kwargs['block_id'], block_start, block_end)
+
+        return _listener
+
+    def close(self) -> None:
+        if self._closed:
+            return
+
+        self._closed = True
+        self._swap()
+        self._pending.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def trace_listener(filename: str, model) -> TraceWriter:
+    """
+    The TraceWriter shared by all layers of `model`, created on first use. Get each
+    layer's listener with `.listener(layer_idx)`. The trace records the tokens of the
+    blocks it reports, so this also starts `model.token_log`.
+    """
+    writer = getattr(model, 'trace_writer', None)
+    if writer is None:
+        if getattr(model, 'token_log', None) is None:
+            model.token_log = TokenLog()
+        writer = TraceWriter(filename, model.token_log)
+        model.trace_writer = writer
+
+    return writer
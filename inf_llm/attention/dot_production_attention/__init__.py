@@ -1,10 +1,19 @@
-from .base import MultiStageDotProductionAttention
+from .base import MultiStageDotProductionAttention, WorkspacePool, get_workspace_pool
 from typing import Tuple
 
 def get_multi_stage_dot_production_attention(flash_attn=False) -> Tuple[type, bool]:
+    """
+    flash_attn: True for the triton kernels, "sdpa" for torch's scaled_dot_product_attention,
+    False for the plain torch implementation.
+    Returns the attention class and whether the triton kernels are used.
+    """
     class UseTorch(Exception):
         pass
 
+    if flash_attn == "sdpa":
+        from .sdpa_impl import SdpaMultiStageDotProductionAttention
+        return SdpaMultiStageDotProductionAttention, False
+
     try:
         if flash_attn:
             from .triton_impl import TritonMultiStageDotProductionAttention as ret
@@ -1,24 +1,86 @@
 import torch
 
+
+class WorkspacePool:
+    """
+    Reusable attention buffers. One flat buffer is kept per (name, dtype, device)
+    and grown to the largest size requested, `get` returns a view of its prefix.
+    A view is only valid until the next `get` of the same name, so results
+    that outlive the attention call have to be copied out by the caller.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype, device):
+        numel = 1
+        for s in shape:
+            numel *= s
+
+        key = (name, dtype, torch.device(device))
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            # drop the old buffer before allocating the larger one
+            self._buffers.pop(key, None)
+            del buffer
+            # zeros, so that masked-out parts of a fresh buffer are never nan
+            buffer = torch.zeros((numel,), dtype=dtype, device=device)
+            self._buffers[key] = buffer
+
+        return buffer[:numel].view(shape)
+
+    def clear(self):
+        self._buffers.clear()
+
+    def nbytes(self, device=None):
+        return sum(
+            buffer.numel() * buffer.element_size()
+            for (_, _, d), buffer in self._buffers.items()
+            if device is None or d == torch.device(device)
+        )
+
+
+_WORKSPACE_POOL = WorkspacePool()
+
+
+def get_workspace_pool() -> WorkspacePool:
+    """
+    The process-wide pool shared by all layers. Decoder layers run one after
+    another, so a single set of buffers serves all of them.
+    """
+    return _WORKSPACE_POOL
+
+
 class MultiStageDotProductionAttention:
     def __init__(
-        self, 
+        self,
         q_shape,
         dtype,
         device,
+        workspace: WorkspacePool = None,
     ):
         self.q_shape = q_shape
         self.dtype = dtype
         self.device = device
+        self.workspace = workspace
         self.end = False
-        self.ret = torch.zeros(
-            q_shape, dtype=dtype, device=device
-        )
+        if workspace is None:
+            self.ret = torch.zeros(
+                q_shape, dtype=dtype, device=device
+            )
+        else:
+            # finalize overwrites the whole result, no need to reset it
+            self.ret = workspace.get("ret", q_shape, dtype, device)
         self.score_list = []
 
+    def _buffer(self, name, shape, dtype):
+        if self.workspace is None:
+            return torch.empty(shape, dtype=dtype, device=self.device)
+
+        return self.workspace.get(name, shape, dtype, self.device)
+
     def append(
-        self, 
-        q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, 
+        self,
+        q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
         sliding_window=None, complement_sliding_window: bool = False,
         end=False, get_score=False,
         *args, **kwargs
@@ -26,5 +88,36 @@ class MultiStageDotProductionAttention:
         raise NotImplementedError
 
 
+    def append_paged(
+        self,
+        q: torch.Tensor, k_cache: torch.Tensor, v_cache: torch.Tensor,
+        block_table: torch.Tensor,
+        sliding_window=None, complement_sliding_window: bool = False,
+        end=False, get_score=False
+    ):
+        """
+        A stage whose keys are pages of a paged cache.
+
+        k_cache, v_cache - (num_slots, num_heads_kv, page_size, dim_head)
+        block_table      - (batch, num_pages) int64 slots of the pages, in key order
+
+        Gathers the pages into contiguous k/v by default.
+        """
+        batch_size, num_pages = block_table.shape
+        _, num_heads_kv, page_size, dim_head = k_cache.shape
+
+        def gather(cache):
+            return cache[block_table].transpose(1, 2).reshape(
+                batch_size, num_heads_kv, num_pages * page_size, dim_head
+            )
+
+        return self.append(
+            q, gather(k_cache), gather(v_cache),
+            sliding_window=sliding_window,
+            complement_sliding_window=complement_sliding_window,
+            end=end, get_score=get_score
+        )
+
+
     def get_result(self):
         return self.ret, self.score_list
@@ -0,0 +1,164 @@
+import re
+import math
+import torch
+
+from .base import MultiStageDotProductionAttention
+from .torch_impl import (
+    sliding_window_mask, sliding_window_range,
+    attention_stage_score, online_softmax_attention
+)
+
+# The fused ops that return the log-sum-exp are private and their signatures change
+# between releases. They are only called on the releases they were checked against,
+# every other release falls back to the online softmax of the torch backend.
+_FUSED_LSE_CUDA_VERSIONS = ((2, 1), (2, 5))  # _scaled_dot_product_efficient_attention with attn_bias
+_FUSED_LSE_CPU_VERSIONS = ((2, 3), (2, 5))   # _scaled_dot_product_flash_attention_for_cpu with attn_mask
+
+
+def _torch_version():
+    match = re.match(r"(\d+)\.(\d+)", torch.__version__)
+    return (int(match.group(1)), int(match.group(2))) if match is not None else (0, 0)
+
+
+# whether torch's fused attention ops can return the log-sum-exp on this install
+_FUSED_LSE = True
+
+
+def _fused_attention_with_lse(q, k, v, mask, sm_scale):
+    lo, hi = _FUSED_LSE_CUDA_VERSIONS if q.is_cuda else _FUSED_LSE_CPU_VERSIONS
+    if not lo <= _torch_version() <= hi:
+        raise NotImplementedError(f"fused log-sum-exp is only used with torch {lo} to {hi}")
+
+    if q.is_cuda:
+        attn_bias = None
+        if mask is not None:
+            # the memory efficient kernel wants the bias rows 16-element aligned
+            len_q, len_k = mask.shape
+            attn_bias = torch.zeros(
+                (len_q, (len_k + 15) // 16 * 16), dtype=q.dtype, device=q.device
+            )[:, :len_k]
+            attn_bias.masked_fill_(mask == False, float("-inf"))
+            attn_bias = attn_bias.expand(q.size(0), q.size(1), len_q, len_k)
+
+        out, lse = torch.ops.aten._scaled_dot_product_efficient_attention(
+            q, k, v, attn_bias, True, scale=sm_scale
+        )[:2]
+    else:
+        out, lse = torch.ops.aten._scaled_dot_product_flash_attention_for_cpu(
+            q, k, v, attn_mask=mask, scale=sm_scale
+        )[:2]
+
+    lse = lse[:, :, :q.size(2)]
+    if out.shape != q.shape or lse.shape != q.shape[:3]:
+        raise NotImplementedError(f"unexpected fused attention outputs {tuple(out.shape)}, {tuple(lse.shape)}")
+
+    return out, lse
+
+
+def attention_with_lse(q, k, v, sliding_window, complement_sliding_window, sm_scale):
+    """
+    Attention of one stage and the (batch, num_heads, len_q) log-sum-exp of every
+    row, -inf for rows without visible keys. Uses the fused kernels' own log-sum-exp
+    when torch exposes it, and a single online softmax pass over the keys otherwise.
+    """
+    global _FUSED_LSE
+    if _FUSED_LSE:
+        batch_size, num_heads, len_q, dim_head = q.shape
+        len_k = k.size(-2)
+        num_heads_kv = k.size(1)
+        num_group = num_heads // num_heads_kv
+
+        lo, hi = sliding_window_range(len_q, len_k, sliding_window, complement_sliding_window)
+        if hi <= lo:
+            return None, None
+
+        mask = None
+        if sliding_window is not None:
+            mask = sliding_window_mask(
+                len_q, hi - lo, sliding_window[0] - lo, sliding_window[1],
+                complement_sliding_window, q.device
+            )
+            if num_group > 1:
+                mask = mask.repeat(num_group, 1)
+
+        try:
+            # fold the query heads of a group into rows, so that grouped k/v are never expanded
+            out, lse = _fused_attention_with_lse(
+                q.reshape(batch_size, num_heads_kv, num_group * len_q, dim_head),
+                k[:, :, lo:hi, :], v[:, :, lo:hi, :],
+                mask, sm_scale
+            )
+            return out.view(q.shape), lse.view(q.shape[:3])
+        except Exception as E:
+            _FUSED_LSE = False
+            from warnings import warn
+            warn(f"Fused attention with log-sum-exp is not available. Use the online softmax instead.\n{E}")
+
+    return online_softmax_attention(q, k, v, sm_scale, sliding_window, complement_sliding_window)
+
+
+class SdpaMultiStageDotProductionAttention(MultiStageDotProductionAttention):
+    """
+    Multi-stage attention on top of torch.nn.functional.scaled_dot_product_attention.
+    Each stage only passes the keys its sliding window can see, with the window as
+    a boolean mask, and the stage outputs are merged by their log-sum-exp.
+    """
+    def __init__(self, q_shape, dtype, device, workspace=None):
+        super().__init__(q_shape, dtype, device, workspace)
+        batch_size, num_heads, len_q, dim_head = q_shape
+        self.o = self._buffer("o", (batch_size, num_heads, len_q, dim_head), torch.float32).zero_()
+        self.lse = self._buffer("lse", (batch_size, num_heads, len_q), torch.float32).fill_(float("-inf"))
+        self.sm_scale = 1 / math.sqrt(dim_head)
+        self.score_stage_list = []
+
+
+    def finalize(self):
+        self.end = True
+        # rows without any visible key get lse = inf, hence zero scores
+        lse = torch.where(self.lse > float("-inf"), self.lse, float("inf"))[..., None]
+        for stage in self.score_stage_list:
+            if stage is None:
+                self.score_list.append(None)
+                continue
+
+            q, k, sliding_window, complement_sliding_window = stage
+            score = attention_stage_score(q, k, lse, self.sm_scale, sliding_window, complement_sliding_window)
+            self.score_list.append(score.to(self.dtype))
+
+        self.ret.copy_(self.o)
+
+
+    def append(
+            self,
+            q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+            sliding_window = None,
+            complement_sliding_window:bool = False,
+            end=False, get_score=False,
+            *args, **kwargs
+        ):
+        len_q, len_k = q.size(-2), k.size(-2)
+        if isinstance(sliding_window, int):
+            sliding_window = (len_k - len_q, sliding_window)
+
+        stage_o, stage_lse = attention_with_lse(
+            q, k, v, sliding_window, complement_sliding_window, self.sm_scale
+        )
+        if stage_o is not None:
+            stage_o = stage_o.float()
+            stage_lse = stage_lse.float()
+
+            # merge by log-sum-exp, rows without visible keys carry no weight
+            lse = torch.logaddexp(self.lse, stage_lse)
+            lse_safe = torch.where(lse == float("-inf"), 0., lse)
+            stage_o = torch.where((stage_lse == float("-inf"))[..., None], 0., stage_o)
+            self.o.mul_(torch.exp(self.lse - lse_safe)[..., None])
+            self.o.add_(stage_o * torch.exp(stage_lse - lse_safe)[..., None])
+            self.lse.copy_(lse)
+
+        if get_score:
+            self.score_stage_list.append((q, k, sliding_window, complement_sliding_window))
+        else:
+            self.score_stage_list.append(None)
+
+        if end:
+            self.finalize()
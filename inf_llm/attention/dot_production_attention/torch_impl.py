@@ -1,96 +1,229 @@
 import math
 import torch
+from collections import OrderedDict
 
 from .base import MultiStageDotProductionAttention
 
+# number of keys processed at a time, bounds the logits to (len_q, _KV_CHUNK_SIZE) per head
+_KV_CHUNK_SIZE = 1024
+# side of the largest mask band kept on device, 64 MB each
+_MASK_BAND_MAX_SIDE = 1 << 13
+# number of mask bands kept, the least recently used one is dropped beyond it
+_MASK_BAND_MAX_NUM = 4
+# (size, complement, visible, device) -> band, with band[a, b] the mask at dist = a - b + (size + 1) // 2,
+# in least recently used order
+_mask_bands = OrderedDict()
+
+
+def _window_mask(len_q, len_k, sliding_window_offset, sliding_window_size, complement_sliding_window, device, visible):
+    dist = torch.arange(
+        len_q, dtype=torch.int64, device=device
+    )[:, None] - torch.arange(
+        len_k, dtype=torch.int64, device=device
+    )[None, :] + sliding_window_offset
+    if complement_sliding_window:
+        mask = dist >= sliding_window_size
+    else:
+        mask = (dist < sliding_window_size) & (dist >= 0)
+
+    if not visible:
+        mask.logical_not_()
+
+    return mask
+
+
+def sliding_window_mask(len_q, len_k, sliding_window_offset, sliding_window_size, complement_sliding_window, device, visible=True):
+    """
+    (len_q, len_k) bool mask of the keys visible to each query, or of the hidden ones if not `visible`.
+    dist = i - j + sliding_window_offset, visible if 0 <= dist < size, or dist >= size for the complement.
+
+    The mask only depends on dist, so it is a view of one band per window size, kept
+    on device and shared by all layers and steps whatever the offset. Callers must
+    not modify it in place. Masks wider than _MASK_BAND_MAX_SIDE are built uncached,
+    and at most _MASK_BAND_MAX_NUM bands are kept.
+    """
+    # the mask is constant for dist < 0 and for dist >= size, so offsets beyond them give the same mask
+    offset = min(max(sliding_window_offset, -len_q), sliding_window_size + len_k - 1)
+    shift = (sliding_window_size + 1) // 2
+    side = len_q + len_k + shift
+    if side > _MASK_BAND_MAX_SIDE:
+        return _window_mask(len_q, len_k, offset, sliding_window_size, complement_sliding_window, device, visible)
+
+    key = (sliding_window_size, complement_sliding_window, visible, torch.device(device))
+    band = _mask_bands.get(key)
+    if band is None or band.size(0) < side:
+        if band is not None:
+            side = min(max(side, 2 * band.size(0)), _MASK_BAND_MAX_SIDE)
+        band = _window_mask(side, side, shift, sliding_window_size, complement_sliding_window, device, visible)
+        _mask_bands[key] = band
+        if len(_mask_bands) > _MASK_BAND_MAX_NUM:
+            _mask_bands.popitem(last=False)
+    _mask_bands.move_to_end(key)
+
+    # rows and columns of the band with row - column = offset - shift
+    row = max(offset - shift, 0)
+    col = row - offset + shift
+    return band[row:row + len_q, col:col + len_k]
+
+
+def sliding_window_range(len_q, len_k, sliding_window, complement_sliding_window):
+    """
+    Range [lo, hi) of keys that are visible to at least one query.
+    """
+    if sliding_window is None:
+        return 0, len_k
+
+    sliding_window_offset, sliding_window_size = sliding_window
+    if complement_sliding_window:
+        lo = 0
+        hi = len_q + sliding_window_offset - sliding_window_size
+    else:
+        lo = sliding_window_offset - sliding_window_size + 1
+        hi = len_q + sliding_window_offset
+
+    return max(lo, 0), min(max(hi, 0), len_k)
+
+
+def attention_logits_chunks(q, k, sm_scale, sliding_window, complement_sliding_window):
+    """
+    Yields (st, ed, logits) for each chunk of visible keys, logits grouped as
+    (batch, num_heads_kv, num_group, len_q, ed - st) in float32, scaled and masked.
+    """
+    batch_size, num_heads, len_q, dim_head = q.shape
+    num_heads_kv = k.size(1)
+    num_group = num_heads // num_heads_kv
+    len_k = k.size(-2)
+
+    # fold the query heads of a group into rows, so that grouped k/v are never expanded
+    q = q.reshape(batch_size, num_heads_kv, num_group * len_q, dim_head)
+
+    lo, hi = sliding_window_range(len_q, len_k, sliding_window, complement_sliding_window)
+    for st in range(lo, hi, _KV_CHUNK_SIZE):
+        ed = min(st + _KV_CHUNK_SIZE, hi)
+        logits = torch.matmul(q, k[:, :, st:ed, :].transpose(-1, -2)).float()
+        logits = logits.view(batch_size, num_heads_kv, num_group, len_q, ed - st)
+        logits.mul_(sm_scale)
+        if sliding_window is not None:
+            hidden = sliding_window_mask(
+                len_q, ed - st, sliding_window[0] - st, sliding_window[1],
+                complement_sliding_window, q.device, visible=False
+            )
+            logits.masked_fill_(hidden, float("-inf"))
+
+        yield st, ed, logits
+
+
+def attention_stage_score(q, k, lse, sm_scale, sliding_window, complement_sliding_window):
+    """
+    Per-key probability sums (batch, num_heads, len_k) of one stage, given the
+    final (batch, num_heads, len_q, 1) log-sum-exp of every row (inf for empty rows).
+    """
+    batch_size, num_heads, len_q, _ = q.shape
+    num_heads_kv = k.size(1)
+    lse = lse.view(batch_size, num_heads_kv, num_heads // num_heads_kv, len_q, 1)
+    score = torch.zeros((batch_size, num_heads, k.size(-2)), dtype=torch.float32, device=q.device)
+    for st, ed, logits in attention_logits_chunks(q, k, sm_scale, sliding_window, complement_sliding_window):
+        p = torch.exp(logits - lse)
+        score[:, :, st:ed] = p.sum(dim=-2).view(batch_size, num_heads, ed - st)
+
+    return score
+
+
+def online_softmax_update(m, l, acc, q, k, v, sm_scale, sliding_window, complement_sliding_window):
+    """
+    Folds one stage into the running (batch, num_heads, len_q, 1) max `m` and sum `l`
+    and the (batch, num_heads, len_q, dim_head) output accumulator `acc`, in place.
+    """
+    batch_size, num_heads, len_q, dim_head = q.shape
+    num_heads_kv = k.size(1)
+    num_group = num_heads // num_heads_kv
+
+    m = m.view(batch_size, num_heads_kv, num_group, len_q, 1)
+    l = l.view(batch_size, num_heads_kv, num_group, len_q, 1)
+    acc = acc.view(batch_size, num_heads_kv, num_group * len_q, dim_head)
+    for st, ed, logits in attention_logits_chunks(q, k, sm_scale, sliding_window, complement_sliding_window):
+        m_new = torch.maximum(m, logits.amax(dim=-1, keepdim=True))
+        # rows without any visible key so far keep m = -inf
+        m_safe = torch.where(m_new == float("-inf"), 0., m_new)
+        alpha = torch.exp(m - m_safe)
+        p = torch.exp(logits - m_safe)
+        l.mul_(alpha).add_(p.sum(dim=-1, keepdim=True))
+        acc.mul_(alpha.view(batch_size, num_heads_kv, num_group * len_q, 1))
+        acc.add_(torch.matmul(
+            p.view(batch_size, num_heads_kv, num_group * len_q, ed - st).to(v.dtype),
+            v[:, :, st:ed, :]
+        ).float())
+        m.copy_(m_new)
+
+
+def online_softmax_attention(q, k, v, sm_scale, sliding_window, complement_sliding_window):
+    """
+    Attention output and (batch, num_heads, len_q) log-sum-exp of one stage in a
+    single pass over its keys, -inf for rows without visible keys.
+    """
+    m = torch.full((*q.shape[:3], 1), float("-inf"), dtype=torch.float32, device=q.device)
+    l = torch.zeros_like(m)
+    acc = torch.zeros(q.shape, dtype=torch.float32, device=q.device)
+    online_softmax_update(m, l, acc, q, k, v, sm_scale, sliding_window, complement_sliding_window)
+    out = torch.where(l > 0, acc / l, 0.)
+    lse = torch.where(l > 0, m + torch.log(l), float("-inf"))
+    return out, lse.squeeze(-1)
+
+
 class TorchMultiStageDotProductionAttention(MultiStageDotProductionAttention):
-    def __init__(self, q_shape, dtype, device):
-        super().__init__(q_shape, dtype, device)
-        self.logits_list = []
-        self.v_list = []
-        self.mask_list = []
-        self.get_score_list = []
-        self.kv_len_list = []
+    """
+    Multi-stage attention with online softmax: every stage updates a running
+    max, sum and output accumulator chunk by chunk over its keys, so memory is
+    O(len_q * _KV_CHUNK_SIZE) per head instead of the full probability matrix.
+    """
+    def __init__(self, q_shape, dtype, device, workspace=None):
+        super().__init__(q_shape, dtype, device, workspace)
+        batch_size, num_heads, len_q, dim_head = q_shape
+        self.m = self._buffer("m", (batch_size, num_heads, len_q, 1), torch.float32).fill_(float("-inf"))
+        self.l = self._buffer("l", (batch_size, num_heads, len_q, 1), torch.float32).zero_()
+        self.acc = self._buffer("acc", (batch_size, num_heads, len_q, dim_head), torch.float32).zero_()
+        self.sm_scale = 1 / math.sqrt(dim_head)
+        self.score_stage_list = []
+
 
     def finalize(self):
-        logits = torch.cat(self.logits_list, dim=-1)
-        p = torch.softmax(logits, dim=-1)
-        st = 0
-        for kv_len, mask, get_score, v in zip(self.kv_len_list, self.mask_list, self.get_score_list, self.v_list):
-            ed = st + kv_len
-            tmp = p[:, :, :, st: ed]
-            tmp = torch.masked_fill(
-                tmp,
-                mask==False,
-                0
-            )
-            if get_score:
-                self.score_list.append(tmp.sum(dim=-2))
-            else:
+        self.end = True
+        # rows without any visible key get lse = inf, hence zero scores
+        lse = torch.where(self.l > 0, self.m + torch.log(self.l), float("inf"))
+        for stage in self.score_stage_list:
+            if stage is None:
                 self.score_list.append(None)
+                continue
 
-            self.ret.add_(
-                torch.matmul(tmp, v)
-            )
+            q, k, sliding_window, complement_sliding_window = stage
+            score = attention_stage_score(q, k, lse, self.sm_scale, sliding_window, complement_sliding_window)
+            self.score_list.append(score.to(self.dtype))
 
-            st = ed
+        ret = torch.where(self.l > 0, self.acc / self.l, 0.)
+        self.ret.copy_(ret)
 
 
     def append(
-            self, 
-            q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, 
+            self,
+            q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
             sliding_window = None,
             complement_sliding_window:bool = False,
             end=False, get_score=False,
             *args, **kwargs
         ):
-        len_q = q.size(-2)
-        len_k = k.size(-2)
-
-        num_heads = q.size(1)
-        num_heads_kv = k.size(1)
-        if num_heads != num_heads_kv:
-            shape = list(k.shape)
-            num_group = num_heads // num_heads_kv
-            k = k[:, :, None, :, :].expand(shape[0], shape[1], num_group, shape[2], shape[3])
-            k = k.reshape(shape[0], num_heads, shape[2], shape[3])
-            v = v[:, :, None, :, :].expand(shape[0], shape[1], num_group, shape[2], shape[3])
-            v = v.reshape(shape[0], num_heads, shape[2], shape[3])
-
-        if sliding_window is None:
-            mask = torch.ones(
-                (len_q, len_k),
-                dtype=torch.bool,
-                device=q.device
-            )
-        else:
-            if isinstance(sliding_window, int):
-                sliding_window = (len_k - len_q, sliding_window)
-
-            dist = torch.arange(
-                len_q, dtype=torch.int64, device=q.device
-            )[:, None] - torch.arange(
-                len_k, dtype=torch.int64, device=k.device
-            )[None, :] + sliding_window[0]
-            if complement_sliding_window:
-                mask = dist >= sliding_window[1]
-            else:
-                mask = (dist < sliding_window[1]) & (dist >= 0)
-
-        m_shape = [1] * (4-mask.dim()) + list(mask.shape)
-        mask = mask.view(m_shape)
-        self.v_list.append(v)
-        self.mask_list.append(mask)
-        self.get_score_list.append(get_score)
-        self.kv_len_list.append(k.size(-2))
-        logits = torch.matmul(q, k.transpose(-1, -2))
-        logits = torch.masked_fill(
-            logits,
-            mask==False,
-            float("-inf")
+        len_q, len_k = q.size(-2), k.size(-2)
+        if isinstance(sliding_window, int):
+            sliding_window = (len_k - len_q, sliding_window)
+
+        online_softmax_update(
+            self.m, self.l, self.acc, q, k, v,
+            self.sm_scale, sliding_window, complement_sliding_window
         )
-        logits.mul_(1/math.sqrt(q.size(-1)))
-        self.logits_list.append(logits)
+
+        if get_score:
+            self.score_stage_list.append((q, k, sliding_window, complement_sliding_window))
+        else:
+            self.score_stage_list.append(None)
 
         if end:
             self.finalize()
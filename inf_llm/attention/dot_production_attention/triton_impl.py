@@ -11,23 +11,86 @@ Extra Credits:
 
 """
 
+import os
+import json
+import atexit
 import math
+import inspect
 import torch
 
 import triton
 import triton.language as tl
 from .base import MultiStageDotProductionAttention
 
-_BLOCK_N=64
-_BLOCK_M=64
+# tuned block configurations are kept across processes in this file
+_TUNING_CACHE_FILE = os.environ.get(
+    "INF_LLM_TRITON_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "inf_llm", "triton_autotune.json")
+)
+
+
+def _ctx_bucket(n):
+    """
+    Query length bucket that block configurations are tuned for, decode gets its own.
+    """
+    return min(triton.next_power_of_2(max(n, 1)), 4096)
+
+
+def _prune_configs(configs, named_args, **kwargs):
+    # no need to try query tiles much larger than the queries
+    bucket = named_args["N_CTX_BUCKET"]
+    ret = [c for c in configs if c.kwargs["BLOCK_M"] <= max(16, bucket)]
+    return ret if len(ret) > 0 else configs[:1]
+
+
+def _autotune(configs, key, restore_value=None):
+    kwargs = {"configs": configs, "key": key, "prune_configs_by": {"early_config_prune": _prune_configs}}
+    if restore_value is not None:
+        if "restore_value" not in inspect.signature(triton.autotune).parameters:
+            # benchmarking would run the kernel several times on its own accumulators,
+            # without restore_value only the default configuration is safe
+            kwargs["configs"] = configs[:1]
+        else:
+            kwargs["restore_value"] = restore_value
+
+    return triton.autotune(**kwargs)
+
+
+# the first configuration is the default, used where it cannot be tuned.
+# BLOCK_M must divide 64, the length q is padded to.
+_FWD_CONFIGS = [
+    triton.Config({"BLOCK_M": 64, "BLOCK_N": 64}, num_warps=4, num_stages=4)
+] + [
+    triton.Config({"BLOCK_M": block_m, "BLOCK_N": block_n}, num_warps=num_warps, num_stages=num_stages)
+    for block_m in [16, 32, 64]
+    for block_n in [32, 64, 128]
+    for num_warps, num_stages in [(4, 2), (4, 3), (8, 3)]
+]
+
+_SCORE_CONFIGS = [
+    triton.Config({"BLOCK_M": block_m, "BLOCK_N": block_n}, num_warps=num_warps, num_stages=num_stages)
+    for block_m in [16, 32, 64]
+    for block_n in [32, 64, 128]
+    for num_warps, num_stages in [(4, 2), (4, 4)]
+]
+
+_TUNING_KEY = ["N_CTX_BUCKET", "SLIDING_WINDOW", "COMPLEMENT_SLIDING_WINDOW"]
+# logits (in bytes) the stages of one attention may keep together for their scores, stages
+# beyond it recompute qk. They are freed after the score pass, not kept in the workspace pool.
+_LOGITS_CACHE_BYTES = 1 << 28
+# keys handled by one program of the split-kv decode kernel
+_DECODE_SPLIT_SIZE = 256
+_DECODE_BLOCK_N = 64
 
 @triton.jit
 def _attn_fwd_inner(acc, l_i, m_i, q, 
                     K_block_ptr, V_block_ptr,
                     start_m, qk_scale, N_CTX,
                     sliding_window_offset, sliding_window_size,
+                    Logits, stride_lm, stride_ln, Q_CTX,
                     BLOCK_M: tl.constexpr, BLOCK_DMODEL: tl.constexpr, BLOCK_N: tl.constexpr, SLIDING_WINDOW: tl.constexpr,
-                    IS_EVEN_M: tl.constexpr, IS_EVEN_N: tl.constexpr, COMPLEMENT_SLIDING_WINDOW: tl.constexpr
+                    IS_EVEN_M: tl.constexpr, IS_EVEN_N: tl.constexpr, COMPLEMENT_SLIDING_WINDOW: tl.constexpr,
+                    STORE_LOGITS: tl.constexpr
                 ):
     # range of values handled by this stage
     if SLIDING_WINDOW and not COMPLEMENT_SLIDING_WINDOW:
@@ -76,6 +139,15 @@ def _attn_fwd_inner(acc, l_i, m_i, q,
 
         if not IS_EVEN_N:
             qk = tl.where(((tl.arange(0, BLOCK_N) + start_n) < N_CTX)[None, :], qk, float("-inf"))
+
+        if STORE_LOGITS:
+            # keep the masked log2-domain logits for the score pass
+            offs_lm = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+            offs_ln = start_n + tl.arange(0, BLOCK_N)
+            tl.store(
+                Logits + offs_lm[:, None] * stride_lm + offs_ln[None, :] * stride_ln, qk,
+                mask=(offs_lm < Q_CTX)[:, None] & (offs_ln < N_CTX)[None, :]
+            )
    
         m_ij = tl.maximum(m_i, tl.max(qk, 1))
         qk = qk - m_ij[:, None]
@@ -111,6 +183,11 @@ def _attn_fwd_inner(acc, l_i, m_i, q,
     return acc, l_i, m_i
 
 
+@_autotune(
+    _FWD_CONFIGS,
+    key=["BLOCK_DMODEL", "END", "INIT", "STORE_LOGITS"] + _TUNING_KEY,
+    restore_value=["M", "Out", "L"]
+)
 @triton.heuristics(
     {
         "IS_EVEN_M": lambda args: args["N_CTX"] % args["BLOCK_M"] == 0,
@@ -118,17 +195,19 @@ def _attn_fwd_inner(acc, l_i, m_i, q,
     }
 )
 @triton.jit
-def _attn_fwd(Q, K, V, sm_scale, M, Out, L,#
+def _attn_fwd(Q, K, V, sm_scale, M, Out, L, Logits,#
               stride_qz, stride_qh, stride_qm, stride_qk,  #
               stride_kz, stride_kh, stride_kn, stride_kk,  #
               stride_vz, stride_vh, stride_vk, stride_vn,  #
               stride_oz, stride_oh, stride_om, stride_on,  #
+              stride_lz, stride_lh, stride_lm, stride_ln,  #
               Z, H, H_KV, #
               N_CTX,  #
               ROUND_CTX,
               NKV_CTX,
               sliding_window_offset,
               sliding_window_size,
+              N_CTX_BUCKET,
               IS_EVEN_M: tl.constexpr,
               IS_EVEN_N: tl.constexpr,
               BLOCK_M: tl.constexpr,  #
@@ -137,7 +216,8 @@ def _attn_fwd(Q, K, V, sm_scale, M, Out, L,#
               END: tl.constexpr,
               INIT: tl.constexpr,
               SLIDING_WINDOW: tl.constexpr,
-              COMPLEMENT_SLIDING_WINDOW: tl.constexpr
+              COMPLEMENT_SLIDING_WINDOW: tl.constexpr,
+              STORE_LOGITS: tl.constexpr
             ):
 
     start_m = tl.program_id(0)
@@ -149,6 +229,7 @@ def _attn_fwd(Q, K, V, sm_scale, M, Out, L,#
     k_offset = off_z.to(tl.int64) * stride_kz + off_hkv.to(tl.int64) * stride_kh
     v_offset = off_z.to(tl.int64) * stride_vz + off_hkv.to(tl.int64) * stride_vh
     o_offset = off_z.to(tl.int64) * stride_oz + off_h.to(tl.int64) * stride_oh
+    logits_offset = off_z.to(tl.int64) * stride_lz + off_h.to(tl.int64) * stride_lh
 
     # block pointers
     Q_block_ptr = tl.make_block_ptr(
@@ -209,8 +290,9 @@ def _attn_fwd(Q, K, V, sm_scale, M, Out, L,#
     acc, l_i, m_i = _attn_fwd_inner(acc, l_i, m_i, q, K_block_ptr, V_block_ptr, #
                                     start_m, qk_scale, NKV_CTX, #
                                     sliding_window_offset, sliding_window_size,
+                                    Logits + logits_offset, stride_lm, stride_ln, N_CTX,
                                     BLOCK_M, BLOCK_DMODEL, BLOCK_N, SLIDING_WINDOW, IS_EVEN_M, IS_EVEN_N,
-                                    COMPLEMENT_SLIDING_WINDOW) 
+                                    COMPLEMENT_SLIDING_WINDOW, STORE_LOGITS) 
     # epilogue
     if (END):
         m_i += tl.math.log2(l_i)
@@ -222,6 +304,7 @@ def _attn_fwd(Q, K, V, sm_scale, M, Out, L,#
     tl.store(O_block_ptr, acc.to(Out.type.element_ty))
 
 
+@_autotune(_SCORE_CONFIGS, key=["BLOCK_DMODEL"] + _TUNING_KEY)
 @triton.heuristics(
     {
         "IS_EVEN_M": lambda args: args["N_CTX"] % args["BLOCK_M"] == 0,
@@ -240,6 +323,7 @@ def _score_kernel(
     NKV_CTX,
     sliding_window_offset,
     sliding_window_size,
+    N_CTX_BUCKET,
     SLIDING_WINDOW: tl.constexpr,
     COMPLEMENT_SLIDING_WINDOW: tl.constexpr,
     IS_EVEN_M: tl.constexpr,
@@ -317,7 +401,7 @@ def _score_kernel(
         if SLIDING_WINDOW:
             p = tl.where(mask, p, 0)
 
-        if not IS_EVEN_N:
+        if not IS_EVEN_M:
             p = tl.where(
                 ((tl.arange(0, BLOCK_M) + start_m) < N_CTX)[:, None],
                 p, 0
@@ -334,6 +418,179 @@ def _score_kernel(
     o_ptrs = Out + o_offset + o_range
     tl.store(o_ptrs, o.to(Out.type.element_ty), mask = o_range < NKV_CTX)
 
+@_autotune(_SCORE_CONFIGS, key=_TUNING_KEY)
+@triton.jit
+def _score_from_logits_kernel(
+    Logits, M, Out,
+    stride_lz, stride_lh, stride_lm, stride_ln,
+    stride_oz, stride_oh, stride_on,
+    H,
+    N_CTX,
+    ROUND_CTX,
+    NKV_CTX,
+    sliding_window_offset,
+    sliding_window_size,
+    N_CTX_BUCKET,
+    SLIDING_WINDOW: tl.constexpr,
+    COMPLEMENT_SLIDING_WINDOW: tl.constexpr,
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+):
+    start_n = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    logits_offset = off_z.to(tl.int64) * stride_lz + off_h.to(tl.int64) * stride_lh
+    offs_n = start_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    o = tl.zeros([BLOCK_N], dtype=tl.float32)
+
+    for start_m in range(0, N_CTX, BLOCK_M):
+        offs_m = start_m + tl.arange(0, BLOCK_M)
+        mask = (offs_m < N_CTX)[:, None] & (offs_n < NKV_CTX)[None, :]
+        # the forward pass only wrote the tiles its sliding window visits
+        if SLIDING_WINDOW:
+            dist = offs_m[:, None] - offs_n[None, :] + sliding_window_offset
+            if COMPLEMENT_SLIDING_WINDOW:
+                mask = mask & (dist >= sliding_window_size)
+            else:
+                mask = mask & (dist >= 0) & (dist < sliding_window_size)
+
+        qk = tl.load(
+            Logits + logits_offset + offs_m[:, None] * stride_lm + offs_n[None, :] * stride_ln,
+            mask=mask, other=float("-inf")
+        )
+        m = tl.load(M + off_hz * ROUND_CTX + offs_m, mask=offs_m < N_CTX, other=0.)
+        p = tl.math.exp2(qk - m[:, None])
+        o += tl.sum(p, axis=0)
+
+    o_offset = off_z.to(tl.int64) * stride_oz + off_h.to(tl.int64) * stride_oh
+    tl.store(Out + o_offset + offs_n * stride_on, o.to(Out.type.element_ty), mask=offs_n < NKV_CTX)
+
+
+def _tuning_device():
+    name = torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu"
+    return f"{name}/triton-{triton.__version__}"
+
+
+def _tuned_kernels():
+    return {
+        "attn_fwd": _attn_fwd,
+        "attn_fwd_paged": _attn_fwd_paged,
+        "score": _score_kernel,
+        "score_from_logits": _score_from_logits_kernel,
+    }
+
+
+def _load_tuning_cache():
+    if _load_tuning_cache.loaded:
+        return
+    _load_tuning_cache.loaded = True
+
+    try:
+        with open(_TUNING_CACHE_FILE) as f:
+            saved = json.load(f).get(_tuning_device(), {})
+    except (OSError, ValueError):
+        return
+
+    for name, kernel in _tuned_kernels().items():
+        for key, config in saved.get(name, []):
+            kernel.cache[tuple(key)] = triton.Config(
+                config["kwargs"], num_warps=config["num_warps"], num_stages=config["num_stages"]
+            )
+
+
+_load_tuning_cache.loaded = False
+
+
+def _save_tuning_cache():
+    """
+    Merges the tuned configurations of this device into the cache file, replacing it
+    atomically. Runs at exit if anything new was tuned, not in the launch path.
+    """
+    if not _save_tuning_cache.pending:
+        return
+    _save_tuning_cache.pending = False
+
+    try:
+        with open(_TUNING_CACHE_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    saved[_tuning_device()] = {
+        name: [
+            [list(key), {"kwargs": config.kwargs, "num_warps": config.num_warps, "num_stages": config.num_stages}]
+            for key, config in kernel.cache.items()
+        ]
+        for name, kernel in _tuned_kernels().items()
+    }
+
+    try:
+        os.makedirs(os.path.dirname(_TUNING_CACHE_FILE), exist_ok=True)
+        tmp_file = f"{_TUNING_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_file, _TUNING_CACHE_FILE)
+    except OSError as E:
+        from warnings import warn
+        warn(f"Cannot save triton tuning cache to {_TUNING_CACHE_FILE}.\n{E}")
+
+
+_save_tuning_cache.pending = False
+atexit.register(_save_tuning_cache)
+
+
+def _launch(kernel, grid, *args, **kwargs):
+    """
+    Launch an autotuned kernel. Configurations tuned for new keys are saved at exit.
+    """
+    _load_tuning_cache()
+    num_tuned = len(kernel.cache)
+    kernel[grid](*args, **kwargs)
+    if len(kernel.cache) != num_tuned:
+        _save_tuning_cache.pending = True
+
+
+def get_score_from_logits(logits, m, dtype, sliding_window, complement_sliding_window):
+    """
+    Per-key probability sums from the logits the forward pass stored, with m the
+    final log2-domain log-sum-exp of every row. Reads each logit once instead of
+    recomputing qk.
+    """
+    assert logits.dim() == 4
+    assert m.dim() == 3
+    assert logits.shape[:2] == m.shape[:2]
+    N_CTX = logits.size(2)
+    NKV_CTX = logits.size(3)
+    ret = torch.zeros(logits.shape[:2] + (NKV_CTX,), dtype=dtype, device=logits.device)
+    if NKV_CTX == 0:
+        return ret
+
+    if sliding_window is not None:
+        sliding_window_offset, sliding_window_size = sliding_window
+    else:
+        sliding_window_offset, sliding_window_size = None, None
+
+    grid = lambda META: (
+        triton.cdiv(NKV_CTX, META["BLOCK_N"]),
+        logits.size(0) * logits.size(1)
+    )
+    _launch(
+        _score_from_logits_kernel, grid,
+        logits, m, ret,
+        logits.stride(0), logits.stride(1), logits.stride(2), logits.stride(3),
+        ret.stride(0), ret.stride(1), ret.stride(2),
+        logits.size(1),
+        N_CTX, m.size(-1), NKV_CTX,
+        sliding_window_offset,
+        sliding_window_size,
+        _ctx_bucket(N_CTX),
+        SLIDING_WINDOW=(sliding_window is not None),
+        COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
+    )
+    return ret
+
+
 def get_score(q, k, m, sliding_window, complement_sliding_window):
     assert q.dim() == 4
     assert k.dim() == 4
@@ -358,45 +615,21 @@ def get_score(q, k, m, sliding_window, complement_sliding_window):
     )
     sm_scale = 1 / math.sqrt(q.size(-1))
 
-    global _BLOCK_N
-    global _BLOCK_M
-
-    try:
-        _score_kernel[grid](
-            q, k, m, sm_scale, ret,
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
-            ret.stride(0), ret.stride(1), ret.stride(2),
-            q.size(0), q.size(1), k.size(1),
-            N_CTX, ROUND_CTX, NKV_CTX,
-            sliding_window_offset,
-            sliding_window_size,
-            SLIDING_WINDOW=(sliding_window is not None),
-            COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
-            BLOCK_M=_BLOCK_M,
-            BLOCK_N=_BLOCK_N,
-            BLOCK_DMODEL=q.size(-1)
-        )
-    except triton.OutOfResources as E:
-        from warnings import warn
-        _BLOCK_N = _BLOCK_N // 2
-        _BLOCK_M = _BLOCK_M // 2
-        warn(f"Triton Attention Output Resources. {E}\nUse smaller block size {_BLOCK_N}.")
-        _score_kernel[grid](
-            q, k, m, sm_scale, ret,
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
-            ret.stride(0), ret.stride(1), ret.stride(2),
-            q.size(0), q.size(1), k.size(1),
-            N_CTX, ROUND_CTX, NKV_CTX,
-            sliding_window_offset,
-            sliding_window_size,
-            SLIDING_WINDOW=(sliding_window is not None),
-            COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
-            BLOCK_M=_BLOCK_M,
-            BLOCK_N=_BLOCK_N,
-            BLOCK_DMODEL=q.size(-1)
-        )
+    _launch(
+        _score_kernel, grid,
+        q, k, m, sm_scale, ret,
+        q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+        k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+        ret.stride(0), ret.stride(1), ret.stride(2),
+        q.size(0), q.size(1), k.size(1),
+        N_CTX, ROUND_CTX, NKV_CTX,
+        sliding_window_offset,
+        sliding_window_size,
+        _ctx_bucket(N_CTX),
+        SLIDING_WINDOW=(sliding_window is not None),
+        COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
+        BLOCK_DMODEL=q.size(-1)
+    )
 
     return ret
 
@@ -404,7 +637,8 @@ def _forward(
     q, k, v, sm_scale, 
     o = None, m = None, l = None, end = False, 
     sliding_window=None, init=False,
-    complement_sliding_window=False
+    complement_sliding_window=False,
+    logits=None
 ):
     Lq, Lk, Lv = q.shape[-1], k.shape[-1], v.shape[-1]
     
@@ -423,83 +657,429 @@ def _forward(
         q.shape[0] * q.shape[1],
     )
 
-    global _BLOCK_N
-    global _BLOCK_M
+    store_logits = logits is not None
+    if not store_logits:
+        # never written, any tensor will do as the pointer
+        logits = m
+        logits_strides = (0, 0, 0, 0)
+    else:
+        logits_strides = logits.stride()
+
+    _launch(
+        _attn_fwd, grid,
+        q, k, v, sm_scale, m, o, l, logits, #
+        q.stride(0), q.stride(1), q.stride(2), q.stride(3),  #
+        k.stride(0), k.stride(1), k.stride(2), k.stride(3),  #
+        v.stride(0), v.stride(1), v.stride(2), v.stride(3),  #
+        o.stride(0), o.stride(1), o.stride(2), o.stride(3),  #
+        *logits_strides,  #
+        q.shape[0], q.shape[1], k.shape[1], #
+        q.shape[2],  #
+        q_round_len,
+        k.shape[2],
+        sliding_window_offset,
+        sliding_window_size,
+        _ctx_bucket(q.shape[2]),
+        BLOCK_DMODEL=Lk,  #
+        END=end,
+        INIT=init,
+        SLIDING_WINDOW=(sliding_window is not None),
+        COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
+        STORE_LOGITS=store_logits,
+    )
 
-    try:
-        _attn_fwd[grid](
-            q, k, v, sm_scale, m, o, l, #
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),  #
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),  #
-            v.stride(0), v.stride(1), v.stride(2), v.stride(3),  #
-            o.stride(0), o.stride(1), o.stride(2), o.stride(3),  #
-            q.shape[0], q.shape[1], k.shape[1], #
-            q.shape[2],  #
-            q_round_len,
-            k.shape[2],
-            sliding_window_offset,
-            sliding_window_size,
-            BLOCK_DMODEL=Lk,  #
-            END=end,
-            INIT=init,
-            BLOCK_M=_BLOCK_M,
-            BLOCK_N=_BLOCK_N,
-            SLIDING_WINDOW=(sliding_window is not None),
-            COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
-            num_warps=4,
-            num_stages=4
+    if end:
+        o = o[:, :, :q.shape[2], :].contiguous().to(q.dtype)
+
+    return o, m, l
+
+
+
+@_autotune(
+    _FWD_CONFIGS,
+    key=["BLOCK_DMODEL", "END", "INIT", "STORE_LOGITS"] + _TUNING_KEY,
+    restore_value=["M", "Out", "L"]
+)
+@triton.jit
+def _attn_fwd_paged(
+    Q, K, V, BlockTable, sm_scale, M, Out, L, Logits,
+    stride_qz, stride_qh, stride_qm, stride_qk,
+    stride_ks, stride_kh, stride_kn, stride_kk,
+    stride_vs, stride_vh, stride_vn, stride_vk,
+    stride_oz, stride_oh, stride_om, stride_on,
+    stride_lz, stride_lh, stride_lm, stride_ln,
+    stride_bz, stride_bn,
+    H, H_KV,
+    N_CTX,
+    ROUND_CTX,
+    NKV_CTX,
+    PAGE_SIZE,
+    sliding_window_offset,
+    sliding_window_size,
+    N_CTX_BUCKET,
+    BLOCK_M: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    END: tl.constexpr,
+    INIT: tl.constexpr,
+    SLIDING_WINDOW: tl.constexpr,
+    COMPLEMENT_SLIDING_WINDOW: tl.constexpr,
+    STORE_LOGITS: tl.constexpr
+):
+    # _attn_fwd with K/V read from (slot, head, page_size, dim) pages,
+    # key n lies in page BlockTable[z, n // PAGE_SIZE]
+    start_m = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    off_hkv = off_h // (H//H_KV)
+    q_offset = off_z.to(tl.int64) * stride_qz + off_h.to(tl.int64) * stride_qh
+    o_offset = off_z.to(tl.int64) * stride_oz + off_h.to(tl.int64) * stride_oh
+    logits_offset = off_z.to(tl.int64) * stride_lz + off_h.to(tl.int64) * stride_lh
+
+    offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    m_ptrs = M + off_hz * ROUND_CTX + offs_m
+    l_ptrs = L + off_hz * ROUND_CTX + offs_m
+    o_ptrs = Out + o_offset + offs_m[:, None] * stride_om + offs_d[None, :] * stride_on
+    if INIT:
+        m_i = tl.zeros([BLOCK_M], dtype=tl.float32) - float("inf")
+        l_i = tl.zeros([BLOCK_M], dtype=tl.float32) + 1.0
+        acc = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
+    else:
+        # o, m and l have ROUND_CTX rows, no boundary check needed
+        m_i = tl.load(m_ptrs).to(tl.float32)
+        l_i = tl.load(l_ptrs).to(tl.float32)
+        acc = tl.load(o_ptrs).to(tl.float32)
+
+    qk_scale = sm_scale
+    qk_scale *= 1.4426950408889634   # 1/log(2)
+    q = tl.load(
+        Q + q_offset + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qk,
+        mask=(offs_m < N_CTX)[:, None], other=0.
+    )
+
+    for start_n in range(0, NKV_CTX, BLOCK_N):
+        offs_n = start_n + tl.arange(0, BLOCK_N)
+        mask_n = offs_n < NKV_CTX
+        slot = tl.load(
+            BlockTable + off_z.to(tl.int64) * stride_bz + (offs_n // PAGE_SIZE) * stride_bn,
+            mask=mask_n, other=0
+        ).to(tl.int64)
+        k_rows = slot * stride_ks + off_hkv.to(tl.int64) * stride_kh + (offs_n % PAGE_SIZE) * stride_kn
+        v_rows = slot * stride_vs + off_hkv.to(tl.int64) * stride_vh + (offs_n % PAGE_SIZE) * stride_vn
+        k = tl.load(K + k_rows[None, :] + offs_d[:, None] * stride_kk, mask=mask_n[None, :], other=0.)
+
+        qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
+        qk += tl.dot(q, k)
+        qk = qk * qk_scale
+        qk = tl.where(mask_n[None, :], qk, float("-inf"))
+        if SLIDING_WINDOW:
+            dist = offs_m[:, None] - offs_n[None, :] + sliding_window_offset
+            if COMPLEMENT_SLIDING_WINDOW:
+                mask = (dist >= sliding_window_size)
+            else:
+                mask = (dist >= 0) & (dist < sliding_window_size)
+            qk = tl.where(mask, qk, float("-inf"))
+
+        if STORE_LOGITS:
+            tl.store(
+                Logits + logits_offset + offs_m[:, None] * stride_lm + offs_n[None, :] * stride_ln, qk,
+                mask=(offs_m < N_CTX)[:, None] & mask_n[None, :]
+            )
+
+        m_ij = tl.maximum(m_i, tl.max(qk, 1))
+        # rows without any visible key so far keep m = -inf and l = 1
+        m_safe = tl.where(m_ij == float("-inf"), 0., m_ij)
+        p = tl.math.exp2(qk - m_safe[:, None])
+        alpha = tl.where(m_i == m_ij, 1., tl.math.exp2(m_i - m_safe))
+        l_i = l_i * alpha + tl.sum(p, 1)
+        acc = acc * alpha[:, None]
+        v = tl.load(V + v_rows[:, None] + offs_d[None, :] * stride_vk, mask=mask_n[:, None], other=0.)
+        acc += tl.dot(p.to(v.dtype), v)
+        m_i = m_ij
+
+    if (END):
+        m_i += tl.math.log2(l_i)
+        acc = acc / l_i[:, None]
+    else:
+        tl.store(l_ptrs, l_i)
+
+    tl.store(m_ptrs, m_i)
+    tl.store(o_ptrs, acc.to(Out.type.element_ty))
+
+
+def _paged_forward(
+    q, k_cache, v_cache, block_table, sm_scale,
+    o, m, l, end=False,
+    sliding_window=None, init=False,
+    complement_sliding_window=False,
+    logits=None
+):
+    """
+    `_forward` on keys stored as pages of a paged cache.
+
+    k_cache, v_cache - (num_slots, num_heads_kv, page_size, dim_head)
+    block_table      - (batch, num_pages) slots of the pages, in key order
+    """
+    Lk = k_cache.shape[-1]
+    assert Lk in {16, 32, 64, 128}
+    page_size = k_cache.size(2)
+    q_round_len = math.ceil(q.shape[2] / 64) * 64
+
+    if sliding_window is not None:
+        sliding_window_offset, sliding_window_size = sliding_window
+    else:
+        sliding_window_offset, sliding_window_size = None, None
+
+    grid = lambda META: (
+        triton.cdiv(q.shape[2], META["BLOCK_M"]),
+        q.shape[0] * q.shape[1],
+    )
+
+    store_logits = logits is not None
+    if not store_logits:
+        # never written, any tensor will do as the pointer
+        logits = m
+        logits_strides = (0, 0, 0, 0)
+    else:
+        logits_strides = logits.stride()
+
+    _launch(
+        _attn_fwd_paged, grid,
+        q, k_cache, v_cache, block_table, sm_scale, m, o, l, logits,
+        q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+        k_cache.stride(0), k_cache.stride(1), k_cache.stride(2), k_cache.stride(3),
+        v_cache.stride(0), v_cache.stride(1), v_cache.stride(2), v_cache.stride(3),
+        o.stride(0), o.stride(1), o.stride(2), o.stride(3),
+        *logits_strides,
+        block_table.stride(0), block_table.stride(1),
+        q.shape[1], k_cache.shape[1],
+        q.shape[2],
+        q_round_len,
+        block_table.size(1) * page_size,
+        page_size,
+        sliding_window_offset,
+        sliding_window_size,
+        _ctx_bucket(q.shape[2]),
+        BLOCK_DMODEL=Lk,
+        END=end,
+        INIT=init,
+        SLIDING_WINDOW=(sliding_window is not None),
+        COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
+        STORE_LOGITS=store_logits,
+    )
+
+    if end:
+        o = o[:, :, :q.shape[2], :].contiguous().to(q.dtype)
+
+    return o, m, l
+
+
+@triton.jit
+def _attn_decode_split(
+    Q, K, V, BlockTable, sm_scale, PartO, PartM, PartL, Logits,
+    stride_qz, stride_qh, stride_qk,
+    stride_kz, stride_kh, stride_kn, stride_kk,
+    stride_vz, stride_vh, stride_vk, stride_vn,
+    stride_lz, stride_lh, stride_ln,
+    stride_bz, stride_bn,
+    H, H_KV,
+    KV_START, KV_END,
+    NUM_SPLITS,
+    PAGE_SIZE,
+    SPLIT_SIZE: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    STORE_LOGITS: tl.constexpr,
+    PAGED: tl.constexpr,
+):
+    # one program per (split, head), a single query row attending to keys
+    # [KV_START + split * SPLIT_SIZE, ...) without any padded query rows.
+    # If PAGED, K/V are (slot, head, page_size, dim) pages and key n lies in
+    # page BlockTable[z, n // PAGE_SIZE], stride_kz/stride_vz being the slot strides.
+    off_s = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    off_hkv = off_h // (H//H_KV)
+    q_offset = off_z.to(tl.int64) * stride_qz + off_h.to(tl.int64) * stride_qh
+    k_offset = off_hkv.to(tl.int64) * stride_kh
+    v_offset = off_hkv.to(tl.int64) * stride_vh
+    if not PAGED:
+        k_offset += off_z.to(tl.int64) * stride_kz
+        v_offset += off_z.to(tl.int64) * stride_vz
+    logits_offset = off_z.to(tl.int64) * stride_lz + off_h.to(tl.int64) * stride_lh
+
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    qk_scale = sm_scale
+    qk_scale *= 1.4426950408889634   # 1/log(2)
+    q = tl.load(Q + q_offset + offs_d * stride_qk).to(tl.float32)
+
+    lo = KV_START + off_s * SPLIT_SIZE
+    hi = tl.minimum(lo + SPLIT_SIZE, KV_END)
+    m_i = float("-inf")
+    l_i = 0.
+    acc = tl.zeros([BLOCK_DMODEL], dtype=tl.float32)
+    for start_n in range(lo, hi, BLOCK_N):
+        offs_n = start_n + tl.arange(0, BLOCK_N)
+        mask_n = offs_n < hi
+        if PAGED:
+            slot = tl.load(
+                BlockTable + off_z.to(tl.int64) * stride_bz + (offs_n // PAGE_SIZE) * stride_bn,
+                mask=mask_n, other=0
+            ).to(tl.int64)
+            k_rows = slot * stride_kz + (offs_n % PAGE_SIZE) * stride_kn
+            v_rows = slot * stride_vz + (offs_n % PAGE_SIZE) * stride_vk
+        else:
+            k_rows = offs_n * stride_kn
+            v_rows = offs_n * stride_vk
+        k = tl.load(
+            K + k_offset + k_rows[:, None] + offs_d[None, :] * stride_kk,
+            mask=mask_n[:, None], other=0.
         )
-    except triton.OutOfResources as E:
-        _BLOCK_N = _BLOCK_N // 2
-        _BLOCK_M = _BLOCK_M // 2
-        from warnings import warn
-        warn(f"Triton Attention Output Resources. {E}\nUse smaller block size {_BLOCK_N}.")
-        _attn_fwd[grid](
-            q, k, v, sm_scale, m, o, l, #
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),  #
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),  #
-            v.stride(0), v.stride(1), v.stride(2), v.stride(3),  #
-            o.stride(0), o.stride(1), o.stride(2), o.stride(3),  #
-            q.shape[0], q.shape[1], k.shape[1], #
-            q.shape[2],  #
-            q_round_len,
-            k.shape[2],
-            sliding_window_offset,
-            sliding_window_size,
-            BLOCK_DMODEL=Lk,  #
-            END=end,
-            INIT=init,
-            BLOCK_M=_BLOCK_M,
-            BLOCK_N=_BLOCK_N,
-            SLIDING_WINDOW=(sliding_window is not None),
-            COMPLEMENT_SLIDING_WINDOW=complement_sliding_window,
+        qk = tl.sum(k.to(tl.float32) * q[None, :], axis=1) * qk_scale
+        qk = tl.where(mask_n, qk, float("-inf"))
+        if STORE_LOGITS:
+            tl.store(Logits + logits_offset + offs_n * stride_ln, qk, mask=mask_n)
+
+        # the first key of every tile is valid, so m_ij is finite
+        m_ij = tl.maximum(m_i, tl.max(qk, 0))
+        p = tl.math.exp2(qk - m_ij)
+        alpha = tl.math.exp2(m_i - m_ij)
+        v = tl.load(
+            V + v_offset + v_rows[:, None] + offs_d[None, :] * stride_vn,
+            mask=mask_n[:, None], other=0.
+        )
+        l_i = l_i * alpha + tl.sum(p, 0)
+        acc = acc * alpha + tl.sum(p[:, None] * v.to(tl.float32), 0)
+        m_i = m_ij
+
+    part_offset = off_hz.to(tl.int64) * NUM_SPLITS + off_s
+    tl.store(PartM + part_offset, m_i)
+    tl.store(PartL + part_offset, l_i)
+    tl.store(PartO + part_offset * BLOCK_DMODEL + offs_d, acc)
+
+
+def _decode_forward(
+    q, k, v, sm_scale,
+    o, m, l, part_buffer, end=False,
+    sliding_window=None, init=False,
+    complement_sliding_window=False,
+    logits=None, block_table=None
+):
+    """
+    `_forward` for a single query row. The visible keys are split across many
+    programs per head and the partial results are merged by log-sum-exp into row 0
+    of o, m and l, keeping the same multi-stage state as `_forward`.
+
+    With a block_table, k and v are (num_slots, num_heads_kv, page_size, dim_head)
+    pages, see `_paged_forward`.
+    """
+    assert q.size(2) == 1
+    Lk = k.shape[-1]
+    assert Lk in {16, 32, 64, 128}
+    batch_size, num_heads = q.shape[:2]
+
+    paged = block_table is not None
+    if paged:
+        page_size = k.size(2)
+        len_k = block_table.size(1) * page_size
+    else:
+        # never read, any tensor will do as the pointer
+        block_table, page_size = q, 1
+        len_k = k.size(2)
+
+    # range of keys the single query can see
+    kv_start, kv_end = 0, len_k
+    if sliding_window is not None:
+        sliding_window_offset, sliding_window_size = sliding_window
+        if complement_sliding_window:
+            kv_end = min(kv_end, max(sliding_window_offset - sliding_window_size + 1, 0))
+        else:
+            kv_start = max(sliding_window_offset - sliding_window_size + 1, 0)
+            kv_end = min(kv_end, max(sliding_window_offset + 1, 0))
+
+    num_splits = max(triton.cdiv(kv_end - kv_start, _DECODE_SPLIT_SIZE), 0)
+    part_o = part_buffer("part_o", (batch_size, num_heads, num_splits, Lk), torch.float32)
+    part_m = part_buffer("part_m", (batch_size, num_heads, num_splits), torch.float32)
+    part_l = part_buffer("part_l", (batch_size, num_heads, num_splits), torch.float32)
+
+    if num_splits > 0:
+        if logits is None:
+            # never written, any tensor will do as the pointer
+            logits_ptr, logits_strides = part_m, (0, 0, 0)
+        else:
+            logits_ptr, logits_strides = logits, (logits.stride(0), logits.stride(1), logits.stride(3))
+
+        _attn_decode_split[(num_splits, batch_size * num_heads)](
+            q, k, v, block_table, sm_scale, part_o, part_m, part_l, logits_ptr,
+            q.stride(0), q.stride(1), q.stride(3),
+            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+            *logits_strides,
+            block_table.stride(0) if paged else 0, block_table.stride(-1) if paged else 0,
+            num_heads, k.size(1),
+            kv_start, kv_end,
+            num_splits,
+            page_size,
+            SPLIT_SIZE=_DECODE_SPLIT_SIZE,
+            BLOCK_DMODEL=Lk,
+            BLOCK_N=_DECODE_BLOCK_N,
+            STORE_LOGITS=(logits is not None),
+            PAGED=paged,
             num_warps=4,
-            num_stages=4
         )
 
+    # merge the splits with the state of the previous stages, in the log2 domain
+    if init:
+        prev_m = torch.full_like(m[:, :, 0], float("-inf"))
+        prev_l = torch.zeros_like(l[:, :, 0])
+        prev_o = torch.zeros_like(o[:, :, 0, :])
+    else:
+        prev_m, prev_l, prev_o = m[:, :, 0], l[:, :, 0], o[:, :, 0, :]
+
+    m_new = prev_m
+    if num_splits > 0:
+        m_new = torch.maximum(prev_m, part_m.amax(dim=-1))
+    m_safe = torch.where(m_new == float("-inf"), 0., m_new)
+    alpha = torch.exp2(prev_m - m_safe)
+    w = torch.exp2(part_m - m_safe[..., None])
+    l_new = prev_l * alpha + (w * part_l).sum(dim=-1)
+    acc = prev_o * alpha[..., None] + (w[..., None] * part_o).sum(dim=-2)
+    # rows without any key so far keep l = 1, as in _attn_fwd
+    l_new = torch.where(m_new == float("-inf"), 1., l_new)
 
     if end:
-        o = o[:, :, :q.shape[2], :].contiguous().to(q.dtype)
+        m[:, :, 0] = m_new + torch.log2(l_new)
+        o[:, :, 0, :] = acc / l_new[..., None]
+        return o[:, :, :1, :].contiguous().to(q.dtype), m, l
 
+    m[:, :, 0] = m_new
+    l[:, :, 0] = l_new
+    o[:, :, 0, :] = acc
     return o, m, l
 
 
-
 class TritonMultiStageDotProductionAttention(MultiStageDotProductionAttention):
-    def __init__(self, q_shape, dtype, device):
+    def __init__(self, q_shape, dtype, device, workspace=None):
         self.q_shape = q_shape
         self.dtype = dtype
         self.device = device
+        self.workspace = workspace
         q_round_len = math.ceil(q_shape[2] / 64) * 64
         o_shape = (q_shape[0], q_shape[1], q_round_len, q_shape[3])
         m_shape = (q_shape[0], q_shape[1], q_round_len)
         l_shape = (q_shape[0], q_shape[1], q_round_len)
 
-        self.o = torch.empty(o_shape, device=device, dtype=torch.float32)
-        self.m = torch.empty(m_shape, device=device, dtype=torch.float32)
-        self.l = torch.empty(l_shape, device=device, dtype=torch.float32)
+        # the first stage initializes o, m and l in the kernel
+        self.o = self._buffer("o", o_shape, torch.float32)
+        self.m = self._buffer("m", m_shape, torch.float32)
+        self.l = self._buffer("l", l_shape, torch.float32)
         self.q_list = []
         self.k_list = []
+        self.logits_list = []
+        self.logits_bytes = 0
         self.sliding_window_list = []
         self.complement_sliding_window_list = []
         self.score_list = []
@@ -508,38 +1088,42 @@ class TritonMultiStageDotProductionAttention(MultiStageDotProductionAttention):
 
     def finalize(self):
         self.end = True
-        for q, k, sliding_window, comp in zip(self.q_list, self.k_list, self.sliding_window_list, self.complement_sliding_window_list):
-            if q is not None:
+        for q, k, logits, sliding_window, comp in zip(
+            self.q_list, self.k_list, self.logits_list,
+            self.sliding_window_list, self.complement_sliding_window_list
+        ):
+            if logits is not None:
+                score = get_score_from_logits(logits, self.m, q.dtype, sliding_window, comp)
+                self.score_list.append(score)
+            elif q is not None:
                 score = get_score(q, k, self.m, sliding_window, comp)
                 self.score_list.append(score)
             else:
                 self.score_list.append(None)
 
+        self.logits_list = []
         self.ret = self.o
 
 
-    def append(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, end=False, get_score=False, sliding_window = None, complement_sliding_window: bool = False):
-        assert q.shape == self.q_shape
+    def _logits_buffer(self, q, len_k, get_score):
+        # keep the logits for the score pass while they fit in _LOGITS_CACHE_BYTES,
+        # so that qk is computed only once
+        logits_shape = (q.size(0), q.size(1), q.size(2), len_k)
+        nbytes = math.prod(logits_shape) * 4
+        if get_score and self.logits_bytes + nbytes <= _LOGITS_CACHE_BYTES:
+            self.logits_bytes += nbytes
+            # the score pass only reads what the forward pass wrote
+            return torch.empty(logits_shape, dtype=torch.float32, device=q.device)
 
-        if isinstance(sliding_window, int):
-            sliding_window = (
-                k.shape[2] - q.shape[2], sliding_window
-            )
+        return None
 
-        q = q.contiguous()
-        k = k.contiguous()
-        v = v.contiguous()
-        
-        sm_scale = 1 / math.sqrt(q.shape[-1])
-        o, m, l = _forward(
-            q, k, v, sm_scale, self.o, self.m, self.l, 
-            sliding_window=sliding_window, end=end, init=not self.init, 
-            complement_sliding_window=complement_sliding_window
-        )
+
+    def _finish_stage(self, o, m, l, q, k, logits, end, get_score, sliding_window, complement_sliding_window):
         self.init = True
         self.o = o
         self.m = m
         self.l = l
+        self.logits_list.append(logits)
         if get_score:
             self.q_list.append(q)
             self.k_list.append(k)
@@ -554,3 +1138,80 @@ class TritonMultiStageDotProductionAttention(MultiStageDotProductionAttention):
         if end:
             assert not self.end 
             self.finalize()
+
+
+    def append(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, end=False, get_score=False, sliding_window = None, complement_sliding_window: bool = False):
+        assert q.shape == self.q_shape
+
+        if isinstance(sliding_window, int):
+            sliding_window = (
+                k.shape[2] - q.shape[2], sliding_window
+            )
+
+        q = q.contiguous()
+        k = k.contiguous()
+        v = v.contiguous()
+        
+        sm_scale = 1 / math.sqrt(q.shape[-1])
+        logits = self._logits_buffer(q, k.size(2), get_score)
+
+        if q.size(2) == 1:
+            o, m, l = _decode_forward(
+                q, k, v, sm_scale, self.o, self.m, self.l, self._buffer,
+                sliding_window=sliding_window, end=end, init=not self.init,
+                complement_sliding_window=complement_sliding_window,
+                logits=logits
+            )
+        else:
+            o, m, l = _forward(
+                q, k, v, sm_scale, self.o, self.m, self.l, 
+                sliding_window=sliding_window, end=end, init=not self.init, 
+                complement_sliding_window=complement_sliding_window,
+                logits=logits
+            )
+
+        self._finish_stage(o, m, l, q, k, logits, end, get_score, sliding_window, complement_sliding_window)
+
+
+    def append_paged(
+        self, q: torch.Tensor, k_cache: torch.Tensor, v_cache: torch.Tensor, block_table: torch.Tensor,
+        sliding_window=None, complement_sliding_window: bool = False,
+        end=False, get_score=False
+    ):
+        assert q.shape == self.q_shape
+        assert k_cache.stride(-1) == 1 and v_cache.stride(-1) == 1
+        len_k = block_table.size(1) * k_cache.size(2)
+
+        if isinstance(sliding_window, int):
+            sliding_window = (
+                len_k - q.shape[2], sliding_window
+            )
+
+        q = q.contiguous()
+        block_table = block_table.contiguous()
+        sm_scale = 1 / math.sqrt(q.shape[-1])
+        logits = self._logits_buffer(q, len_k, get_score)
+
+        if q.size(2) == 1:
+            o, m, l = _decode_forward(
+                q, k_cache, v_cache, sm_scale, self.o, self.m, self.l, self._buffer,
+                sliding_window=sliding_window, end=end, init=not self.init,
+                complement_sliding_window=complement_sliding_window,
+                logits=logits, block_table=block_table
+            )
+        else:
+            o, m, l = _paged_forward(
+                q, k_cache, v_cache, block_table, sm_scale, self.o, self.m, self.l,
+                sliding_window=sliding_window, end=end, init=not self.init,
+                complement_sliding_window=complement_sliding_window,
+                logits=logits
+            )
+
+        k = None
+        if get_score and logits is None:
+            # the score pass recomputes qk on contiguous keys
+            k = k_cache[block_table].transpose(1, 2).reshape(
+                q.size(0), k_cache.size(1), len_k, k_cache.size(-1)
+            )
+
+        self._finish_stage(o, m, l, q, k, logits, end, get_score, sliding_window, complement_sliding_window)
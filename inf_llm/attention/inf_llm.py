@@ -1,9 +1,11 @@
 import torch
 from typing import Optional
 from .context_manager import ContextManager
-from .context_manager_listener import file_listener
+from .context_manager_listener import trace_listener
+from .cache_stats import register_context_manager
 
-DEBUG = True
+# with DEBUG on, cache events are traced to logs/cache_trace.bin unless trace_file is given
+DEBUG = False
 
 def inf_llm_forward(
     n_local, n_init, topk, 
@@ -17,9 +19,32 @@ def inf_llm_forward(
     pin_memory=False,
     faiss=False,
     perhead=False,
+    topk_min=None,
+    topk_mass=None,
+    expected_length=None,
+    static_decode=False,
+    local_score_horizon=None,
+    absolute_local_rope=False,
+    deferred_block_load=True,
+    track_churn=False,
     model=None,
+    trace_file=None,
     *args, **kwargs
 ):
+    if DEBUG and trace_file is None:
+        trace_file = 'logs/cache_trace.bin'
+
+    if model is None:
+        # the trace is shared by the layers of a model
+        trace_file = None
+    else:
+        # what a session costs before it starts, see check_memory_budget
+        model.inf_llm_config = dict(
+            n_init=n_init, n_local=n_local, block_size=block_size,
+            max_cached_block=max_cached_block, exc_block_size=exc_block_size,
+            expected_length=expected_length, absolute_local_rope=absolute_local_rope,
+            faiss=faiss,
+        )
 
     def forward(self, query : torch.Tensor,
                     key_value : torch.Tensor,
@@ -59,8 +84,25 @@ def inf_llm_forward(
                 pin_memory,
                 faiss,
                 perhead,
-                listeners=[file_listener(f'logs/cache{self.layer_idx}.log', model)] if DEBUG else None,
-            )            
+                listeners=[trace_listener(trace_file, model).listener(self.layer_idx)] if trace_file is not None else None,
+                topk_min=topk_min,
+                topk_mass=topk_mass,
+                expected_length=expected_length,
+                static_decode=static_decode,
+                local_score_horizon=local_score_horizon,
+                absolute_local_rope=absolute_local_rope,
+                deferred_block_load=deferred_block_load,
+                track_churn=track_churn,
+                layer_idx=self.layer_idx,
+            )
+            if model is not None:
+                register_context_manager(model, self.layer_idx, past_key_value)
+
+        if model is not None:
+            # set by enable_stage_profiler, can change between calls
+            past_key_value.profiler = getattr(model, 'stage_profiler', None)
+            # set by model_memory_report
+            past_key_value.track_memory_peak = getattr(model, 'track_memory_peak', False)
 
         local_q, local_k, local_v = h_q, h_k, h_v
         global_q, global_k, global_v = h_q, h_k, h_v
@@ -1,5 +1,45 @@
 import torch
 from typing import Optional
+from .dot_production_attention import get_workspace_pool
+from .dot_production_attention.torch_impl import sliding_window_mask, TorchMultiStageDotProductionAttention
+
+# queries attended at a time by the torch implementation, which bounds its memory
+# to O(_Q_CHUNK_SIZE * _KV_CHUNK_SIZE) per head
+_Q_CHUNK_SIZE = 1024
+
+
+class FullKVCache:
+    """
+    KV cache of full attention. Keys and values are appended into preallocated
+    buffers which grow geometrically, so a step only copies its new tokens.
+    """
+    def __init__(self):
+        self.length = 0
+        self.k = None
+        self.v = None
+
+    def append(self, k: torch.Tensor, v: torch.Tensor):
+        """
+        Appends k, v (batch, num_heads_kv, num_new, dim_head) and returns views of all cached keys and values.
+        """
+        num_new = k.size(-2)
+        if self.k is None or self.length + num_new > self.k.size(-2):
+            capacity = self.length + num_new
+            if self.k is not None:
+                capacity = max(capacity, 2 * self.k.size(-2))
+
+            for name, x in (("k", k), ("v", v)):
+                old = getattr(self, name)
+                new = x.new_empty(x.shape[:2] + (capacity, x.size(-1)))
+                if old is not None:
+                    new[:, :, :self.length].copy_(old[:, :, :self.length])
+                setattr(self, name, new)
+
+        self.k[:, :, self.length:self.length + num_new].copy_(k)
+        self.v[:, :, self.length:self.length + num_new].copy_(v)
+        self.length += num_new
+        return self.k[:, :, :self.length], self.v[:, :, :self.length]
+
 
 def origin_forward(fattn: bool, *args, **kwargs):
     def forward(self, query : torch.Tensor,
@@ -23,51 +63,64 @@ def origin_forward(fattn: bool, *args, **kwargs):
 
 
         h_q = h_q.view(batch_size, len_q, num_heads, dim_head).permute(0, 2, 1, 3).contiguous()   # (batch, num_heads, len_q, dim_head)
-        h_k = h_k.view(batch_size, len_k, num_heads_kv, dim_head).permute(0, 2, 1, 3).contiguous()   # (batch, num_heads_kv, len_k, dim_head)
-        h_v = h_v.view(batch_size, len_k, num_heads_kv, dim_head).permute(0, 2, 1, 3).contiguous()   # (batch, num_heads_kv, len_k, dim_head)
+        h_k = h_k.view(batch_size, len_k, num_heads_kv, dim_head).permute(0, 2, 1, 3)   # (batch, num_heads_kv, len_k, dim_head)
+        h_v = h_v.view(batch_size, len_k, num_heads_kv, dim_head).permute(0, 2, 1, 3)   # (batch, num_heads_kv, len_k, dim_head)
+
 
+        if past_key_value is None:
+            past_key_value = FullKVCache()
 
-        if past_key_value is not None:
-            h_k = torch.cat((past_key_value[0], h_k), dim=-2)
-            h_v = torch.cat((past_key_value[1], h_v), dim=-2)
-            len_k = h_k.size(-2)
+        h_k, h_v = past_key_value.append(h_k, h_v)
+        len_k = past_key_value.length
 
         if use_cache:
-            current_key_value = h_k, h_v
+            current_key_value = past_key_value
 
         h_q, h_k = position_bias(h_q, h_k)
 
-        if fattn:
+        if fattn == "sdpa":
+            # fold the query heads of a group into rows, so that grouped k/v are never expanded
+            num_group = num_heads // num_heads_kv
+            o = torch.empty_like(h_q)
+            for st in range(0, len_q, _Q_CHUNK_SIZE):
+                ed = min(st + _Q_CHUNK_SIZE, len_q)
+                kv_ed = len_k - len_q + ed
+                attention_mask = None
+                if ed - st > 1:
+                    # causal mask over the keys of the chunk, i.e. the complement of an empty sliding window
+                    attention_mask = sliding_window_mask(
+                        ed - st, kv_ed, kv_ed - (ed - st), 0, True, h_q.device
+                    ).repeat(num_group, 1)
+                o[:, :, st:ed, :].copy_(torch.nn.functional.scaled_dot_product_attention(
+                    h_q[:, :, st:ed, :].reshape(batch_size, num_heads_kv, num_group * (ed - st), dim_head),
+                    h_k[:, :, :kv_ed, :], h_v[:, :, :kv_ed, :],
+                    attn_mask=attention_mask
+                ).view(batch_size, num_heads, ed - st, dim_head))
+            o = o.permute(0, 2, 1, 3)
+        elif fattn:
             from flash_attn.flash_attn_interface import flash_attn_func
             h_q = h_q.transpose(1, 2)
             h_k = h_k.transpose(1, 2)
             h_v = h_v.transpose(1, 2)
             o = flash_attn_func(h_q, h_k, h_v, causal=True)
         else:
-            dist = torch.arange(0, len_q, device=h_q.device)[:, None] - torch.arange(0, len_k, device=h_q.device)[None, :] + len_k - len_q
-            attention_mask = (dist >= 0)
-            score = torch.matmul(h_q, h_k.transpose(-1, -2))
-            score = torch.masked_fill(
-                score,
-                attention_mask.view(1, 1, len_q, len_k)==False,
-                torch.scalar_tensor(float("-inf"), device=score.device, dtype=score.dtype)
-            )   # (batch, num_heads, len_q, len_k)
-
-            score = torch.nn.functional.softmax(score, dim=-1)
-
-            # avoid nan in softmax
-            score = torch.masked_fill(
-                score,
-                attention_mask.view(1, 1, len_q, len_k)==False,
-                torch.scalar_tensor(0, device=score.device, dtype=score.dtype)
-            )
-            #.view(batch_size * self.num_heads, len_q, len_k) # (batch * num_heads, len_q, len_k)
-
-
-            # (batch * num_heads, len_q, len_k) @ (batch * num_heads, len_k, dim_head) = (batch * num_heads, len_q, dim_head)
-            o = torch.matmul(score, h_v)
-
-            o = o.view(batch_size, num_heads, len_q, dim_head).permute(0, 2, 1, 3)
+            # causal attention, chunked over queries here and over keys by the online softmax
+            o = torch.empty_like(h_q)
+            workspace = get_workspace_pool()
+            for st in range(0, len_q, _Q_CHUNK_SIZE):
+                ed = min(st + _Q_CHUNK_SIZE, len_q)
+                kv_ed = len_k - len_q + ed
+                attn = TorchMultiStageDotProductionAttention(
+                    (batch_size, num_heads, ed - st, dim_head), h_q.dtype, h_q.device, workspace
+                )
+                attn.append(
+                    h_q[:, :, st:ed, :], h_k[:, :, :kv_ed, :], h_v[:, :, :kv_ed, :],
+                    sliding_window=(kv_ed - (ed - st), 0), complement_sliding_window=True,
+                    end=True
+                )
+                o[:, :, st:ed, :].copy_(attn.get_result()[0])
+
+            o = o.permute(0, 2, 1, 3)
 
         o = o.reshape(batch_size, len_q, dim_head * num_heads)
         o = attention_out(o)
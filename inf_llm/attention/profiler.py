@@ -0,0 +1,135 @@
+import json
+import torch
+from time import perf_counter
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    """
+    Opt-in timer of the stages of ContextManager.append (rope, local_attention, topk,
+    load_blocks, global_attention, score_update, append_global, static_decode).
+
+    Stages on cuda are timed with CUDA events recorded on the stream they run on, so
+    the timeline shows how GLOBAL_STREAM overlaps the default stream. Stages on CPU
+    are timed with perf_counter. Events are only resolved, i.e. synchronized, when
+    the results are read.
+    """
+    def __init__(self):
+        self.records = []
+        self._cpu_origin = perf_counter()
+        # device -> (event, perf_counter time) the cuda timestamps of the device are relative to
+        self._cuda_origin = {}
+
+    @contextmanager
+    def stage(self, layer, name: str, device: torch.device):
+        if device.type != "cuda":
+            st = perf_counter()
+            try:
+                yield
+            finally:
+                self.records.append((layer, name, device, None, st, perf_counter()))
+            return
+
+        stream = torch.cuda.current_stream(device)
+        if device not in self._cuda_origin:
+            origin = torch.cuda.Event(enable_timing=True)
+            origin.record(stream)
+            self._cuda_origin[device] = (origin, perf_counter())
+
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record(stream)
+        try:
+            yield
+        finally:
+            end.record(stream)
+            self.records.append((layer, name, device, stream, start, end))
+
+    def clear(self):
+        self.records = []
+
+    def _resolve(self):
+        """
+        (layer, stage, device, stream, start_us, duration_us) of every record, start
+        relative to the creation of the profiler.
+        """
+        if len(self._cuda_origin) > 0:
+            torch.cuda.synchronize()
+
+        ret = []
+        for layer, name, device, stream, start, end in self.records:
+            if stream is None:
+                st = (start - self._cpu_origin) * 1e6
+                dur = (end - start) * 1e6
+            else:
+                origin, origin_time = self._cuda_origin[device]
+                st = (origin_time - self._cpu_origin) * 1e6 + origin.elapsed_time(start) * 1e3
+                dur = start.elapsed_time(end) * 1e3
+            ret.append((layer, name, device, stream, st, dur))
+
+        return ret
+
+    def summary(self) -> dict:
+        """
+        {layer: {stage: {"count", "total_ms", "mean_ms"}}}, with the sum over layers under "total".
+        """
+        ret = {}
+        for layer, name, _, _, _, dur in self._resolve():
+            for key in (layer, "total"):
+                stage = ret.setdefault(key, {}).setdefault(name, {"count": 0, "total_ms": 0.})
+                stage["count"] += 1
+                stage["total_ms"] += dur / 1e3
+
+        for stages in ret.values():
+            for stage in stages.values():
+                stage["mean_ms"] = stage["total_ms"] / stage["count"]
+
+        return ret
+
+    def chrome_trace(self) -> dict:
+        """
+        The records as a Chrome trace / Perfetto timeline: one process per device,
+        one thread per stream, one complete event per stage.
+        """
+        from . import context_manager
+        pids, tids = {}, {}
+        events = []
+        for layer, name, device, stream, st, dur in self._resolve():
+            pid = pids.setdefault(str(device), len(pids))
+            if stream is None:
+                thread = "host"
+            elif stream == torch.cuda.default_stream(device):
+                thread = "default stream"
+            elif stream == context_manager.GLOBAL_STREAM:
+                thread = "global stream"
+            else:
+                thread = f"stream {stream.cuda_stream:#x}"
+            tid = tids.setdefault((pid, thread), len(tids))
+            events.append({
+                "name": name, "cat": f"layer {layer}", "ph": "X",
+                "ts": st, "dur": dur, "pid": pid, "tid": tid,
+                "args": {"layer": layer},
+            })
+
+        for device, pid in pids.items():
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": device}})
+        for (pid, thread), tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, filename: str) -> None:
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def enable_stage_profiler(model) -> StageProfiler:
+    """
+    Profiles the ContextManagers of `model` from its next forward on.
+    """
+    model.stage_profiler = StageProfiler()
+    return model.stage_profiler
+
+
+def disable_stage_profiler(model) -> None:
+    model.stage_profiler = None
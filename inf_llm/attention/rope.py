@@ -1,6 +1,68 @@
 import torch
 from typing import Union, Tuple
 
+
+def _rotate_reference(x, cos, sin):
+    x1, x2 = x.float().chunk(2, dim=-1)
+    cos = cos.float()
+    sin = sin.float()
+    return torch.cat((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1).to(x.dtype)
+
+
+def _torch_rotary_forward(x, cos, sin, start, step, out):
+    length = x.size(-2)
+    if step == 0:
+        cos, sin = cos[start:start + 1], sin[start:start + 1]
+    else:
+        cos, sin = cos[start:start + length], sin[start:start + length]
+
+    ret = None
+    if _get_rotary_fn.compiled is None:
+        _get_rotary_fn.compiled = False
+        if hasattr(torch, "compile"):
+            _get_rotary_fn.compiled = torch.compile(_rotate_reference, dynamic=True)
+
+    if _get_rotary_fn.compiled:
+        try:
+            ret = _get_rotary_fn.compiled(x, cos, sin)
+        except Exception as E:
+            # no working compiler backend, e.g. a host without a c++ toolchain
+            _get_rotary_fn.compiled = False
+            from warnings import warn
+            warn(f"Compile rotary embedding error. Use eager torch impl.\n{E}")
+
+    if ret is None:
+        ret = _rotate_reference(x, cos, sin)
+
+    return ret if out is None else out.copy_(ret)
+
+
+def _get_rotary_fn(device):
+    """
+    Fused rotation fn(x, cos, sin, start, step, out) for tensors on `device`: the
+    Triton kernel on cuda, otherwise `_rotate_reference` compiled with `torch.compile`
+    when it works, eager if not.
+    """
+    if device.type == "cuda" and _get_rotary_fn.triton is not False:
+        if _get_rotary_fn.triton is None:
+            try:
+                from .rope_triton import rotary_forward
+                _get_rotary_fn.triton = rotary_forward
+            except Exception as E:
+                _get_rotary_fn.triton = False
+                from warnings import warn
+                warn(f"Load triton rotary embedding error. Use torch impl.\n{E}")
+
+        if _get_rotary_fn.triton:
+            return _get_rotary_fn.triton
+
+    return _torch_rotary_forward
+
+
+_get_rotary_fn.triton = None
+_get_rotary_fn.compiled = None
+
+
 class RotaryEmbeddingESM(torch.nn.Module):
     """
     Rotary position embeddings based on those in
@@ -27,6 +89,8 @@ class RotaryEmbeddingESM(torch.nn.Module):
         self._seq_len_cached = -1
         self._cos_cached = None
         self._sin_cached = None
+        # device -> float32 (cos, sin) half tables of shape (length, dim // 2) used by `rotate`
+        self._rotary_tables = {}
 
     def rotate_half(self, x):
         x1, x2 = x.chunk(2, dim=-1)
@@ -91,28 +155,58 @@ class RotaryEmbeddingESM(torch.nn.Module):
 
         return self._cos_cached, self._sin_cached
 
+    def _get_rotary_tables(self, length, device):
+        """
+        float32 cos/sin tables of at least `length` positions, shared by every rotation
+        on `device`. The two halves of a rotary table are equal, so only one is kept.
+        Tables grow to the next power of two, hence are rebuilt O(log(length)) times.
+        """
+        key = torch.device(device)
+        tables = self._rotary_tables.get(key)
+        if tables is None or tables[0].size(0) < length:
+            size = max(1 << (length - 1).bit_length(), 64)
+            t = torch.arange(size, device=device, dtype=torch.float32)
+            freqs = torch.outer(t * self.distance_scale, self.inv_freq.to(device))
+            tables = (freqs.cos(), freqs.sin())
+            self._rotary_tables[key] = tables
+
+        return tables
+
+    def rotate(self, x: torch.Tensor, start: int, step: int = 1, out: torch.Tensor = None):
+        """
+        Rotate x (..., length, dim), token i at position start + i * step, in one fused pass.
+        step = 0 rotates all tokens at the same angle. out may be x to rotate in place.
+        """
+        length = x.size(-2)
+        if length == 0:
+            return x.clone() if out is None else out
+
+        if x.dim() > 4 or x.stride(-1) != 1 or (out is not None and (out.dim() > 4 or out.stride(-1) != 1)):
+            ret = self.rotate(x.reshape(-1, length, x.size(-1)).contiguous(), start, step).view(x.shape)
+            return ret if out is None else out.copy_(ret)
+
+        cos, sin = self._get_rotary_tables(start + (length - 1) * step + 1, x.device)
+        return _get_rotary_fn(x.device)(x, cos, sin, start, step, out)
+
     def apply_rotary_pos_emb_one_angle(
         self, x: torch.Tensor, index
     ):
-        dtype = x.dtype
-        cos, sin = self._update_cos_sin_tables_len(index, x.device)
-        if cos.dim() == 2:
-            cos = cos[index-1:index, :]
-            sin = sin[index-1:index, :]
-        elif cos.dim() == 3:
-            cos = cos[:, index-1:index, :]
-            sin = sin[:, index-1:index, :]
-        elif  cos.dim() == 4:
-            cos = cos[:, :, index-1:index, :]
-            sin = sin[:, :, index-1:index, :]
+        return self.rotate(x, index - 1, step=0)
 
-        cos = cos.to(x.device)
-        sin = sin.to(x.device)
 
-        return ((x.float() * cos) + (self.rotate_half(x).float() * sin)).to(dtype)
+    def apply_rotary_pos_emb_range(self, x: torch.Tensor, start: int):
+        """
+        Rotate x (..., length, dim) with positions start .. start + length - 1,
+        so that tokens can be rotated once at their own positions.
+        """
+        return self.rotate(x, start)
 
 
     def forward(self, q: torch.Tensor, k: torch.Tensor, seq_dim= -2) -> Tuple[torch.Tensor, torch.Tensor]:
+        if seq_dim in (-2, k.dim() - 2):
+            len_k = k.size(-2)
+            return self.rotate(q, len_k - q.size(-2)), self.rotate(k, 0)
+
         self._cos_cached, self._sin_cached = self._update_cos_sin_tables(k, seq_dim=seq_dim)
         return (
             self.apply_rotary_pos_emb(q, q.size(seq_dim), k.size(seq_dim), self._cos_cached, self._sin_cached),
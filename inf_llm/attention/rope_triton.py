@@ -0,0 +1,76 @@
+"""
+Fused rotary position embedding in Triton: each program rotates a tile of tokens
+with one read of x and the cos/sin half tables, and one write of the result.
+"""
+
+import torch
+import triton
+import triton.language as tl
+
+# tokens rotated by one program
+_BLOCK_L = 16
+
+
+@triton.jit
+def _rotary_kernel(
+    X, Out, Cos, Sin,
+    stride_xz, stride_xh, stride_xl,
+    stride_oz, stride_oh, stride_ol,
+    stride_cl,
+    H, L, start, step,
+    HALF: tl.constexpr,
+    BLOCK_L: tl.constexpr,
+    BLOCK_D: tl.constexpr,
+):
+    start_l = tl.program_id(0)
+    off_hz = tl.program_id(1)
+    off_z = off_hz // H
+    off_h = off_hz % H
+
+    offs_l = start_l * BLOCK_L + tl.arange(0, BLOCK_L)
+    offs_d = tl.arange(0, BLOCK_D)
+    mask = (offs_l[:, None] < L) & (offs_d[None, :] < HALF)
+    pos = start + offs_l * step
+
+    x_ptrs = X + off_z * stride_xz + off_h * stride_xh + offs_l[:, None] * stride_xl + offs_d[None, :]
+    c_offs = pos[:, None] * stride_cl + offs_d[None, :]
+    # read everything before writing, out may be x
+    x1 = tl.load(x_ptrs, mask=mask, other=0.).to(tl.float32)
+    x2 = tl.load(x_ptrs + HALF, mask=mask, other=0.).to(tl.float32)
+    cos = tl.load(Cos + c_offs, mask=mask, other=0.).to(tl.float32)
+    sin = tl.load(Sin + c_offs, mask=mask, other=0.).to(tl.float32)
+
+    o_ptrs = Out + off_z * stride_oz + off_h * stride_oh + offs_l[:, None] * stride_ol + offs_d[None, :]
+    tl.store(o_ptrs, (x1 * cos - x2 * sin).to(Out.type.element_ty), mask=mask)
+    tl.store(o_ptrs + HALF, (x2 * cos + x1 * sin).to(Out.type.element_ty), mask=mask)
+
+
+def rotary_forward(x, cos, sin, start, step, out):
+    """
+    x, out   - (..., length, dim) with at most 4 dimensions and contiguous last dimension
+    cos, sin - (table_length, dim // 2), contiguous
+    Token i is rotated at position start + i * step. out may be x, or None for a new tensor.
+    """
+    if out is None:
+        out = torch.empty(x.shape, dtype=x.dtype, device=x.device)
+
+    x4, out4 = x, out
+    while x4.dim() < 4:
+        x4 = x4.unsqueeze(0)
+        out4 = out4.unsqueeze(0)
+
+    Z, H, L, D = x4.shape
+    half = D // 2
+    grid = (triton.cdiv(L, _BLOCK_L), Z * H)
+    _rotary_kernel[grid](
+        x4, out4, cos, sin,
+        x4.stride(0), x4.stride(1), x4.stride(2),
+        out4.stride(0), out4.stride(1), out4.stride(2),
+        cos.stride(0),
+        H, L, start, step,
+        HALF=half,
+        BLOCK_L=_BLOCK_L,
+        BLOCK_D=triton.next_power_of_2(half),
+        num_warps=4,
+    )
+    return out
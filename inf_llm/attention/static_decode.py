@@ -0,0 +1,99 @@
+import math
+import torch
+from .utils import repeat_kv
+
+
+def _rotate(x, cos, sin):
+    x = x.float()
+    x1, x2 = x.chunk(2, dim=-1)
+    return x * cos + torch.cat((-x2, x1), dim=-1) * sin
+
+
+def static_decode_attention(
+    q, local_k, local_v, cos, sin,
+    global_q, cache_k, cache_v, block_slots, block_mask,
+    global_k, global_v, global_mask
+):
+    """
+    One decode step of inf-llm attention with static shapes.
+
+    q, global_q       - (batch, num_heads, 1, dim_head)
+    local_k, local_v  - (batch, num_heads_kv, n_local, dim_head), not rotated
+    cos, sin          - (n_local, dim_head) rotary tables of the local window
+    cache_k/v         - (num_slots, num_heads_kv, block_size, dim_head) cuda cache
+    block_slots       - (batch, topk) cache slots of the selected blocks, padded
+    block_mask        - (topk * block_size,) bool, valid keys of the selected blocks
+    global_k/v        - (batch, num_heads_kv, buffer_len, dim_head), the whole global buffer
+    global_mask       - (buffer_len,) bool, valid keys of the global buffer
+
+    Returns the attention output and the per-key probability sums of the local
+    and global stages, the global keys being the blocks followed by the buffer.
+    There is no data-dependent shape or control flow, so the function can be
+    compiled into one static graph.
+    """
+    batch_size, num_heads_kv = local_k.shape[:2]
+    num_group = q.size(1) // num_heads_kv
+    scale = 1 / math.sqrt(q.size(-1))
+
+    def gather(cache):
+        return cache[block_slots].transpose(1, 2).reshape(batch_size, num_heads_kv, -1, cache.size(-1))
+
+    global_k = torch.cat((gather(cache_k), global_k), dim=-2)
+    global_v = torch.cat((gather(cache_v), global_v), dim=-2)
+    global_mask = torch.cat((block_mask, global_mask), dim=-1)
+    # padded slots may hold anything, keep them out of p @ v
+    global_v = global_v.masked_fill(~global_mask[:, None], 0)
+
+    local_h_q = _rotate(q, cos[-1:, :], sin[-1:, :])
+    local_h_k = repeat_kv(_rotate(local_k, cos, sin), num_group)
+    local_h_v = repeat_kv(local_v, num_group).float()
+    global_h_k = repeat_kv(global_k, num_group).float()
+    global_h_v = repeat_kv(global_v, num_group).float()
+
+    local_logits = torch.matmul(local_h_q, local_h_k.transpose(-1, -2)) * scale
+    global_logits = torch.matmul(global_q.float(), global_h_k.transpose(-1, -2)) * scale
+    global_logits = global_logits.masked_fill(~global_mask, float("-inf"))
+
+    m = torch.maximum(
+        local_logits.amax(dim=-1, keepdim=True),
+        global_logits.amax(dim=-1, keepdim=True)
+    )
+    local_p = torch.exp(local_logits - m)
+    global_p = torch.exp(global_logits - m)
+    l = local_p.sum(dim=-1, keepdim=True) + global_p.sum(dim=-1, keepdim=True)
+    local_p = local_p / l
+    global_p = global_p / l
+
+    o = torch.matmul(local_p, local_h_v) + torch.matmul(global_p, global_h_v)
+    return o.to(q.dtype), local_p.sum(dim=-2).to(q.dtype), global_p.sum(dim=-2).to(q.dtype)
+
+
+def _compiled_static_decode_attention(*args):
+    fn = get_static_decode_attention.compiled
+    if fn is None:
+        fn = False
+        if hasattr(torch, "compile"):
+            fn = torch.compile(static_decode_attention, dynamic=False, fullgraph=True)
+        get_static_decode_attention.compiled = fn
+
+    if fn:
+        try:
+            return fn(*args)
+        except Exception as E:
+            # no working compiler backend, e.g. a host without a c++ toolchain, or a graph break
+            get_static_decode_attention.compiled = False
+            from warnings import warn
+            warn(f"Compile static decode attention error. Use eager torch impl.\n{E}")
+
+    return static_decode_attention(*args)
+
+
+def get_static_decode_attention():
+    """
+    `static_decode_attention`, compiled with `torch.compile` when it is available
+    and falling back to eager when compilation fails.
+    """
+    return _compiled_static_decode_attention
+
+
+get_static_decode_attention.compiled = None
@@ -0,0 +1,92 @@
+import torch
+
+
+class StreamingKVCache:
+    """
+    Per-layer KV cache of the stream-llm and infinite-lm baselines. These baselines
+    attend to the first n_init tokens plus a sliding window of the last n_local tokens.
+
+    Keys and values are kept in one preallocated buffer each, shaped
+    (batch, num_heads_kv, capacity, dim_head). The init tokens are pinned at the
+    start and later tokens are written right behind them. When the buffer is full,
+    the last n_local tokens are moved back behind the init tokens. The buffer has
+    room for at least 2 * n_local tokens after the init ones, so this happens at most
+    once every n_local tokens, which amortizes to one extra copy per token.
+    Attention always reads contiguous views of the buffer, and nothing is allocated
+    after the first step unless a chunk outgrows the buffer.
+    """
+    def __init__(self, n_init, n_local):
+        self.n_init = n_init
+        self.n_local = n_local
+        # number of tokens seen
+        self.length = 0
+        # buffer[:, :, :end] holds the init tokens followed by the latest tokens, in order
+        self.end = 0
+        self.k = None
+        self.v = None
+        # init keys rotated at their positions, kept once all n_init are in
+        self._rotated_init_k = None
+
+    def _capacity(self, num_new):
+        return self.n_init + max(2 * self.n_local, self.n_local + num_new)
+
+    def _make_room(self, num_new):
+        init_len = min(self.n_init, self.end)
+        keep = min(self.n_local, self.end - init_len)
+        if init_len + keep + num_new > self.k.size(-2):
+            capacity = max(2 * self.k.size(-2), self._capacity(num_new))
+            for name in ("k", "v"):
+                old = getattr(self, name)
+                new = old.new_empty(old.shape[:2] + (capacity, old.size(-1)))
+                new[:, :, :init_len].copy_(old[:, :, :init_len])
+                new[:, :, init_len:init_len + keep].copy_(old[:, :, self.end - keep:self.end])
+                setattr(self, name, new)
+        else:
+            for buffer in (self.k, self.v):
+                src = buffer[:, :, self.end - keep:self.end]
+                if self.end - keep < init_len + keep:
+                    src = src.clone()
+                buffer[:, :, init_len:init_len + keep].copy_(src)
+
+        self.end = init_len + keep
+
+    def append(self, k: torch.Tensor, v: torch.Tensor):
+        """
+        Appends k, v (batch, num_heads_kv, num_new, dim_head).
+        Returns views (init_k, init_v, local_k, local_v) of the init tokens, and of the
+        last num_new + n_local kept tokens, which end with the new ones.
+        """
+        num_new = k.size(-2)
+        if self.k is None:
+            capacity = self._capacity(num_new)
+            self.k = k.new_empty(k.shape[:2] + (capacity, k.size(-1)))
+            self.v = v.new_empty(v.shape[:2] + (capacity, v.size(-1)))
+        elif self.end + num_new > self.k.size(-2):
+            self._make_room(num_new)
+
+        self.k[:, :, self.end:self.end + num_new].copy_(k)
+        self.v[:, :, self.end:self.end + num_new].copy_(v)
+        self.end += num_new
+        self.length += num_new
+
+        init_len = min(self.n_init, self.end)
+        local_st = max(self.end - num_new - self.n_local, 0)
+        return (
+            self.k[:, :, :init_len], self.v[:, :, :init_len],
+            self.k[:, :, local_st:self.end], self.v[:, :, local_st:self.end]
+        )
+
+    def rotated_init_k(self, position_bias):
+        """
+        Init keys rotated at positions 0 .. n_init - 1. The init tokens never change once
+        n_init of them are in, so from then on they are rotated once and reused.
+        """
+        if self._rotated_init_k is not None:
+            return self._rotated_init_k
+
+        init_len = min(self.n_init, self.end)
+        init_h_k = position_bias.apply_rotary_pos_emb_range(self.k[:, :, :init_len], 0)
+        if init_len == self.n_init:
+            self._rotated_init_k = init_h_k
+
+        return init_h_k
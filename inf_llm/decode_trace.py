@@ -0,0 +1,94 @@
+"""
+Decode a binary cache-event trace written by `TraceWriter` into text, one event per line.
+
+    python -m inf_llm.decode_trace logs/cache_trace.bin --tokenizer mistralai/Mistral-7B-Instruct-v0.2
+"""
+import sys
+import argparse
+
+from inf_llm.attention.context_manager_listener import (
+    TRACE_MAGIC, TRACE_VERSION, TRACE_HEADER, TRACE_RECORD, TRACE_EVENTS
+)
+
+
+def read_trace(filename):
+    """
+    Yields (time, event, layer, unit_id, block_id, block_start, block_end) for every record.
+    """
+    with open(filename, 'rb') as f:
+        magic, version, record_size = TRACE_HEADER.unpack(f.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{filename} is not a cache trace")
+        if version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise ValueError(f"Unsupported trace version {version} with record size {record_size}")
+
+        while True:
+            data = f.read(record_size * 4096)
+            if len(data) == 0:
+                return
+
+            # a trace cut off while writing may end with a partial record
+            data = data[:len(data) // record_size * record_size]
+            for t, block_start, block_end, block_id, unit_id, layer, event in TRACE_RECORD.iter_unpack(data):
+                yield t, TRACE_EVENTS[event], layer, unit_id, block_id, block_start, block_end
+
+
+def decode_trace(filename, out, tokenizer=None, layer=None, contents=True):
+    def decode(ids):
+        if tokenizer is None:
+            return ids
+        return tokenizer.decode(
+            ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True
+        )
+
+    tokens = []
+    topk = None
+    for t, event, l, unit_id, block_id, block_start, block_end in read_trace(filename):
+        if event == 'reset':
+            tokens = []
+            continue
+
+        if event == 'token':
+            # positions arrive in order within a session
+            tokens.append(block_id)
+            continue
+
+        if layer is not None and l != layer:
+            continue
+
+        if event == 'topk':
+            # consecutive records of one selection, block_start is the rank
+            if block_start == 0:
+                topk = []
+            topk.append(block_id)
+            if len(topk) == block_end:
+                out.write(f"[{t:.3f}] l{l:02d} u{unit_id:02d} {event:>5}\n")
+                out.write(f"  ret={topk}\n")
+            continue
+
+        out.write(f"[{t:.3f}] l{l:02d} u{unit_id:02d} {event:>5} block {block_id}\n")
+        if contents and block_end > 0:
+            out.write(f"  block_contents={decode(tokens[block_start:block_end])}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str)
+    parser.add_argument("--tokenizer", type=str, default=None, help="Tokenizer path to decode block contents with, token ids are printed otherwise.")
+    parser.add_argument("--layer", type=int, default=None, help="Only print the events of this layer.")
+    parser.add_argument("--no-contents", action="store_true", help="Do not print block contents.")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    tokenizer = None
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    decode_trace(args.trace, out, tokenizer, args.layer, not args.no_contents)
+    if out is not sys.stdout:
+        out.close()
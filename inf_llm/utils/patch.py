@@ -1,5 +1,5 @@
 import torch
-from ..attention import RotaryEmbeddingESM, ATTN_FORWRAD
+from ..attention import RotaryEmbeddingESM, ATTN_FORWRAD, model_stats, model_memory_report
 
 def huggingface_forward(forward):
     def hf_forward(
@@ -72,12 +72,12 @@ def patch_hf(
             raise ValueError("You cannot specify both decoder_input_ids and decoder_inputs_embeds at the same time")
         elif input_ids is not None:
             batch_size, seq_length = input_ids.shape
-            if hasattr(model, 'input_ids'):
-                # append current input_ids to model.input_ids
-                model.input_ids = torch.cat([model.input_ids, input_ids], dim=1)
-            else:
-                # set model.input_ids to input_ids
-                model.input_ids = input_ids
+            # only recorded when a listener asked for the tokens
+            token_log = getattr(model, 'token_log', None)
+            if token_log is not None:
+                if past_key_values is None:
+                    token_log.clear()
+                token_log.append(input_ids)
         elif inputs_embeds is not None:
             batch_size, seq_length, _ = inputs_embeds.shape
         else:
@@ -176,4 +176,22 @@ def patch_hf(
     model.model._old_forward = model.model.forward
     model.model.forward = model_forward.__get__(model.model, Model)
 
+    def stats():
+        """
+        Memory unit cache telemetry of the current session, per layer and summed over layers.
+        Empty unless attn_type is inf-llm.
+        """
+        return model_stats(model)
+
+    model.stats = stats
+
+    def memory_report():
+        """
+        Bytes held by the current session per tier, per layer and summed over layers,
+        with peaks. Empty unless attn_type is inf-llm.
+        """
+        return model_memory_report(model)
+
+    model.memory_report = memory_report
+
     return model
\ No newline at end of file
@@ -0,0 +1,93 @@
+import torch
+
+from inf_llm.attention.cache_stats import CacheStats, register_context_manager, model_stats, to_prometheus
+
+
+class _Manager:
+    initialized = True
+
+    def __init__(self, cache_stats):
+        self.cache_stats = cache_stats
+
+    def stats(self):
+        return self.cache_stats.as_dict(num_blocks=6, num_cached_blocks=4)
+
+
+class _Model:
+    pass
+
+
+def _retrieve(stats):
+    stats.record_retrieval(torch.tensor([[0, 1], [2, 3]]), loaded=[2, 0])
+    stats.record_retrieval(torch.tensor([[1, 4], [2, 3]]))
+    stats.record_retrieval(torch.tensor([[1, 4], [5, 3]]), loaded=[0, 3])
+    stats.record_eviction(1)
+    stats.record_add()
+
+
+def test_counters():
+    stats = CacheStats(num_units=2, block_bytes=10)
+    _retrieve(stats)
+    stats.record_loads([1, 0])
+
+    s = stats.as_dict(num_blocks=6, num_cached_blocks=4)
+    assert s["retrievals"] == 3
+    assert s["selected_blocks"] == 12
+    assert s["loaded_blocks"] == 6
+    assert s["hit_blocks"] == 6
+    assert s["hit_rate"] == 0.5
+    assert s["loaded_bytes"] == 60
+    assert s["evicted_blocks"] == 1
+    assert s["added_blocks"] == 1
+    # 0, 2 and 3 blocks loaded fall in the buckets 0, 2 and 2
+    assert s["load_histogram"][:3] == [1, 0, 2]
+    assert [u["loaded_blocks"] for u in s["units"]] == [3, 3]
+
+
+def test_churn_is_opt_in():
+    stats = CacheStats(num_units=2, block_bytes=10)
+    _retrieve(stats)
+    s = stats.as_dict()
+    assert s["churn_blocks"] is None and s["churn_rate"] is None
+    assert stats._churn is None and stats._prev_topk is None
+
+    stats = CacheStats(num_units=2, block_bytes=10, track_churn=True)
+    _retrieve(stats)
+    s = stats.as_dict()
+    # the first selection is all new, then unit 0 swaps 0 for 4, then unit 1 swaps 2 for 5
+    assert [u["churn_blocks"] for u in s["units"]] == [3, 3]
+    assert s["churn_blocks"] == 6
+    assert s["churn_rate"] == 0.5
+
+
+def test_model_stats_and_prometheus():
+    model = _Model()
+    managers = [_Manager(CacheStats(2, 10, track_churn=True)), _Manager(CacheStats(2, 10))]
+    for layer_idx, manager in enumerate(managers):
+        _retrieve(manager.cache_stats)
+        register_context_manager(model, layer_idx, manager)
+
+    stats = model_stats(model)
+    assert list(stats["layers"]) == [0, 1]
+    assert stats["total"]["retrievals"] == 6
+    assert stats["total"]["blocks"] == 12
+    assert stats["total"]["load_histogram"][:3] == [2, 0, 4]
+    # layer 1 does not track churn
+    assert stats["total"]["churn_blocks"] is None
+
+    text = to_prometheus(stats)
+    assert "# TYPE infllm_cache_retrievals_total counter\n" in text
+    assert 'infllm_cache_retrievals_total{layer="1"} 3\n' in text
+    assert 'infllm_cache_cached_blocks{layer="0"} 4\n' in text
+    assert 'infllm_cache_churn_blocks_total{layer="0"} 6\n' in text
+    assert 'infllm_cache_churn_blocks_total{layer="1"}' not in text
+    assert 'infllm_cache_loaded_blocks_per_retrieval_bucket{layer="0",le="0"} 1\n' in text
+    assert 'infllm_cache_loaded_blocks_per_retrieval_bucket{layer="0",le="3"} 3\n' in text
+    assert 'infllm_cache_loaded_blocks_per_retrieval_bucket{layer="0",le="+Inf"} 3\n' in text
+    assert 'infllm_cache_loaded_blocks_per_retrieval_sum{layer="0"} 5\n' in text
+
+
+def test_finished_sessions_are_dropped():
+    model = _Model()
+    register_context_manager(model, 0, _Manager(CacheStats(1, 10)))
+    assert model_stats(model)["layers"] == {}
@@ -0,0 +1,36 @@
+import torch
+
+from inf_llm.attention.origin import FullKVCache
+
+
+def _tokens(st, ed):
+    # (batch, num_heads_kv, ed - st, dim_head) with every entry set to its token position
+    return torch.arange(st, ed, dtype=torch.float32)[None, None, :, None].expand(1, 2, ed - st, 3)
+
+
+def _positions(x):
+    return x[0, 0, :, 0].long().tolist()
+
+
+def test_full_cache_grows_geometrically():
+    cache = FullKVCache()
+    k, v = cache.append(_tokens(0, 5), -_tokens(0, 5))
+    assert _positions(k) == list(range(5))
+    assert cache.k.size(-2) == 5
+
+    k, v = cache.append(_tokens(5, 6), -_tokens(5, 6))
+    # the buffer doubles, so that the next steps only copy their own tokens
+    assert cache.k.size(-2) == 10
+    ptr = cache.k.data_ptr()
+    for pos in range(6, 10):
+        k, v = cache.append(_tokens(pos, pos + 1), -_tokens(pos, pos + 1))
+    assert cache.k.data_ptr() == ptr
+
+    assert _positions(k) == list(range(10))
+    assert _positions(-v) == list(range(10))
+
+    # a chunk larger than the doubled buffer grows it to fit
+    k, v = cache.append(_tokens(10, 40), -_tokens(10, 40))
+    assert cache.k.size(-2) == 40
+    assert _positions(k) == list(range(40))
+    assert cache.length == 40
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import torch
+
+from inf_llm.attention import check_memory_budget, session_memory
+from inf_llm.attention.dot_production_attention import get_workspace_pool
+
+
+def _model(**config):
+    inf_llm_config = dict(
+        n_init=4, n_local=16, block_size=8, max_cached_block=2, exc_block_size=8,
+        expected_length=None, absolute_local_rope=False, faiss=False,
+    )
+    inf_llm_config.update(config)
+    return SimpleNamespace(
+        config=SimpleNamespace(
+            num_attention_heads=4, num_key_value_heads=2, hidden_size=32, num_hidden_layers=2
+        ),
+        dtype=torch.float16,
+        inf_llm_config=inf_llm_config,
+    )
+
+
+# keys and values of one token: 2 kv heads * 8 dims * 2 (k and v) * 2 bytes
+KV_BYTES = 64
+
+
+def test_session_memory_before_any_token():
+    session = session_memory(_model())
+    # cuda cache slots + local window + init tokens + 16 block table entries
+    assert session["layer"] == {"gpu": 2 * 8 * KV_BYTES + 16 * KV_BYTES + 4 * KV_BYTES + 16 * 12, "host": 0}
+    # global buffer + float32 accumulators of a query block
+    assert session["workspace"] == (8 + 8 + 4) * KV_BYTES + 4 * 8 * (8 + 2) * 4
+
+
+def test_session_memory_grows_with_memory_units():
+    empty = session_memory(_model())["layer"]
+    # 100 tokens leave (100 - 4 - 16) // 8 = 10 memory units
+    layer = session_memory(_model(), num_tokens=100)["layer"]
+    assert layer["host"] == 10 * 8 * KV_BYTES
+    # one 4 heads * 8 dims fp16 representative per memory unit
+    assert layer["gpu"] - empty["gpu"] == 10 * 4 * 8 * 2
+
+    rope = session_memory(_model(absolute_local_rope=True))["layer"]
+    assert rope["gpu"] - empty["gpu"] == 16 * KV_BYTES // 2
+
+
+def test_budget_of_a_model_without_sessions():
+    get_workspace_pool().clear()
+    model = _model()
+    session = session_memory(model, num_tokens=100)
+    gpu = 2 * session["layer"]["gpu"] + session["workspace"]
+    host = 2 * session["layer"]["host"]
+
+    assert check_memory_budget(model, 100) == {"fits": True, "gpu": gpu, "host": host}
+    assert check_memory_budget(model, 100, gpu_budget=gpu, host_budget=host)["fits"]
+    assert not check_memory_budget(model, 100, gpu_budget=gpu - 1)["fits"]
+    assert not check_memory_budget(model, 100, host_budget=host - 1)["fits"]
+
+
+def test_unpatched_model_has_no_session_cost():
+    get_workspace_pool().clear()
+    model = SimpleNamespace()
+    assert session_memory(model) == {}
+    assert check_memory_budget(model, 1 << 20, gpu_budget=0, host_budget=0)["fits"]
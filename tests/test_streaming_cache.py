@@ -0,0 +1,62 @@
+import torch
+
+from inf_llm.attention.streaming_cache import StreamingKVCache
+
+
+def _tokens(st, ed):
+    # (batch, num_heads_kv, ed - st, dim_head) with every entry set to its token position
+    return torch.arange(st, ed, dtype=torch.float32)[None, None, :, None].expand(1, 2, ed - st, 3)
+
+
+def _positions(x):
+    return x[0, 0, :, 0].long().tolist()
+
+
+def test_streaming_cache_keeps_init_and_local():
+    n_init, n_local = 2, 4
+    cache = StreamingKVCache(n_init, n_local)
+    init_k, init_v, local_k, local_v = cache.append(_tokens(0, 3), -_tokens(0, 3))
+    assert _positions(init_k) == [0, 1]
+    assert _positions(local_k) == [0, 1, 2]
+    capacity = cache.k.size(-2)
+    assert capacity == n_init + 2 * n_local
+
+    for pos in range(3, 40):
+        init_k, init_v, local_k, local_v = cache.append(_tokens(pos, pos + 1), -_tokens(pos, pos + 1))
+        # the new token and the n_local before it
+        assert _positions(local_k) == list(range(max(pos - n_local, 0), pos + 1))
+        assert _positions(-local_v) == _positions(local_k)
+        assert _positions(init_k) == [0, 1]
+
+    # decoding never reallocates the buffer
+    assert cache.k.size(-2) == capacity
+    assert cache.length == 40
+
+
+def test_streaming_cache_chunk_larger_than_the_buffer():
+    cache = StreamingKVCache(2, 4)
+    cache.append(_tokens(0, 8), -_tokens(0, 8))
+    init_k, _, local_k, _ = cache.append(_tokens(8, 28), -_tokens(8, 28))
+    assert _positions(init_k) == [0, 1]
+    assert _positions(local_k) == list(range(4, 28))
+
+
+class _Rope:
+    def __init__(self):
+        self.calls = 0
+
+    def apply_rotary_pos_emb_range(self, x, offset):
+        self.calls += 1
+        return x + offset
+
+
+def test_rotated_init_k_is_reused_once_complete():
+    cache = StreamingKVCache(2, 4)
+    rope = _Rope()
+    cache.append(_tokens(0, 1), _tokens(0, 1))
+    assert _positions(cache.rotated_init_k(rope)) == [0]
+    cache.append(_tokens(1, 3), _tokens(1, 3))
+    assert _positions(cache.rotated_init_k(rope)) == [0, 1]
+    cache.append(_tokens(3, 4), _tokens(3, 4))
+    cache.rotated_init_k(rope)
+    assert rope.calls == 2
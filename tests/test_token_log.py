@@ -0,0 +1,34 @@
+import torch
+
+from inf_llm.attention.context_manager_listener import TokenLog
+
+
+def test_appends_span_chunks():
+    log = TokenLog(chunk_size=4)
+    log.append(torch.tensor([[0, 1, 2]]))
+    log.append(torch.tensor([[3, 4, 5, 6, 7, 8, 9]]))
+    assert len(log) == 10
+    assert [len(chunk) for chunk in log.chunks] == [4, 4, 2]
+    assert log.get(0, 10) == list(range(10))
+    assert log.get(3, 9) == list(range(3, 9))
+    assert log.get(4, 8) == list(range(4, 8))
+    # ranges past the end are cut
+    assert log.get(8, 100) == [8, 9]
+
+
+def test_only_the_first_row_is_kept():
+    log = TokenLog()
+    log.append(torch.tensor([[5, 6], [7, 8]]))
+    assert log.get(0, 2) == [5, 6]
+
+
+def test_clear_starts_a_new_session():
+    log = TokenLog(chunk_size=2)
+    log.append(torch.tensor([[1, 2, 3]]))
+    session = log.session
+    log.clear()
+    assert len(log) == 0
+    assert log.session == session + 1
+
+    log.append(torch.tensor([[4]]))
+    assert log.get(0, 1) == [4]
@@ -0,0 +1,91 @@
+import io
+
+import torch
+
+from inf_llm.attention.context_manager_listener import TraceWriter, TokenLog
+from inf_llm.decode_trace import read_trace, decode_trace
+
+
+def _write_trace(filename, events, token_log=None):
+    # a small buffer, so that the events span several buffer swaps
+    writer = TraceWriter(str(filename), token_log, buffer_records=4)
+    for layer, event, kwargs in events:
+        writer.listener(layer)(event, **kwargs)
+    writer.close()
+
+
+def _decode(filename, **kwargs):
+    out = io.StringIO()
+    decode_trace(str(filename), out, **kwargs)
+    return out.getvalue()
+
+
+def test_topk_per_unit_round_trip(tmp_path):
+    filename = tmp_path / "trace.bin"
+    _write_trace(filename, [
+        (3, 'topk', dict(unit_id=0, ret=[4, 1, 2])),
+        (3, 'topk', dict(unit_id=1, ret=[0, 5])),
+    ])
+
+    records = [(event, layer, unit_id, block_id) for _, event, layer, unit_id, block_id, _, _ in read_trace(str(filename))]
+    assert records == [
+        ('topk', 3, 0, 4), ('topk', 3, 0, 1), ('topk', 3, 0, 2),
+        ('topk', 3, 1, 0), ('topk', 3, 1, 5),
+    ]
+
+    text = _decode(filename)
+    assert "l03 u00  topk\n  ret=[4, 1, 2]\n" in text
+    assert "l03 u01  topk\n  ret=[0, 5]\n" in text
+
+
+def test_topk_of_all_units_is_split_per_unit(tmp_path):
+    # the (num_units, k) selection of the batched top-k, as one nested list
+    filename = tmp_path / "trace.bin"
+    _write_trace(filename, [
+        (0, 'topk', dict(unit_id=0, ret=[[7, 8], [9, 6]])),
+    ])
+
+    text = _decode(filename)
+    assert "l00 u00  topk\n  ret=[7, 8]\n" in text
+    assert "l00 u01  topk\n  ret=[9, 6]\n" in text
+
+
+def test_block_contents_follow_sessions(tmp_path):
+    filename = tmp_path / "trace.bin"
+    token_log = TokenLog(chunk_size=3)
+    writer = TraceWriter(str(filename), token_log, buffer_records=4)
+    listener = writer.listener(1)
+
+    token_log.append(torch.tensor([[10, 11, 12, 13, 14]]))
+    listener('add', unit_id=0, block_id=0, block_start=0, block_end=2)
+    listener('add', unit_id=0, block_id=1, block_start=2, block_end=5)
+    listener('load', unit_id=0, block_id=1, block_start=2, block_end=5)
+    listener('evict', unit_id=0, block_id=0)
+
+    token_log.clear()
+    token_log.append(torch.tensor([[20, 21]]))
+    listener('add', unit_id=0, block_id=0, block_start=0, block_end=2)
+    writer.close()
+
+    text = _decode(filename)
+    assert text.count("  add block") == 3
+    assert "  block_contents=[10, 11]\n" in text
+    assert text.count("  block_contents=[12, 13, 14]\n") == 2
+    assert "evict block 0\n" in text
+    assert text.endswith("  block_contents=[20, 21]\n")
+
+    # each token is traced once per session
+    tokens = [block_id for _, event, _, _, block_id, _, _ in read_trace(str(filename)) if event == 'token']
+    assert tokens == [10, 11, 12, 13, 14, 20, 21]
+
+
+def test_layer_filter_and_no_contents(tmp_path):
+    filename = tmp_path / "trace.bin"
+    _write_trace(filename, [
+        (0, 'evict', dict(unit_id=0, block_id=3)),
+        (1, 'evict', dict(unit_id=0, block_id=4)),
+    ])
+
+    text = _decode(filename, layer=1, contents=False)
+    assert "block 4" in text
+    assert "block 3" not in text
@@ -0,0 +1,45 @@
+import torch
+
+from inf_llm.attention.dot_production_attention import WorkspacePool, get_workspace_pool
+
+
+def test_views_share_one_buffer_per_name():
+    pool = WorkspacePool()
+    a = pool.get("o", (2, 3), torch.float32, "cpu")
+    assert a.shape == (2, 3)
+    assert torch.equal(a, torch.zeros((2, 3)))
+
+    a.fill_(1.)
+    b = pool.get("o", (3,), torch.float32, "cpu")
+    # a smaller request is a view of the same prefix
+    assert b.data_ptr() == a.data_ptr()
+    assert torch.equal(b, torch.ones((3,)))
+    assert pool.nbytes() == 6 * 4
+
+
+def test_buffers_grow_to_the_largest_request():
+    pool = WorkspacePool()
+    pool.get("o", (4,), torch.float32, "cpu").fill_(1.)
+    c = pool.get("o", (2, 4), torch.float32, "cpu")
+    # a larger request reallocates, zero filled
+    assert torch.equal(c, torch.zeros((2, 4)))
+    assert pool.nbytes() == 8 * 4
+
+    pool.get("o", (2,), torch.float32, "cpu")
+    assert pool.nbytes() == 8 * 4
+
+
+def test_names_and_dtypes_are_separate():
+    pool = WorkspacePool()
+    pool.get("o", (4,), torch.float32, "cpu")
+    pool.get("lse", (4,), torch.float32, "cpu")
+    pool.get("o", (4,), torch.float16, "cpu")
+    assert pool.nbytes() == 4 * 4 + 4 * 4 + 4 * 2
+    assert pool.nbytes("cpu") == pool.nbytes()
+
+    pool.clear()
+    assert pool.nbytes() == 0
+
+
+def test_shared_pool():
+    assert get_workspace_pool() is get_workspace_pool()